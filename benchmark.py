@@ -0,0 +1,305 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tracemalloc
+
+import optimizer
+
+# Benchmarks for the greedy_value hot paths (PState.value, get_greedy_best,
+# tick, apply_mods). Every case is timed on a fresh pstate, best of at least
+# --repeat runs (and MIN_SECONDS of runs), and compared against the stored
+# baseline:
+#
+#   python benchmark.py                 compare against benchmark_baseline.json
+#   python benchmark.py --save          store the results as the new baseline
+#   python benchmark.py --quick         skip the hour long horizons
+#
+# Timings are compared relative to a calibration loop (plain python, none of
+# the optimizer) that is timed with every run and saved with each baseline
+# entry, so a baseline from a faster or slower machine still applies.
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+HORIZONS = [
+    ("60s", optimizer.to_ticks(sec=60)),
+    ("10m", optimizer.to_ticks(sec=600)),
+    ("1h", optimizer.to_ticks(sec=3600)),
+    ("3h", optimizer.to_ticks(sec=3 * 3600)),
+]
+
+QUICK_HORIZONS = ["60s", "10m"]
+
+SYNTHETIC_SIZES = [15, 60, 200, 600]
+
+# Synthetic bars that are also run on ArrayPState, it's only meant to pay off
+# on wide bars
+ARRAY_SIZES = [200, 600]
+
+# Metric -> True if bigger is better
+METRICS = {
+    "decisions_per_sec": True,
+    "value_us": False,
+    "peak_kb": False,
+}
+
+# Metrics that scale with the speed of the machine
+TIMED_METRICS = ["decisions_per_sec", "value_us"]
+
+# Short cases are repeated until they've run for at least this long (CPU
+# time, so other processes on the machine don't count against a case)
+MIN_SECONDS = 0.5
+
+# Fixed seed so prng runs make the same decisions every time
+SEED = 1234
+
+
+# Bar of n actions made from copies of the melee and range bars (copies get
+# a number added to their name so the names stay unique)
+def synthetic_bar(n):
+    source = optimizer.melee_2h_actions + optimizer.range_2h_actions
+    actions = []
+
+    for i in range(0, n):
+        action = copy.deepcopy(source[i % len(source)])
+        copies = i // len(source)
+
+        if copies > 0:
+            action.name = "{0} {1}".format(action.name, copies)
+
+        actions.append(action)
+
+    return actions
+
+def get_cases(quick=False):
+    cases = []
+
+    for bar in ("melee_2h", "range_2h"):
+        for horizon, ticks in HORIZONS:
+            if quick and horizon not in QUICK_HORIZONS:
+                continue
+
+            for prng in (False, True):
+                cases.append({
+                    "name": "{0}/{1}/prng-{2}".format(bar, horizon, "on" if prng else "off"),
+                    "actions": lambda bar=bar: copy.deepcopy(optimizer.action_bars[bar]),
+                    "ticks": ticks,
+                    "prng": prng,
+                })
+
+    for n in SYNTHETIC_SIZES:
+        for prng in (False, True):
+            cases.append({
+                "name": "synthetic-{0}/10m/prng-{1}".format(n, "on" if prng else "off"),
+                "actions": lambda n=n: synthetic_bar(n),
+                "ticks": optimizer.to_ticks(sec=600),
+                "prng": prng,
+            })
+
+            if n in ARRAY_SIZES:
+                cases.append(dict(cases[-1], name=cases[-1]["name"] + "/array", engine=optimizer.ArrayPState))
+
+    return cases
+
+# Fixed workload of the kind the hot paths do (dict lookups, float math,
+# builtin calls), best CPU time of `repeat` runs
+def calibrate(repeat=5):
+    best = None
+
+    for _ in range(0, repeat):
+        start = time.process_time()
+        calibration_loop()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def calibration_loop(n=200000):
+    values = {}
+    total = 0.0
+
+    for i in range(0, n):
+        key = i & 63
+        total += max(values.get(key, 0.0), float(i)) * 0.5
+        values[key] = total - int(total)
+
+    return total
+
+def new_pstate(case):
+    engine = case.get("engine", optimizer.PState)
+    return engine(case["actions"](), use_ringofvigour=True, use_prng=case["prng"], seed=SEED)
+
+# Average time of a PState.value call over a run, best of `repeat` runs (these
+# runs aren't used for the decision timings because of the extra overhead)
+def time_value_calls(case, repeat=3):
+    return min(time_value_run(case) for _ in range(0, repeat))
+
+def time_value_run(case):
+    calls = [0, 0.0]
+    value = optimizer.PState.value
+
+    def timed_value(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = value(self, *args, **kwargs)
+        calls[1] += time.perf_counter() - start
+        calls[0] += 1
+        return result
+
+    optimizer.PState.value = timed_value
+
+    try:
+        optimizer.greedy_value(new_pstate(case), case["ticks"])
+    finally:
+        optimizer.PState.value = value
+
+    return calls[1] / calls[0] * 1e6 if calls[0] else 0.0
+
+def peak_memory(case):
+    tracemalloc.start()
+
+    try:
+        optimizer.greedy_value(new_pstate(case), case["ticks"])
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+def run_case(case, repeat=5):
+    best = None
+    decisions = 0
+    runs = 0
+    total = 0.0
+
+    while runs < repeat or total < MIN_SECONDS:
+        pstate = new_pstate(case)
+        start = time.process_time()
+        rotation = optimizer.greedy_value(pstate, case["ticks"])
+        elapsed = time.process_time() - start
+
+        decisions = len(rotation)
+        best = elapsed if best is None else min(best, elapsed)
+        runs += 1
+        total += elapsed
+
+    return {
+        "decisions": decisions,
+        "seconds": best,
+        "decisions_per_sec": decisions / best if best else 0.0,
+        "value_us": time_value_calls(case),
+        "peak_kb": peak_memory(case),
+    }
+
+# Baseline value of a metric at the speed of this run: timed metrics are
+# scaled by how much faster the calibration loop ran now than when the entry
+# was saved (entries saved without a calibration time are used as they are)
+def expected(entry, metric, calibration):
+    old = entry.get(metric)
+
+    if not old or metric not in TIMED_METRICS or not entry.get("calibration") or not calibration:
+        return old
+
+    speed = entry["calibration"] / calibration
+    return old * speed if METRICS[metric] else old / speed
+
+# Metrics that are worse than the baseline by more than threshold (a fraction,
+# 0.25 = 25%) as (name, metric, baseline, result) tuples, baseline values are
+# scaled to the results' calibration time
+def find_regressions(results, baseline, threshold):
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for metric, bigger_is_better in METRICS.items():
+            old = expected(baseline[name], metric, result.get("calibration"))
+            new = result[metric]
+
+            if not old:
+                continue
+
+            change = (new - old) / old
+            if (bigger_is_better and change < -threshold) or (not bigger_is_better and change > threshold):
+                regressions.append((name, metric, old, new))
+
+    return regressions
+
+def print_results(results, baseline):
+    print("{0:32} | {1:>9} | {2:>12} | {3:>9} | {4:>9} | {5}".format(
+        "Case", "Decisions", "Decisions/s", "Value us", "Peak KB", "vs baseline"
+    ))
+
+    for name, r in results.items():
+        change = ""
+        old = expected(baseline[name], "decisions_per_sec", r.get("calibration")) if name in baseline else None
+        if old:
+            change = "{0:+.1f}%".format(100.0 * (r["decisions_per_sec"] - old) / old)
+
+        print("{0:32} | {1:>9} | {2:>12.0f} | {3:>9.2f} | {4:>9.0f} | {5}".format(
+            name, r["decisions"], r["decisions_per_sec"], r["value_us"], r["peak_kb"], change
+        ))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark greedy_value against a stored baseline")
+    parser.add_argument("--quick", action="store_true", help="Skip the hour long horizons")
+    parser.add_argument("--filter", default=None, help="Only run cases with this in their name")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.25,
+        help="Allowed slowdown before a metric counts as a regression (0.25 = 25%%)")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="Store the results as the baseline")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    calibration = calibrate()
+
+    for case in get_cases(quick=args.quick):
+        if args.filter is not None and args.filter not in case["name"]:
+            continue
+
+        results[case["name"]] = run_case(case, repeat=args.repeat)
+
+    # Timed before and after the cases, the quicker one is the least
+    # disturbed by whatever else the machine was doing
+    calibration = min(calibration, calibrate())
+    for r in results.values():
+        r["calibration"] = calibration
+
+    print("Calibration loop: {0:.3f}s".format(calibration))
+    print_results(results, baseline)
+
+    if args.save:
+        baseline.update(results)
+
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+
+        print()
+        print("Saved baseline to {0}".format(args.baseline))
+        return 0
+
+    regressions = find_regressions(results, baseline, args.threshold)
+
+    if len(regressions) > 0:
+        print()
+        print("Regressions (more than {0:.0f}% worse than baseline):".format(args.threshold * 100))
+
+        for name, metric, old, new in regressions:
+            print("| {0:32} {1:18} {2:.2f} -> {3:.2f}".format(name, metric, old, new))
+
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
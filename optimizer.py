@@ -4,6 +4,30 @@ import inspect
 import random
 import math
 import ast
+import heapq
+import statistics
+import argparse
+import itertools
+import functools
+import bisect
+import concurrent.futures
+import asyncio
+import signal
+import sys
+import collections
+import json
+import time
+import os
+import pickle
+import hashlib
+import operator
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for ArrayPState
+    np = None
 
 def adjust_adrenaline(pstate, action):
     # Adjust adrenaline as appropriate
@@ -13,10 +37,11 @@ def adjust_adrenaline(pstate, action):
             actual_change = -90
         elif action.adrenaline_change == -15 and \
                 pstate.use_ASR and pstate.use_prng:
-            actual_change = 0 if random.random() <= .1 else -15
+            actual_change = 0 if pstate.rng.random() <= .1 else -15
         else:
             actual_change = action.adrenaline_change
         
+        pstate.remember(pstate, "adrenaline", "gained_adrenaline", "spent_adrenaline", "excess_adrenaline")
         pstate.adrenaline += actual_change
         
         if actual_change > 0:
@@ -33,26 +58,34 @@ def adjust_adrenaline(pstate, action):
 def apply_mods(pstate, action):
     # If we have a mod, apply mod to the pstate
     if hasattr(action, "mod") and type(action.mod) == Modifier:
-        mod = copy.deepcopy(action.mod)
-        mod.reset()
-        
-        if mod.name not in[m.name for m in pstate.active_mods if m.is_unqiue]:
-            pstate.active_mods.append(mod)
+        if action.mod.name not in[m.name for m in pstate.active_mods if m.is_unqiue]:
+            # New list rather than append so a snapshot can keep the old one
+            pstate.remember(pstate, "active_mods")
+            pstate.active_mods = pstate.active_mods + [pstate.acquire_mod(action.mod)]
         else:
             # We should find the mod and reset it if it was just rewned
             for i in range(0, len(pstate.active_mods)):
-                if pstate.active_mods[i].name == mod.name:
+                if pstate.active_mods[i].name == action.mod.name:
+                    pstate.remember(pstate.active_mods[i], "last_used", "is_active")
                     pstate.active_mods[i].reset()
+        
+        if pstate.value_cache is not None:
+            pstate.value_cache.update_mods()
 
         
 def update_buddies(pstate, action):
     # Update any of our buddy actions that share a cooldown with us
     # (useful for testing variations of stopping multi-tick abilities)
     if action.shares_cooldown():
-        for action_name in action.buddy_actions:
-            i = Action.find_by_name(action_name, action_list=pstate.actions)
-            if i is not None:
-                pstate.actions[i].last_used = 0
+        for i in pstate.actions.buddies_of(action):
+            pstate.remember(pstate.actions[i], "last_used")
+            pstate.actions[i].last_used = 0
+            
+            if pstate.value_cache is not None:
+                pstate.value_cache.update_action(i)
+                
+            if pstate.ready_set is not None:
+                pstate.ready_set.update_action(i)
             
             
 def register_action_value(pstate, action):   
@@ -62,32 +95,981 @@ def register_action_value(pstate, action):
     i = Action.find_by_name(action.name, pstate.actions)
     
     if i is not None:
+        pstate.remember(pstate.actions[i], "total_used_value")
         pstate.actions[i].total_used_value += pstate.value(action, mod_value_prediction=False)    
 
+
+# What every PState runs on activation unless it's given other hooks
+default_on_activate = (
+    adjust_adrenaline,
+    apply_mods,
+    update_buddies,
+    register_action_value,
+)
+
+
+class EventQueue(object):
+    # Priority queue of the upcoming ticks (absolute, in pstate.elapsed_ticks)
+    # where the set of available actions or active mods can change. It's
+    # built from the pstate when a decision point finds nothing available
+    # and stays valid for as long as we are idle (only an activation adds
+    # new cooldowns or mods), so runs that are never idle don't pay for it.
+    # Entries can go stale (ie. a renewed mod), they only cause an extra
+    # wake-up which re-checks the pstate.
+    #
+    # Adrenaline only changes when an action is activated, so the pstate_check
+    # thresholds are re-evaluated at every decision point and never flip while
+    # we are idle. Conditions that compare a cooldown get a wake-up where the
+    # cooldown crosses the other side of the comparison (see
+    # Condition.cooldown_crossings). Conditions that read the clock or read a
+    # cooldown some other way can flip on any tick, with one of those on the
+    # bar we wake up every tick. Python function checks can read anything,
+    # so they count as one of those.
+    COOLDOWN = "cooldown"
+    MODIFIER = "modifier"
+    CROSSING = "crossing"
+
+    def __init__(self):
+        self.events = []
+        self.counter = 0
+        self.every_tick = False
+
+    @staticmethod
+    def from_pstate(pstate):
+        events = EventQueue()
+        checks = [a.pstate_check for a in pstate.actions if type(a.pstate_check) is Condition]
+        events.every_tick = any(inspect.isfunction(a.pstate_check) for a in pstate.actions) or any(
+            c.reads_clock or (c.reads_timers and c.crossings is None) for c in checks
+        )
+
+        for a in pstate.actions:
+            events.push_action(pstate.elapsed_ticks, a)
+
+        for check in dict.fromkeys(checks):
+            for name, difference in check.crossings or ():
+                events.push_crossing(pstate, name, difference)
+
+        for m in pstate.active_mods:
+            if m.is_active:
+                events.push_mod(pstate.elapsed_ticks, m, elapsed=m.last_used)
+
+        return events
+
+    def push(self, tick, kind, name):
+        # Counter keeps ordering stable for events on the same tick
+        heapq.heappush(self.events, (tick, self.counter, kind, name))
+        self.counter += 1
+
+    def push_action(self, now, action):
+        remaining = action.time_remaining
+        if remaining > 0:
+            self.push(now + int(math.ceil(remaining)), EventQueue.COOLDOWN, action.name)
+
+    def push_mod(self, now, mod, elapsed=0):
+        if mod.duration is not None:
+            self.push(now + max(1, mod.duration - elapsed), EventQueue.MODIFIER, mod.name)
+
+    def push_crossing(self, pstate, name, difference):
+        # difference (left - right of the comparison) is linear in the
+        # cooldown, it changes sign k ticks from now. Both ticks around k
+        # are pushed, in case k is a whole tick (equal, then past it) or
+        # off by a rounding error.
+        i = Action.find_by_name(name, pstate.actions)
+        if i is None:
+            return
+
+        remaining = pstate.actions[i].time_remaining
+        at_zero = difference(pstate, 0.0)
+        slope = difference(pstate, 1.0) - at_zero
+        if slope == 0:
+            return
+
+        k = remaining + at_zero / slope
+        for tick in set([int(math.floor(k)), int(math.floor(k)) + 1, int(math.ceil(k)), int(math.ceil(k)) + 1]):
+            if tick > 0:
+                self.push(pstate.elapsed_ticks + tick, EventQueue.CROSSING, name)
+
+    def next_event(self, now):
+        # Drop anything that already happened and peek at the next tick
+        if self.every_tick:
+            return now + 1
+
+        while len(self.events) > 0 and self.events[0][0] <= now:
+            heapq.heappop(self.events)
+
+        if len(self.events) == 0:
+            return None
+
+        return self.events[0][0]
+
+    def __len__(self):
+        return len(self.events)
+
+
+class ValueCache(object):
+    # Memoizes PState.value. Entries don't have to be thrown away as the
+    # pstate runs, the keys cover everything that changes:
+    #   base value -> (action definition, active mod signature)
+    #   mod gain   -> (action, modable actions that are within the mod's
+    #                  tick window and pass their pstate_check)
+    # tick/activate/apply_mods only update the key inputs when they actually
+    # change (a cooldown crossing a window, a mod being added or expiring).
+    # Mod gains are worked out from tables built with the cache instead of
+    # rescanning the actions (see mod_value_increase). The tables are built
+    # from the definitions, after replacing one (a parameter setter like
+    # action.max = ..., a new mod) call PState.update_definitions.
+    def __init__(self, pstate, max_size=100000):
+        self.pstate = pstate
+        self.max_size = max_size
+        self.base_values = {}
+        self.hits = 0
+        self.misses = 0
+
+        # Used to check pstate_checks against the "maximum possible
+        # adrenaline" for mods that have a duration
+        self.adrenaline_pstate = PState(actions=[], use_value_cache=False)
+        self.rebuild()
+
+    def rebuild(self):
+        # Tables from the actions' current definitions and timers, base
+        # values are kept (they are keyed by definition)
+        pstate = self.pstate
+        self.mod_values = {}
+
+        # Distinct pstate_check functions, their results are what
+        # we use as the adrenaline band
+        self.checks = []
+        for a in pstate.actions:
+            if is_pstate_check(a.pstate_check) and a.pstate_check not in self.checks:
+                self.checks.append(a.pstate_check)
+
+        # Gain tables for the mod predictions. For every action with a mod,
+        # the value per tick (mod applied) of each modable action it could
+        # boost, and the actions that pass their pstate_check as a bitmask
+        # for each set of check results (by adrenaline for duration mods,
+        # their checks only ever see adrenaline).
+        self.gain_terms = {}
+        self.band_masks = {}
+        self.adrenaline_masks = {}
+        self.build_gain_terms()
+
+        # Bitmask (by action index) of actions that will be off cooldown
+        # within each tick window a mod prediction looks at. Actions that are
+        # outside of a window are queued up by the tick they will enter it.
+        self.windows = {}
+        self.window_entries = []
+        self.enters_at = {}
+        for a in pstate.actions:
+            window = ValueCache.mod_window(a)
+            if window is not None:
+                self.windows[window] = 0
+
+        for i in range(0, len(pstate.actions)):
+            self.update_action(i)
+
+        self.mod_signature = None
+        self.update_mods()
+
+    def add_action(self, i):
+        action = self.pstate.actions[i]
+
+        if is_pstate_check(action.pstate_check) and action.pstate_check not in self.checks:
+            self.checks.append(action.pstate_check)
+
+        # Every gain table has a term/bit for each action
+        self.mod_values = {}
+        self.build_gain_terms()
+
+        window = ValueCache.mod_window(action)
+        if window is not None and window not in self.windows:
+            # New window, fill it in for every action
+            self.windows[window] = 0
+            for j in range(0, len(self.pstate.actions)):
+                self.update_action(j)
+        else:
+            self.update_action(i)
+
+    def build_gain_terms(self):
+        actions = self.pstate.actions
+        self.band_masks = {}
+        self.adrenaline_masks = {}
+        self.modable_mask = 0
+        self.gain_terms = {}
+
+        for j in range(0, len(actions)):
+            if getattr(actions[j], "modable", False):
+                self.modable_mask |= 1 << j
+
+        # Terms are in bar order so the sums round the same as
+        # PState.normalized_average_value
+        for a in actions:
+            if getattr(a, "mod", None) is not None:
+                self.gain_terms[a.name] = [
+                    (1 << j, a.mod.apply_mod(actions[j].value()) / actions[j].ticks)
+                    for j in range(0, len(actions)) if self.modable_mask & (1 << j)
+                ]
+
+    def band_mask(self, pstate):
+        # Bitmask of the actions whose pstate_check passes on pstate
+        checks = self.check_signature(pstate)
+        mask = self.band_masks.get(checks)
+
+        if mask is None:
+            results = dict(zip(self.checks, checks))
+            mask = 0
+
+            for j, a in enumerate(self.pstate.actions):
+                if a.pstate_check not in results or results[a.pstate_check] ^ a.negative_pstate_check:
+                    mask |= 1 << j
+
+            self.band_masks[checks] = mask
+
+        return mask
+
+    def adrenaline_mask(self, adrenaline):
+        mask = self.adrenaline_masks.get(adrenaline)
+
+        if mask is None:
+            self.adrenaline_pstate.adrenaline = adrenaline
+            mask = self.band_mask(self.adrenaline_pstate)
+            self.adrenaline_masks[adrenaline] = mask
+
+        return mask
+
+    @staticmethod
+    def mod_window(action):
+        mod = getattr(action, "mod", None)
+        if mod is None:
+            return None
+
+        return action.ticks if mod.one_time_use else mod.duration
+
+    @property
+    def size(self):
+        return len(self.base_values) + len(self.mod_values)
+
+    def clear(self):
+        self.base_values = {}
+        self.mod_values = {}
+
+    def update_action(self, i):
+        # Recompute the window bits of a single action (after it's
+        # cooldown was reset by an activation or a buddy). Bars without
+        # mods have no windows to track.
+        if not self.windows:
+            return
+
+        remaining = self.pstate.actions[i].time_remaining
+        bit = 1 << i
+        journal = self.pstate.journal
+
+        for window in self.windows:
+            if journal is not None:
+                journal.undo(self.windows.__setitem__, window, self.windows[window])
+                journal.undo(self.restore_entry, (window, i), self.enters_at.get((window, i)))
+
+            if remaining <= window:
+                self.windows[window] |= bit
+                self.enters_at.pop((window, i), None)
+            else:
+                self.windows[window] &= ~bit
+                enters_at = self.pstate.elapsed_ticks + remaining - window
+                self.enters_at[(window, i)] = enters_at
+                heapq.heappush(self.window_entries, (enters_at, window, i))
+
+    def restore_entry(self, key, enters_at):
+        # Undo for a window entry, it might have already been popped
+        # so push it again (duplicates are skipped by update_tick)
+        if enters_at is None:
+            self.enters_at.pop(key, None)
+        else:
+            self.enters_at[key] = enters_at
+            heapq.heappush(self.window_entries, (enters_at, key[0], key[1]))
+
+    def update_tick(self):
+        # Cooldowns only go down when ticking, so actions can only
+        # enter a window here (never leave it). Entries that were replaced
+        # by a later update_action are skipped.
+        if not self.window_entries:
+            return
+
+        now = self.pstate.elapsed_ticks
+
+        while len(self.window_entries) > 0 and self.window_entries[0][0] <= now:
+            enters_at, window, i = heapq.heappop(self.window_entries)
+
+            if self.enters_at.get((window, i)) == enters_at:
+                if self.pstate.journal is not None:
+                    self.pstate.journal.undo(self.windows.__setitem__, window, self.windows[window])
+                    self.pstate.journal.undo(self.restore_entry, (window, i), enters_at)
+
+                del self.enters_at[(window, i)]
+                self.windows[window] |= 1 << i
+
+    def update_mods(self):
+        self.pstate.remember(self, "mod_signature")
+        self.mod_signature = tuple(
+            (m.name, m.multiplier) for m in self.pstate.active_mods if m.is_active
+        )
+
+    def branch(self, pstate):
+        # The cached values are keyed by content so they are valid for
+        # every branch, only the window tracking is per pstate
+        cache = copy.copy(self)
+        cache.pstate = pstate
+        cache.windows = dict(self.windows)
+        cache.window_entries = list(self.window_entries)
+        cache.enters_at = dict(self.enters_at)
+        return cache
+
+    def check_signature(self, pstate):
+        return tuple(f(pstate) for f in self.checks)
+
+    def store(self, table, key, value):
+        if self.size >= self.max_size:
+            self.clear()
+
+        table[key] = value
+
+    def base_value(self, action):
+        # Random rolls can't be cached
+        if self.pstate.use_prng:
+            return self.pstate.base_value(action)
+
+        definition = action.definition
+        key = (definition, self.mod_signature if definition.modable else None)
+
+        if key in self.base_values:
+            self.hits += 1
+            return self.base_values[key]
+
+        self.misses += 1
+        value = self.pstate.base_value(action)
+        self.store(self.base_values, key, value)
+
+        return value
+
+    def mod_value_increase(self, action):
+        # Same prediction as PState.mod_value_increase, from the gain tables
+        window = ValueCache.mod_window(action)
+        mod = action.mod
+
+        if mod.one_time_use:
+            band = self.band_mask(self.pstate)
+        else:
+            band = self.adrenaline_mask(int(self.pstate.adrenaline + ((window - 3) / 3.0) * 8))
+
+        key = (action.name, self.windows[window] & band & self.modable_mask)
+
+        if key in self.mod_values:
+            self.hits += 1
+            return self.mod_values[key]
+
+        self.misses += 1
+        values = [v for bit, v in self.gain_terms[action.name] if key[1] & bit]
+        value_increase = lambda v,m : v - (v / (1 + m))
+
+        if mod.one_time_use:
+            value = value_increase(max([0] + values), mod.multiplier)
+        else:
+            average_tick_value = sum(values) / len(values) if len(values) > 0 else 0
+            value = value_increase(average_tick_value, mod.multiplier) * mod.duration
+
+        self.store(self.mod_values, key, value)
+
+        return value
+
+
+
+def iter_bits(mask):
+    # Indexes of the set bits, lowest first
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class ReadySet(object):
+    # The actions that are off cooldown as a bitmask by action index (so
+    # bar order is kept), maintained as the pstate changes instead of
+    # rescanning the bar every decision. Actions on cooldown are queued by
+    # the tick they come off it, activations and buddy resets take them out
+    # again. enabled and the pstate_checks are only looked at for the
+    # actions in the set. Conditions that only depend on adrenaline keep
+    # their result until adrenaline crosses (or lands on) one of the numbers
+    # they compare it with (see Condition.adrenaline_thresholds). Cooldowns, last_used and the
+    # bar order are only followed through tick/activate: after changing
+    # them any other way (or replacing a definition) call
+    # PState.update_definitions, which rebuilds the set.
+    def __init__(self, pstate):
+        self.pstate = pstate
+        self.rebuild()
+
+    def rebuild(self):
+        actions = self.pstate.actions
+        self.size = len(actions)
+        self.ready = 0
+        self.always_use = 0
+        self.pending = []
+        self.ready_at = {}
+        self.adrenaline = None
+        self.band = None
+        self.adrenaline_results = {}
+        self.update_thresholds()
+
+        for i in range(0, self.size):
+            if actions[i].always_use == True:
+                self.always_use |= 1 << i
+            self.update_action(i)
+            
+    def update_thresholds(self):
+        # Every threshold of the adrenaline only conditions on the bar, None
+        # when one of them isn't a plain comparison
+        thresholds = set()
+        
+        for a in self.pstate.actions:
+            check = a.pstate_check
+            if type(check) is Condition and check.adrenaline_only:
+                if check.thresholds is None:
+                    thresholds = None
+                    break
+                thresholds.update(check.thresholds)
+                
+        self.thresholds = None if thresholds is None else sorted(thresholds)
+        self.band = None
+
+    def adrenaline_band(self, adrenaline):
+        # Conditions that only read adrenaline give the same result anywhere
+        # in a band, between two of their thresholds or on one. Without
+        # known thresholds every adrenaline value is its own band.
+        if self.thresholds is None:
+            return adrenaline
+            
+        i = bisect.bisect_left(self.thresholds, adrenaline)
+        return (i, i < len(self.thresholds) and self.thresholds[i] == adrenaline)
+        
+    def update_action(self, i):
+        # After the action's cooldown was reset (activation or a buddy)
+        bit = 1 << i
+        remaining = self.pstate.actions[i].time_remaining
+        journal = self.pstate.journal
+
+        if journal is not None:
+            journal.undo(self.restore, i, self.ready & bit, self.ready_at.get(i))
+
+        if remaining <= 0:
+            self.ready |= bit
+            self.ready_at.pop(i, None)
+        else:
+            self.ready &= ~bit
+            ready_at = self.pstate.elapsed_ticks + remaining
+            self.ready_at[i] = ready_at
+            heapq.heappush(self.pending, (ready_at, i))
+
+    def restore(self, i, ready, ready_at):
+        # Undo for update_action/update_tick, the queue entry might have
+        # already been popped so it's pushed again (duplicates are skipped)
+        bit = 1 << i
+        self.ready = self.ready | bit if ready else self.ready & ~bit
+
+        if ready_at is None:
+            self.ready_at.pop(i, None)
+        else:
+            self.ready_at[i] = ready_at
+            heapq.heappush(self.pending, (ready_at, i))
+
+    def update_tick(self):
+        now = self.pstate.elapsed_ticks
+        pending = self.pending
+        journal = self.pstate.journal
+
+        while len(pending) > 0 and pending[0][0] <= now:
+            ready_at, i = heapq.heappop(pending)
+
+            if self.ready_at.get(i) == ready_at:
+                if journal is not None:
+                    journal.undo(self.restore, i, False, ready_at)
+
+                del self.ready_at[i]
+                self.ready |= 1 << i
+
+    def add_action(self, i):
+        if self.pstate.actions[i].always_use == True:
+            self.always_use |= 1 << i
+        self.size += 1
+        self.update_thresholds()
+        self.update_action(i)
+
+    def branch(self, pstate):
+        ready = copy.copy(self)
+        ready.pstate = pstate
+        ready.pending = list(self.pending)
+        ready.ready_at = dict(self.ready_at)
+        ready.adrenaline_results = dict(self.adrenaline_results)
+        return ready
+
+    def select(self, mask, results):
+        # The actions in mask that are enabled and pass their pstate_check,
+        # results are the check results for this decision
+        actions = self.pstate.actions
+        selected = []
+
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            action = actions[low.bit_length() - 1]
+
+            if not action.enabled:
+                continue
+
+            definition = action.definition
+            check = definition.pstate_check
+
+            if check is None:
+                selected.append(action)
+                continue
+
+            if type(check) is Condition:
+                if check.adrenaline_only:
+                    adrenaline = self.pstate.adrenaline
+                    if adrenaline != self.adrenaline:
+                        self.adrenaline = adrenaline
+                        band = self.adrenaline_band(adrenaline)
+                        if band != self.band:
+                            self.band = band
+                            self.adrenaline_results = {}
+                    cache = self.adrenaline_results
+                else:
+                    cache = results
+
+                result = cache.get(check)
+                if result is None:
+                    result = cache[check] = check.test(self.pstate)
+            elif inspect.isfunction(check):
+                result = results.get(check)
+                if result is None:
+                    result = results[check] = check(self.pstate)
+            else:
+                result = not definition.negative_pstate_check
+
+            if result ^ definition.negative_pstate_check:
+                selected.append(action)
+
+        return selected
+
+    def available(self):
+        # Same as PState.get_available_actions (always_use actions first)
+        if len(self.pstate.actions) != self.size:
+            self.rebuild()
+
+        results = {}
+        always_use = self.ready & self.always_use
+
+        if always_use:
+            always_use_actions = self.select(always_use, results)
+
+            if len(always_use_actions) > 0:
+                return always_use_actions
+
+        return self.select(self.ready, results)
+
+
+class Journal(object):
+    # Undo log behind PState.snapshot/restore. Every change made while it
+    # is open is recorded as a function (and arguments) that reverts it, so
+    # rolling back only costs as much as what actually changed.
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def remember(self, obj, *attrs):
+        for attr in attrs:
+            self.entries.append((setattr, (obj, attr, getattr(obj, attr))))
+
+    def undo(self, f, *args):
+        self.entries.append((f, args))
+
+    def rollback(self, token):
+        while len(self.entries) > token:
+            f, args = self.entries.pop()
+            f(*args)
+
+
+class Instrumentation(object):
+    # Opt-in counters/timers for a pstate (see PState.enable_instrumentation),
+    # with it off the hot paths only pay for an "is None" check. Records:
+    #   - calls and time for every on_activate hook
+    #   - PState.value calls, direct vs with a mod prediction
+    #   - the number of available actions at every decision
+    #   - ticks skipped with nothing available
+    #   - inclusive time of each timed section by its stack of sections
+    #     (get_greedy_best > mod_prediction, activate > hook, ...)
+    def __init__(self):
+        self.hook_calls = collections.Counter()
+        self.hook_time = collections.Counter()
+        self.value_calls = collections.Counter()
+        self.available_sizes = collections.Counter()
+        self.ticks_skipped = 0
+        self.section_time = collections.Counter()
+        self.stack = []
+
+    def start(self, name):
+        self.stack.append((name, time.perf_counter()))
+
+    def stop(self):
+        name, started = self.stack.pop()
+        elapsed = time.perf_counter() - started
+        self.section_time[";".join([n for n, _ in self.stack] + [name])] += elapsed
+        return elapsed
+
+    def start_hook(self, f):
+        # Around each on_activate hook in PState.activate
+        name = getattr(f, "__name__", repr(f))
+        self.start(name)
+        return name
+
+    def stop_hook(self, name):
+        self.hook_calls[name] += 1
+        self.hook_time[name] += self.stop()
+
+    def count_value(self, action, mod_value_prediction):
+        if mod_value_prediction and getattr(action, "mod", None) is not None:
+            self.value_calls["mod_prediction"] += 1
+        else:
+            self.value_calls["direct"] += 1
+
+    def decision(self, available):
+        self.available_sizes[available] += 1
+
+    def skip(self, ticks):
+        self.ticks_skipped += ticks
+
+    def to_dict(self):
+        decisions = sum(self.available_sizes.values())
+
+        return {
+            "hooks": dict(
+                (name, {"calls": self.hook_calls[name], "seconds": self.hook_time[name]})
+                for name in self.hook_calls
+            ),
+            "value_calls": dict(self.value_calls),
+            "decisions": decisions,
+            "available_sizes": dict((str(k), v) for k, v in sorted(self.available_sizes.items())),
+            "average_available": sum(k * v for k, v in self.available_sizes.items()) / float(decisions)
+                if decisions else 0.0,
+            "ticks_skipped": self.ticks_skipped,
+            "sections": dict(self.section_time),
+        }
+
+    def to_json(self, f=None):
+        # JSON string, or written to f (a path or file object) if given
+        if f is None:
+            return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+        if isinstance(f, str):
+            with open(f, "w") as out:
+                json.dump(self.to_dict(), out, indent=2, sort_keys=True)
+        else:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def collapsed_stacks(self):
+        # "a;b;c <microseconds>" lines (flamegraph.pl/speedscope format),
+        # each section's own time without the sections inside it
+        lines = []
+
+        for path, elapsed in sorted(self.section_time.items()):
+            depth = path.count(";") + 1
+            children = sum(
+                t for p, t in self.section_time.items()
+                if p.startswith(path + ";") and p.count(";") == depth
+            )
+            lines.append("{0} {1}".format(path, max(0, int(round((elapsed - children) * 1e6)))))
+
+        return lines
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for line in self.collapsed_stacks():
+                f.write(line + "\n")
+
+
+class ActionRegistry(list):
+    # The action list of a PState, with an O(1) name -> index lookup (used by
+    # Action.find_by_name) and the buddy action links resolved up front.
+    # Behaves like a normal list, any change to it keeps the index in sync.
+    # Toggling enabled doesn't change names/indices, so it needs nothing here.
+    def __init__(self, actions=()):
+        super(ActionRegistry, self).__init__(actions)
+        self.reindex()
+
+    def reindex(self):
+        self.names = {}
+        for i in range(0, len(self)):
+            self.names.setdefault(self[i].name, i)
+        self.resolve_buddies()
+        self.shared = False
+
+    def resolve_buddies(self):
+        # waiting: buddy name that isn't on the bar -> indexes naming it
+        self.buddies = {}
+        self.waiting = {}
+        for i in range(0, len(self)):
+            self.resolve_buddy(i)
+
+    def resolve_buddy(self, i):
+        names = getattr(self[i], "buddy_actions", None) or []
+        self.buddies[i] = [self.names[n] for n in names if n in self.names]
+        for n in names:
+            if n not in self.names and i not in self.waiting.setdefault(n, []):
+                self.waiting[n].append(i)
+
+    def find(self, name):
+        return self.names.get(name)
+
+    def buddies_of(self, action):
+        i = self.find(action.name)
+        return [] if i is None else self.buddies[i]
+
+    def branch(self, actions):
+        # Same names in the same order, so the indexes are shared (every
+        # change below replaces them instead of changing them in place)
+        registry = list.__new__(ActionRegistry)
+        list.__init__(registry, actions)
+        registry.names = self.names
+        registry.buddies = self.buddies
+        registry.waiting = self.waiting
+        registry.shared = self.shared = True
+        return registry
+
+    def append(self, action):
+        # Updates the index in place (after copying it if it's shared with
+        # a branch), so building a registry one action at a time is O(n)
+        super(ActionRegistry, self).append(action)
+        if self.shared:
+            self.names = dict(self.names)
+            self.buddies = dict(self.buddies)
+            self.waiting = dict((n, list(w)) for n, w in self.waiting.items())
+            self.shared = False
+
+        i = len(self) - 1
+        # New action could be a buddy of (or have) existing ones
+        if action.name not in self.names:
+            self.names[action.name] = i
+            for j in self.waiting.pop(action.name, []):
+                self.resolve_buddy(j)
+        self.resolve_buddy(i)
+
+    def __reduce_ex__(self, protocol):
+        return (ActionRegistry, (list(self),))
+
+    # Everything else that changes the list just rebuilds the index
+    def extend(self, actions):
+        super(ActionRegistry, self).extend(actions)
+        self.reindex()
+
+    def __iadd__(self, actions):
+        self.extend(actions)
+        return self
+
+    def __imul__(self, n):
+        super(ActionRegistry, self).__imul__(n)
+        self.reindex()
+        return self
+
+    def insert(self, i, action):
+        super(ActionRegistry, self).insert(i, action)
+        self.reindex()
+
+    def remove(self, action):
+        super(ActionRegistry, self).remove(action)
+        self.reindex()
+
+    def pop(self, i=-1):
+        action = super(ActionRegistry, self).pop(i)
+        self.reindex()
+        return action
+
+    def clear(self):
+        super(ActionRegistry, self).clear()
+        self.reindex()
+
+    def sort(self, *args, **kwargs):
+        super(ActionRegistry, self).sort(*args, **kwargs)
+        self.reindex()
+
+    def reverse(self):
+        super(ActionRegistry, self).reverse()
+        self.reindex()
+
+    def __setitem__(self, i, action):
+        super(ActionRegistry, self).__setitem__(i, action)
+        self.reindex()
+
+    def __delitem__(self, i):
+        super(ActionRegistry, self).__delitem__(i)
+        self.reindex()
+
             
 # Idea: Look at PState value based on total
 #   number of choices + total value of choices
 #   and use this number to improve heuristic
 class PState:
-    def __init__(self, actions, adrenaline=0, use_prng=False, use_ringofvigour=False, use_ASR=False):
+    # Keep a ReadySet instead of scanning the bar for available actions
+    track_ready = True
+    
+    def __init__(self, actions, adrenaline=0, use_prng=False, use_ringofvigour=False, use_ASR=False,
+        use_value_cache=True, seed=None):
         self.adrenaline = adrenaline
         self.excess_adrenaline = 0
         self.spent_adrenaline = 0
         self.gained_adrenaline = 0
-        self.actions = actions
+        # Our own copies of the actions' run state (the definitions are
+        # shared), so any number of pstates can use the same action list
+        if isinstance(actions, ActionRegistry):
+            self.actions = actions
+        else:
+            self.actions = ActionRegistry([copy.copy(a) for a in actions])
         self.use_prng = use_prng
         self.active_mods = []
         self.use_ringofvigour = use_ringofvigour
         self.use_ASR = use_ASR
         
+        # All damage rolls and ASR procs come from here when use_prng
+        # is on, pass a seed to make runs reproducible
+        self.seed(seed)
+        
+        # Total ticks this pstate has been advanced by, used as the clock
+        # for the event queue
+        self.elapsed_ticks = 0
+        
+        # Undo log while a snapshot is open (see snapshot/restore) and
+        # the expired mod instances waiting to be re-used
+        self.journal = None
+        self.mod_pool = {}
+        
+        # Counters/timers, only when enabled (see enable_instrumentation)
+        self.instruments = None
+        
         # Track all changes that need to occur
         # on activation of an ability
-        self.on_activate = [
-            adjust_adrenaline,
-            apply_mods,
-            update_buddies,
-            register_action_value,
-        ]
+        self.on_activate = list(default_on_activate)
+        
+        # Memoized value lookups (see ValueCache), hit/miss counts
+        # are available on value_cache.hits and value_cache.misses
+        self.value_cache = ValueCache(self) if use_value_cache else None
+        
+        # Actions off cooldown (see ReadySet)
+        self.ready_set = ReadySet(self) if self.track_ready else None
+
+    def seed(self, seed=None):
+        # rng_seed is kept for ResultCache keys
+        self.rng_seed = seed
+        self.rng = random.Random(seed)
+
+    # Snapshots record an undo entry for every field that changes from here
+    # on, restore(token) rolls back to the snapshot in O(changed fields).
+    # Snapshots nest (restore to an older token also undoes newer ones).
+    # Random rolls are not rewound. on_activate functions that change the
+    # pstate themselves should call pstate.remember first.
+    def snapshot(self):
+        if self.journal is None:
+            self.journal = Journal()
+
+        return len(self.journal)
+
+    def restore(self, token):
+        self.journal.rollback(token)
+
+    def release(self):
+        # Stop journaling, every open snapshot is dropped
+        self.journal = None
+
+    def remember(self, obj, *attrs):
+        if self.journal is not None:
+            self.journal.remember(obj, *attrs)
+
+    def acquire_mod(self, mod):
+        # Fresh instance of a mod (from the pool when one has expired)
+        # in place of a deepcopy on every cast
+        pool = self.mod_pool.get(mod.name)
+        
+        if not pool:
+            return Modifier.new(mod.definition)
+            
+        instance = pool.pop()
+        instance.definition = mod.definition
+        instance.reset()
+        return instance
+
+    def release_mod(self, mod):
+        # A snapshot could still bring the mod back, so only
+        # recycle it when nothing is journaled
+        if self.journal is None:
+            self.mod_pool.setdefault(mod.name, []).append(mod)
+
+    def update_definitions(self):
+        # Call after replacing action/mod definitions on a live pstate
+        # (parameter setters, a new mod) or changing timers/the bar order
+        # outside of tick/activate, the value cache tables and the ready set
+        # are built from them. Not undone by restore.
+        if self.value_cache is not None:
+            self.value_cache.rebuild()
+
+        if self.ready_set is not None:
+            self.ready_set.rebuild()
+
+    def add_action(self, action):
+        # Add an action to the bar mid run, keeping the registry, value
+        # cache and ready set in sync with it
+        self.actions.append(action)
+        i = len(self.actions) - 1
+
+        if self.value_cache is not None:
+            self.value_cache.add_action(i)
+
+        if self.ready_set is not None:
+            self.ready_set.add_action(i)
+
+        return i
+
+    def enable_instrumentation(self, instruments=None):
+        # Start recording hook/value/decision stats, branches share the
+        # same Instrumentation so searches are counted as a whole
+        if self.instruments is None:
+            self.instruments = Instrumentation() if instruments is None else instruments
+            
+        return self.instruments
+        
+    def branch(self):
+        # Cheap copy of the pstate for searching over rotations. Actions and
+        # mods are shallow copied so only their counters/timers are new, the
+        # definitions (mod, pstate_check, buddy_actions) stay shared.
+        other = copy.copy(self)
+        other.actions = self.actions.branch([copy.copy(a) for a in self.actions])
+        other.active_mods = [copy.copy(m) for m in self.active_mods]
+        other.on_activate = list(self.on_activate)
+        other.journal = None
+        other.mod_pool = {}
+        
+        if self.value_cache is not None:
+            other.value_cache = self.value_cache.branch(other)
+            
+        if self.ready_set is not None:
+            other.ready_set = self.ready_set.branch(other)
+            
+        return other
+        
+    def signature(self):
+        # Everything that decides what happens next (cooldowns, adrenaline
+        # and active mods), two pstates with the same signature will play
+        # out the same from here on
+        return (
+            self.adrenaline,
+            tuple(max(0, a.time_remaining) for a in self.actions),
+            tuple((m.name, m.last_used) for m in self.active_mods if m.is_active),
+        )
                 
     # Normalized Average/Best value used for computing
     # modifier values (average = duration, best = one_time_use)
@@ -96,7 +1078,8 @@ class PState:
         values = []
         
         # Create a fake pstate that has maximum possible adrenaline gain
-        adrenaline_pstate = PState(actions=[], adrenaline=int(self.adrenaline + ((ticks - 3) / 3.0) * 8))
+        adrenaline_pstate = PState(actions=[], adrenaline=int(self.adrenaline + ((ticks - 3) / 3.0) * 8),
+            use_value_cache=False)
         
         for a in self.actions:
             # Check if we have a filter function that will check if we want
@@ -137,24 +1120,62 @@ class PState:
                 if current_best_val < val:
                     current_best_val = val
 
-        return current_best_action
+        return current_best_val
 
     def tick(self, ticks=3):
-        for a in self.actions:
-            a.tick(ticks)
+        if self.journal is not None:
+            self.journal.undo(self.untick, ticks, self.active_mods)
+            for m in self.active_mods:
+                self.journal.remember(m, "is_active")
+            self.journal.remember(self, "active_mods")
+        
+        self.tick_actions(ticks)
             
         for m in self.active_mods:
             m.tick(ticks)
         
+        self.elapsed_ticks += ticks
+        
+        if self.ready_set is not None:
+            self.ready_set.update_tick()
+        
         # Filter out all of the mods that are inactive at this point
-        # TODO: Check if this is the appropriate way to "remove" items
-        #   created by us from a list or if this is a memory problem
-        self.active_mods = [m for m in self.active_mods if m.is_active]
+        # (and hand them back to the pool)
+        active_mods = [m for m in self.active_mods if m.is_active]
+        mods_expired = len(active_mods) != len(self.active_mods)
+        
+        if mods_expired:
+            for m in self.active_mods:
+                if not m.is_active:
+                    self.release_mod(m)
+                    
+        self.active_mods = active_mods
+        
+        if self.value_cache is not None:
+            self.value_cache.update_tick()
+            
+            if mods_expired:
+                self.value_cache.update_mods()
+
+    def tick_actions(self, ticks):
+        for a in self.actions:
+            a.tick(ticks)
+
+    def untick(self, ticks, mods):
+        # Undo for tick (is_active and the mod list are journaled separately)
+        self.tick_actions(-ticks)
+        
+        for m in mods:
+            m.last_used -= ticks
+            
+        self.elapsed_ticks -= ticks
 
     def activate(self, name=None):
         # If the "None" action is activated, we will perform 1 tick
         # to progress the cooldowns of all of our abilities
         if name == None:
+            if self.instruments is not None:
+                self.instruments.skip(1)
             self.tick(1)
             return None
     
@@ -167,18 +1188,41 @@ class PState:
 
         action = self.actions[action_i]
             
+        instruments = self.instruments
+        if instruments is not None:
+            instruments.start("activate")
+            
         # Trigger activate for the action
+        self.remember(action, "last_used", "times_used")
         action.activate()
+        
+        if self.value_cache is not None:
+            self.value_cache.update_action(action_i)
+
+        if self.ready_set is not None:
+            self.ready_set.update_action(action_i)
 
         # Triggar all functions required on_activate
         for f in self.on_activate:
+            if instruments is not None:
+                hook = instruments.start_hook(f)
+
             try:
                 f(self, action)
             except Exception as e:
                 print("Error: {0}".format(e))
+
+            if instruments is not None:
+                instruments.stop_hook(hook)
             
         # Perform a tick appropriate for the actions execution duration
-        self.tick(action.ticks)
+        if instruments is not None:
+            instruments.start("tick")
+            self.tick(action.ticks)
+            instruments.stop()
+            instruments.stop()
+        else:
+            self.tick(action.ticks)
 
     def get_most_value(self):
         most_value = 0
@@ -208,8 +1252,12 @@ class PState:
         greedy_action = None        
         current_best_val = 0
         current_best_action = None
+        available = self.get_available_actions()
+        
+        if self.instruments is not None:
+            self.instruments.decision(len(available))
         
-        for a in self.get_available_actions():
+        for a in available:
             val = self.value(a)
             
             # Update if we have no action, new one is better, or new one
@@ -225,49 +1273,78 @@ class PState:
     def value(self, action, mod_value_prediction=True):
         if action is None:
             return 0
+        
+        cache = self.value_cache
+        instruments = self.instruments
+        
+        if instruments is not None:
+            instruments.count_value(action, mod_value_prediction)
     
-        base_value = action.value(prng=self.use_prng)
+        base_value = self.base_value(action) if cache is None else cache.base_value(action)
+            
+        # Perform predictable increase in value from
+        # a mod applying to future actions
+        if action.definition.mod is not None and mod_value_prediction:
+            if instruments is not None:
+                instruments.start("mod_prediction")
+                
+            if cache is None:
+                base_value += self.mod_value_increase(action)
+            else:
+                base_value += cache.mod_value_increase(action)
+                
+            if instruments is not None:
+                instruments.stop()
+            
+        return base_value
+        
+    def base_value(self, action):
+        base_value = action.value(prng=self.use_prng, rng=self.rng)
         
         # For modable actions, apply all active mods to our value
         if action.modable:
             for m in self.active_mods:
                 if m.is_active:
                     base_value = m.apply_mod(base_value)
+                    
+        return base_value
+        
+    def mod_value_increase(self, action):
+        # We will use this filter to make sure we only apply out normalization
+        # calculations for modable actions since others wouldn't get adding
+        # any value to our current action
+        modable_filter = lambda a : getattr(a, "modable", False)
+        value_increase = lambda v,m : v - (v / (1 + m))
+    
+        if action.mod.one_time_use:
+            # This gets the value of our next best usable action for one_time_use mods
+            next_action_value = self.normalized_best_value(ticks=action.ticks, mod=action.mod, filter=modable_filter)
+            # Compute the "increase" in value that our mod is adding and make that value
+            # become added to our mod (makes actions with modifiers worth more as they should)
+            increase = value_increase(next_action_value, action.mod.multiplier)
+        else:
+            # Here we are computing mods that have duration
+            average_tick_value = self.normalized_average_value(
+                ticks=action.mod.duration, mod=action.mod, filter=modable_filter
+            )
+            # We can get the total value added by this action's modifier by finding an approximate
+            # value per tick added by the modifier and then multiplying by the number of ticks (duration)
+            increase = value_increase(average_tick_value, action.mod.multiplier) * action.mod.duration
             
-        # Perform predictable increase in value from
-        # a mod applying to future actions
-        if getattr(action, "mod", None) is not None and mod_value_prediction:
-            # We will use this filter to make sure we only apply out normalization
-            # calculations for modable actions since others wouldn't get adding
-            # any value to our current action
-            modable_filter = lambda a : getattr(a, "modable", False)
-            value_increase = lambda v,m : v - (v / (1 + m))
-        
-            if action.mod.one_time_use:
-                # This gets the value of our next best usable action for one_time_use mods
-                next_action_value = self.normalized_best_value(ticks=action.ticks, mod=action.mod, filter=modable_filter)
-                # Compute the "increase" in value that our mod is adding and make that value
-                # become added to our mod (makes actions with modifiers worth more as they should)
-                increase = value_increase(next_action_value, action.mod.multiplier)
-            else:
-                # Here we are computing mods that have duration
-                average_tick_value = self.normalized_average_value(
-                    ticks=action.mod.duration, mod=action.mod, filter=modable_filter
-                )
-                # We can get the total value added by this action's modifier by finding an approximate
-                # value per tick added by the modifier and then multiplying by the number of ticks (duration)
-                increase = value_increase(average_tick_value, action.mod.multiplier) * action.mod.duration
-            
-            base_value += increase
-            
-        return base_value
+        return increase
        
     def get_available_actions(self):
         # If there is an available action that we MUST use, we will look at
         # all of these as our set of "available" actions
+        if self.ready_set is not None:
+            return self.ready_set.available()
+            
+        # Every distinct pstate_check only runs once per call
+        results = {}
+        
         always_use_actions = [
             a for a in self.actions
-            if a.always_use == True and a.is_ready() and self.check_pstate(a)
+            if a.always_use == True and a.is_ready() and self.check_pstate(a, results)
         ]
         
         if len(always_use_actions) > 0:
@@ -276,18 +1353,91 @@ class PState:
         actions = []
             
         for a in self.actions:
-            if a.is_ready() and self.check_pstate(a):
+            if a.is_ready() and self.check_pstate(a, results):
                 actions.append(a)
                 
         return actions
         
-    def check_pstate(self, action):
-        if not inspect.isfunction(action.pstate_check):
+    def check_pstate(self, action, results=None):
+        # results (optional) memoizes each check's result for this pstate,
+        # only valid until the pstate changes
+        check = action.pstate_check
+        
+        if type(check) is not Condition and not inspect.isfunction(check):
             return True
+            
+        if results is not None and check in results:
+            result = results[check]
+        else:
+            result = check.test(self) if type(check) is Condition else check(self)
+            if results is not None:
+                results[check] = result
 
-        return action.pstate_check(self) ^ action.negative_pstate_check
+        return result ^ action.negative_pstate_check
 
-class Duration:
+class Definition(object):
+    # Immutable part of an action/modifier, shared (never copied) by every
+    # PState and branch that uses it. Changing a field goes through
+    # replace(), which makes a new definition.
+    __slots__ = ()
+    FIELDS = ()
+    
+    def __init__(self, **fields):
+        for field in type(self).FIELDS:
+            object.__setattr__(self, field, fields.get(field))
+            
+    def __setattr__(self, name, value):
+        raise AttributeError("{0} is immutable, use replace()".format(type(self).__name__))
+        
+    def fields(self):
+        return dict((field, getattr(self, field)) for field in type(self).FIELDS)
+        
+    def replace(self, **changes):
+        fields = self.fields()
+        fields.update(changes)
+        return type(self)(**fields)
+        
+    def __copy__(self):
+        return self
+        
+    def __deepcopy__(self, memo):
+        return self
+        
+    def __reduce__(self):
+        return (rebuild_definition, (type(self), self.fields()))
+        
+def rebuild_definition(cls, fields):
+    return cls(**fields)
+    
+class ActionDefinition(Definition):
+    FIELDS = (
+        "name", "buddy_actions", "min", "max", "cooldown", "ticks", "pstate_check", "negative_pstate_check",
+        "mod", "modable", "adrenaline_change", "accuracy_mod", "number_of_hits", "always_use", "enabled",
+        "equipment",
+    )
+    __slots__ = FIELDS
+    
+class ModifierDefinition(Definition):
+    FIELDS = ("name", "multiplier", "duration", "one_time_use", "is_unqiue")
+    __slots__ = FIELDS
+    
+def definition_properties(cls, fields):
+    # Definition fields read through to self.definition, setting one gives
+    # just this instance a changed copy of the definition
+    def field_property(field):
+        def set_field(self, value):
+            self.definition = self.definition.replace(**{field: value})
+        return property(operator.attrgetter("definition." + field), set_field)
+        
+    for field in fields:
+        setattr(cls, field, field_property(field))
+        
+        
+# Run state only (the timers/counters), the rest of an Ability/Modifier is
+# its shared definition
+class Duration(object):
+    __slots__ = ("last_used", "times_used")
+    
     def __init__(self, last_used=0):
         self.last_used = last_used
         self.times_used = 0
@@ -304,13 +1454,20 @@ class Duration:
 
         
 class Modifier(Duration):
+    __slots__ = ("definition", "is_active")
+    
     def __init__(self, name, multiplier, duration=None, one_time_use=False, is_unqiue=True):
-        self.name = name
-        self.multiplier = multiplier
-        self.duration = duration
-        self.one_time_use = one_time_use
+        self.definition = ModifierDefinition(name=name, multiplier=multiplier, duration=duration,
+            one_time_use=one_time_use, is_unqiue=is_unqiue)
         self.is_active = True
-        self.is_unqiue = is_unqiue
+    
+    @staticmethod
+    def new(definition):
+        # Fresh (active) instance of a definition
+        mod = Modifier.__new__(Modifier)
+        mod.definition = definition
+        mod.reset()
+        return mod
     
     # Activate shouldn't reset the ability since this is a 
     # modifier, it is duration based and will persist (usage
@@ -328,83 +1485,108 @@ class Modifier(Duration):
         return self.apply_mod(value)
 
     def tick(self, ticks=3):
-        super(Modifier, self).tick(ticks)
+        self.last_used += ticks
         
         # When we tick, check if we need to deactivate this mod
-        if self.is_active and (self.last_used >= self.duration):
+        if self.is_active and (self.last_used >= self.definition.duration):
             self.is_active = False
         
     # This function is ignorant to the state of the modifier
     # Only activate and reset will adjust its state
     def apply_mod(self, value):
-        return value + (value * self.multiplier)
+        return value + (value * self.definition.multiplier)
         
     def reset(self):
         self.last_used = 0
         self.is_active = True
         
+    def to_definition(self):
+        return self.definition.fields()
+        
+definition_properties(Modifier, ModifierDefinition.FIELDS)
+        
  
 class Ability(Duration):
+    __slots__ = ("definition", "enabled", "total_used_value")
+    
     def __init__(self, min=None, max=None, cooldown=None, ticks=3, \
         pstate_check=None, negative_pstate_check=False, mod=None, modable=True, \
         adrenaline_change=8, accuracy_mod=0, number_of_hits=1, \
-        always_use=False, enabled=True, equipment=None):
-        
-        self.min = float(min if min else (.20 * max))
-        self.max = max if max is None else float(max)
-        self.ticks = ticks
-        self.pstate_check = pstate_check
-        self.negative_pstate_check = negative_pstate_check
-        self.cooldown = float(cooldown)
-        self.mod = mod
-        self.modable = modable
-        self.adrenaline_change = adrenaline_change
-        self.accuracy_mod = accuracy_mod
-        self.number_of_hits = number_of_hits
-        
-        self.always_use = always_use
-        self.enabled = enabled
+        always_use=False, enabled=True, equipment=None, name=None, buddy_actions=None):
         
-        # 2H, DW, Shield
-        self.equipment = equipment
+        # equipment is 2H, DW or Shield
+        self.definition = ActionDefinition(
+            name=name,
+            buddy_actions=None if buddy_actions is None else tuple(buddy_actions),
+            min=float(min if min else (.20 * max)),
+            max=max if max is None else float(max),
+            cooldown=float(cooldown),
+            ticks=ticks,
+            pstate_check=pstate_check,
+            negative_pstate_check=negative_pstate_check,
+            mod=mod,
+            modable=modable,
+            adrenaline_change=adrenaline_change,
+            accuracy_mod=accuracy_mod,
+            number_of_hits=number_of_hits,
+            always_use=always_use,
+            enabled=enabled,
+            equipment=equipment,
+        )
         
+        self.enabled = enabled
         self.total_used_value = 0
         
         super(Ability, self).__init__(last_used=cooldown)
+        
+    @classmethod
+    def new(cls, definition):
+        # Fresh run state for a definition (off cooldown, unused)
+        ability = cls.__new__(cls)
+        ability.definition = definition
+        ability.enabled = definition.enabled
+        ability.total_used_value = 0
+        ability.last_used = definition.cooldown
+        ability.times_used = 0
+        return ability
 
     # Can use pseudo-random numbers to simulate
     # real min/max instead of averaging
-    def value(self, prng=False, normalize=True):
+    def value(self, prng=False, normalize=True, rng=None):
         # 1. Average min/max or use PRNG
         # 2. Adjust by accuracy_mod
         # 3. Normalize by ticks if requested
         # 4. Multiple by total number of hits
+        definition = self.definition
+        
         if prng:
-            random.seed()
-            val = random.uniform(self.min, self.max)
+            val = (random if rng is None else rng).uniform(definition.min, definition.max)
         else:
-            val = (self.min + self.max) / 2.0
+            val = (definition.min + definition.max) / 2.0
             
-        val += val * self.accuracy_mod
+        val += val * definition.accuracy_mod
 
         if normalize:
-            val = val / self.ticks
+            val = val / definition.ticks
             
-        return val * self.number_of_hits
+        return val * definition.number_of_hits
        
     @property
     def time_remaining(self):
-        return self.cooldown - self.last_used
+        return self.definition.cooldown - self.last_used
        
     def is_ready(self):
-        return self.last_used >= self.cooldown and self.enabled
+        return self.last_used >= self.definition.cooldown and self.enabled
+        
+# enabled is run state (toggled per run), the definition only has its default
+definition_properties(Ability, [field for field in ActionDefinition.FIELDS if field != "enabled"])
         
         
 class Action(Ability):
+    __slots__ = ()
+    
     def __init__(self, name, buddy_actions=None, *args, **kwargs):
-        self.name = name
-        self.buddy_actions = buddy_actions
-        super(Action, self).__init__(*args, **kwargs)
+        super(Action, self).__init__(*args, name=name, buddy_actions=buddy_actions, **kwargs)
         
     def __repr__(self):
         return "{0} ({1})".format(self.name, self.ticks)
@@ -412,8 +1594,63 @@ class Action(Ability):
     def shares_cooldown(self):
         return self.buddy_actions is not None and len(self.buddy_actions) > 0
         
+    # Compact, picklable/JSON friendly definition of this action (no run
+    # state). Condition pstate_checks are stored as their source, python
+    # functions by the name they were registered under (see
+    # register_pstate_check) so they can be looked up again in another
+    # process.
+    def to_definition(self):
+        definition = {
+            "name": self.name,
+            "buddy_actions": None if self.buddy_actions is None else list(self.buddy_actions),
+            "min": self.min,
+            "max": self.max,
+            "cooldown": self.cooldown,
+            "ticks": self.ticks,
+            "pstate_check": None,
+            "negative_pstate_check": self.negative_pstate_check,
+            "mod": None,
+            "modable": self.modable,
+            "adrenaline_change": self.adrenaline_change,
+            "accuracy_mod": self.accuracy_mod,
+            "number_of_hits": self.number_of_hits,
+            "always_use": self.always_use,
+            "enabled": self.enabled,
+            "equipment": self.equipment,
+        }
+        
+        if type(self.pstate_check) is Condition:
+            definition["pstate_check"] = self.pstate_check.source
+        elif self.pstate_check is not None:
+            definition["pstate_check"] = self.pstate_check.__name__
+            
+        if type(self.mod) == Modifier:
+            definition["mod"] = self.mod.to_definition()
+            
+        return definition
+        
+    @staticmethod
+    def from_definition(definition):
+        definition = dict(definition)
+        
+        if definition.get("pstate_check") is not None:
+            check = pstate_checks.get(definition["pstate_check"])
+            if check is None:
+                # Not a registered check, so it has to be a condition
+                # (ValueError if it isn't one)
+                check = Condition(definition["pstate_check"])
+            definition["pstate_check"] = check
+            
+        if definition.get("mod") is not None:
+            definition["mod"] = Modifier(**definition["mod"])
+            
+        return Action(**definition)
+        
     @staticmethod
     def find_by_name(name, action_list):
+        if isinstance(action_list, ActionRegistry):
+            return action_list.find(name)
+            
         for i in range(0, len(action_list)):
             if action_list[i].name == name:
                 return i
@@ -421,218 +1658,4148 @@ class Action(Ability):
         return None
 
 
-def pstate_threshold(pstate):
-    return pstate.adrenaline >= 50
+class ArrayAction(Action):
+    # Copy of an Action whose cooldown timer and enabled flag live in the
+    # arrays of an ArrayPState, so the Action API (is_ready, time_remaining,
+    # pstate_checks, on_activate functions) and the arrays always agree
+    __slots__ = ("array_pstate", "index")
+    
+    def __init__(self, action, pstate, index):
+        self.definition = action.definition
+        self.times_used = action.times_used
+        self.total_used_value = action.total_used_value
+        self.array_pstate = pstate
+        self.index = index
 
+    @property
+    def last_used(self):
+        return float(self.array_pstate.last_used[self.index])
 
-def pstate_threshold_melee(pstate):
-    i = Action.find_by_name("Bersker", pstate.actions)
-   
-    if i is not None and \
-        (pstate.actions[i].is_ready() or \
-        (((pstate.adrenaline - 15) + (pstate.actions[i].time_remaining * (8 / 3.0))) < 100)):
-        return False
+    @last_used.setter
+    def last_used(self, value):
+        self.array_pstate.last_used[self.index] = value
 
-    return pstate.adrenaline >= 50
-    
-    
-def pstate_threshold_range(pstate):
-    i = Action.find_by_name("Death's Swiftness", pstate.actions)
-    
-    # Check if using this threshold is going to make it so we can't
-    # use Death's Swiftness immediately when it's off CD
-    if i is not None and  \
-        (pstate.actions[i].is_ready() or \
-        (((pstate.adrenaline - 15) + (pstate.actions[i].time_remaining * (8 / 3.0))) < 100)):
-        return False
+    @property
+    def enabled(self):
+        return bool(self.array_pstate.enabled[self.index])
 
-    return pstate.adrenaline >= 50
+    @enabled.setter
+    def enabled(self, value):
+        self.array_pstate.enabled[self.index] = value
 
-    
-def pstate_ultimate(pstate):
-    return pstate.adrenaline == 100
 
+class ArrayPState(PState):
+    # PState backed by NumPy arrays (one entry per action) instead of walking
+    # the Action objects. Ticking is one vector add, readiness is a boolean
+    # mask and base values come from one vectorized expression.
+    #
+    # Takes the same Action lists as PState (ie. melee_2h_actions), the
+    # actions are copied into ArrayActions so the list passed in isn't
+    # modified by the simulation. The parameter arrays are copies of the
+    # definitions, after a parameter setter call update_definitions.
+    #
+    # Every decision costs a fixed number of NumPy calls, so it only pays off
+    # on wide bars: slower than PState's ReadySet on the built in bars (about
+    # half the speed at 15 actions), about even at 200 and around twice as
+    # fast at 600 (see the synthetic /array cases in benchmark.py). It's
+    # not a general replacement for PState, only use it for bars of several
+    # hundred actions.
+    # Readiness is already a vectorized mask
+    track_ready = False
 
-def get_total(actions):
-    total = 0
-    
-    for a in actions:
-        total += (a["value"] * a["action"].ticks)
-        
-    return total
-    
-def greedy_value(pstate, ticks):
-    actions = []
-    current_tick = 0
-    
-    while current_tick <= ticks:
-        
-        action = pstate.get_greedy_best()
-        
-        if action is None:
-            pstate.tick(1)
-            current_tick += 1
-            
-        mods = [m.name for m in pstate.active_mods if m.is_active]
-        
-        actions.append({
-            "action": action,
-            "value": pstate.value(action, mod_value_prediction=False),
-            "adrenaline": pstate.adrenaline,
-            "mods": "" if len(mods) == 0 else "[{0}]".format(" | ".join(mods))
-        })
-        
-        pstate.activate(getattr(action, "name", None))
-        current_tick += 1 if action is None else action.ticks
+    def __init__(self, actions, *args, **kwargs):
+        if np is None:
+            raise ImportError("ArrayPState requires numpy")
 
-    return actions
-        
-def to_ticks(sec):
-    return math.ceil(sec / .6)
+        self.last_used = np.array([a.last_used for a in actions], dtype=float)
+        self.enabled = np.array([bool(a.enabled) for a in actions], dtype=bool)
+        self.build_arrays(actions)
 
-deaths_swiftness_mod = Modifier(
-    name="Death's Swiftness",   # Name to reference the modifier by
-    multiplier=.50,             # 50% increase
-    duration=to_ticks(sec=30),  # Lasts for 30 seconds
-    one_time_use=False          # Lasts full duration, not just until next attack
-)
+        actions = ActionRegistry([ArrayAction(actions[i], self, i) for i in range(0, len(actions))])
 
-berserk_mod = Modifier(
-    name="Berserk",
-    multiplier=1.00,
-    duration=to_ticks(sec=20),
-    one_time_use=False
-)
+        super(ArrayPState, self).__init__(actions, *args, **kwargs)
 
-quake_modifier = Modifier(
-    name="Quake",
-    multiplier=.04, # Roughly a 4% dmg increase (5% dmg debuff for 1 minute)
-    duration=to_ticks(sec=60),
-    one_time_use=False,
-    is_unqiue=True
-)
+    def build_arrays(self, actions):
+        # Parameter arrays from the actions' definitions (the run state,
+        # last_used and enabled, is kept as it is)
+        self.cooldown = np.array([a.cooldown for a in actions], dtype=float)
+        self.ticks = np.array([a.ticks for a in actions], dtype=float)
+        self.min = np.array([a.min for a in actions], dtype=float)
+        self.max = np.array([a.max for a in actions], dtype=float)
+        self.accuracy_mod = np.array([a.accuracy_mod for a in actions], dtype=float)
+        self.number_of_hits = np.array([a.number_of_hits for a in actions], dtype=float)
+        self.modable = np.array([bool(a.modable) for a in actions], dtype=bool)
+        self.always_use = np.array([a.always_use == True for a in actions], dtype=bool)
+        self.has_check = np.array([is_pstate_check(a.pstate_check) for a in actions], dtype=bool)
+        self.negative_check = np.array([bool(a.negative_pstate_check) for a in actions], dtype=bool) & self.has_check
 
-range_2h_actions = [
-    Action("Tuska's Wraith", max=110, cooldown=to_ticks(sec=15)),
-    Action("Sacrifice", max=100, cooldown=to_ticks(sec=30)),
-    
-    # TODO: Add real dmg calculations so we can cap the 12k hits
-    Action("Shadow Tendrils", min=66, max=500, cooldown=to_ticks(sec=45),
-        adrenaline_change= -15, pstate_check=pstate_threshold_range, enabled=True),
-    
-    Action("Bombardment", max=219, cooldown=to_ticks(sec=30), 
-        adrenaline_change= -15, pstate_check=pstate_threshold_range),
-    
-    Action("Snipe", min=125.0, max=219.0, cooldown=to_ticks(sec=10), ticks=4),
-    
-    Action("Piercing Shot", max=94, cooldown=to_ticks(sec=3), always_use=True),
-    
-    Action("Binding Shot", max=100.0, cooldown=to_ticks(sec=15)),
-    
-    Action("Snapshot", min=(100+100), max=(210+120), cooldown=to_ticks(sec=20),
-        adrenaline_change= -15, pstate_check=pstate_threshold_range),
-    
-    Action("Dazing Shot", max=157, cooldown=to_ticks(sec=5)),
-    
-    Action("Fragmentation Shot", min=100, max=188, cooldown=to_ticks(sec=15), modable=False),
-    
-    Action("Rapid Fire", max=94, cooldown=to_ticks(sec=20), number_of_hits=8, ticks=7,
-        adrenaline_change= -15, pstate_check=pstate_threshold_range),
-    
-    Action("Corruption Shot", min=19.8, max=60, cooldown=to_ticks(sec=15),
-        number_of_hits=5, modable=False),
-    
-    Action("Death's Swiftness", min=10, max=20, cooldown=to_ticks(sec=60), number_of_hits=15,
-        adrenaline_change= -100, pstate_check=pstate_ultimate, modable=False,
-        mod=deaths_swiftness_mod
-    ),
-]
+        # Index of each action's check in the distinct checks (-1 for none)
+        self.checks = []
+        for a in actions:
+            if is_pstate_check(a.pstate_check) and a.pstate_check not in self.checks:
+                self.checks.append(a.pstate_check)
+        self.check_ids = np.array(
+            [self.checks.index(a.pstate_check) if is_pstate_check(a.pstate_check) else -1 for a in actions],
+            dtype=int
+        )
+        self.has_mod = np.array([getattr(a, "mod", None) is not None for a in actions], dtype=bool)
 
-melee_2h_actions = [
-    Action("Tuska's Wraith", max=110, cooldown=to_ticks(sec=15)),
-    Action("Sacrifice", max=100, cooldown=to_ticks(sec=30)),
+        # Same steps (and order of operations) as Ability.value so the
+        # values match the scalar path exactly
+        self.average_values = self.normalize((self.min + self.max) / 2.0)
 
-    Action("Cleave", max=188, cooldown=to_ticks(sec=7)),
-    
-    # Enable this to test sweaty swaps for decimate
-    Action("Decimate", max=188, cooldown=to_ticks(sec=7), enabled=False
-        always_use=True, pstate_check=pstate_ultimate, negative_pstate_check=True),
+    def update_definitions(self):
+        self.build_arrays(self.actions)
+        super(ArrayPState, self).update_definitions()
+
+    def seed(self, seed=None):
+        super(ArrayPState, self).seed(seed)
+        self.np_rng = np.random.default_rng(seed)
+
+    def normalize(self, values):
+        values = values + values * self.accuracy_mod
+        values = values / self.ticks
+        return values * self.number_of_hits
+
+    def branch(self):
+        other = super(ArrayPState, self).branch()
+        other.last_used = self.last_used.copy()
+        other.enabled = self.enabled.copy()
+
+        for i in range(0, len(other.actions)):
+            other.actions[i].array_pstate = other
+
+        return other
+
+    def tick_actions(self, ticks):
+        self.last_used += ticks
+
+    def ready_mask(self):
+        return (self.last_used >= self.cooldown) & self.enabled
+
+    def check_mask(self, mask, pstate=None):
+        # Each distinct pstate_check is run once and its result spread
+        # over every action that uses it
+        pstate = self if pstate is None else pstate
+        mask = mask.copy()
+        checked = mask & self.has_check
+
+        if checked.any():
+            results = np.array([bool(check(pstate)) for check in self.checks], dtype=bool)
+            mask[checked] = results[self.check_ids[checked]] ^ self.negative_check[checked]
+
+        return mask
+
+    def check_results(self, pstate=None):
+        # Mask of the actions whose pstate_check passes (or that have none),
+        # the index past the last check stands in for "no check"
+        if len(self.checks) == 0:
+            return ~self.negative_check
+
+        pstate = self if pstate is None else pstate
+        results = np.array([bool(check(pstate)) for check in self.checks] + [True], dtype=bool)
+        return results[self.check_ids] ^ self.negative_check
+
+    def base_values(self):
+        # Base values of every action with the active mods applied
+        # to all of the modable ones
+        if self.use_prng:
+            values = self.normalize(self.np_rng.uniform(self.min, self.max))
+        else:
+            values = self.average_values
+
+        for m in self.active_mods:
+            if m.is_active:
+                values = np.where(self.modable, m.apply_mod(values), values)
+
+        return values
+
+    def get_available_indices(self):
+        # Every distinct check is run once per decision, for the always_use
+        # pass and the normal one together
+        available = self.ready_mask()
+        if available.any():
+            available &= self.check_results()
+
+        always_use = available & self.always_use
+        return (always_use if always_use.any() else available).nonzero()[0]
+
+    def get_available_actions(self):
+        return [self.actions[i] for i in self.get_available_indices()]
+
+    def get_greedy_best(self):
+        available = self.get_available_indices()
+
+        if self.instruments is not None:
+            self.instruments.decision(len(available))
+
+        if len(available) == 0:
+            return None
+
+        values = self.base_values()[available]
+
+        for j in np.flatnonzero(self.has_mod[available]):
+            action = self.actions[available[j]]
+            if self.instruments is not None:
+                self.instruments.count_value(action, True)
+                self.instruments.start("mod_prediction")
+            if self.value_cache is None:
+                values[j] += self.mod_value_increase(action)
+            else:
+                values[j] += self.value_cache.mod_value_increase(action)
+            if self.instruments is not None:
+                self.instruments.stop()
+
+        # Best value, ties go to the first action with the lowest cooldown
+        best = available[values == values.max()]
+        return self.actions[best[np.argmin(self.cooldown[best])]]
+
+    # The filter function can't be vectorized, modable_only is the
+    # mask version of the filter used by mod_value_increase
+    def normalized_average_value(self, ticks=3, mod=None, filter=None, modable_only=False):
+        if filter is not None:
+            return super(ArrayPState, self).normalized_average_value(ticks, mod, filter)
+
+        adrenaline_pstate = PState(actions=[], adrenaline=int(self.adrenaline + ((ticks - 3) / 3.0) * 8),
+            use_value_cache=False)
+
+        mask = self.cooldown - self.last_used <= ticks
+        if modable_only:
+            mask &= self.modable
+
+        mask = self.check_mask(mask, adrenaline_pstate)
+        values = self.average_values[mask]
+
+        if mod is not None:
+            values = mod.apply_mod(values)
+
+        # Summed in order (like the scalar path) so rounding matches
+        values = (values / self.ticks[mask]).tolist()
+        return sum(values) / len(values)
+
+    def normalized_best_value(self, ticks=3, mod=None, filter=None, modable_only=False):
+        if filter is not None:
+            return super(ArrayPState, self).normalized_best_value(ticks, mod, filter)
+
+        mask = self.cooldown - self.last_used <= ticks
+        if modable_only:
+            mask &= self.modable
+
+        mask = self.check_mask(mask)
+        values = self.average_values
+
+        if mod is not None:
+            values = np.where(self.modable, mod.apply_mod(values), values)
+
+        values = values[mask] / self.ticks[mask]
+        return max(0, values.max()) if len(values) > 0 else 0
+
+    def mod_value_increase(self, action):
+        # Same as PState.mod_value_increase but using the modable
+        # mask in place of the modable_filter function
+        value_increase = lambda v,m : v - (v / (1 + m))
+
+        if action.mod.one_time_use:
+            next_action_value = self.normalized_best_value(
+                ticks=action.ticks, mod=action.mod, modable_only=True
+            )
+            return value_increase(next_action_value, action.mod.multiplier)
+
+        average_tick_value = self.normalized_average_value(
+            ticks=action.mod.duration, mod=action.mod, modable_only=True
+        )
+        return value_increase(average_tick_value, action.mod.multiplier) * action.mod.duration
+
+
+class Condition(object):
+    # A pstate_check written as an expression instead of a python function,
+    # compiled once into a plain function of the pstate. Conditions are
+    # picklable and stored by their source in action definitions.
+    #
+    #   adrenaline              current adrenaline
+    #   ready("Name")           the action is off cooldown (and enabled)
+    #   cooldown("Name")        ticks until the action is off cooldown
+    #   has("Name")             the action is on the bar
+    #   active("Mod")           the mod is active
+    #
+    # with numbers, + - * /, comparisons, and/or/not and parentheses, e.g.
+    # "adrenaline >= 50 and not (has('Bersker') and cooldown('Bersker') <= 6)"
+    NAMES = {
+        "adrenaline": "adrenaline",
+        "elapsed": "elapsed_ticks",
+    }
     
-    Action("Fury", max=157, cooldown=to_ticks(sec=5)),
+    FUNCTIONS = ["ready", "cooldown", "has", "active"]
     
-    Action("Sever", max=188, cooldown=to_ticks(sec=15)),
+    NODES = (
+        ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+        ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Compare, ast.Eq, ast.NotEq,
+        ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Constant, ast.Name, ast.Load, ast.Call,
+    )
     
-    Action("Slice", min=30, max=120, cooldown=to_ticks(sec=3)),
+    # source -> (compiled function, names used, adrenaline thresholds,
+    # cooldown crossings), shared by every Condition
+    compiled = {}
     
-    Action("Smash", max=125, cooldown=to_ticks(sec=10)),
+    # source -> function over a BatchPState (compiled on first use)
+    compiled_batch = {}
     
-    Action("Hurricane", min=(66+84), max=(219+161), cooldown=to_ticks(sec=20),
-        adrenaline_change= -15, pstate_check=pstate_threshold_melee),
+    def __init__(self, source):
+        self.source = source
+        compiled = Condition.compiled.get(source)
         
-    Action("Bersker", max=0, cooldown=to_ticks(sec=60), adrenaline_change= -100,
-        pstate_check=pstate_ultimate, mod=berserk_mod, modable=False),
+        if compiled is None:
+            compiled = Condition.compiled[source] = Condition.compile(source)
+            
+        # adrenaline_only conditions can be cached by adrenaline (by the band
+        # between thresholds when they are known), conditions that read
+        # elapsed depend on the clock (no steady state) and those that also
+        # read a cooldown can change while idle. When the cooldowns are only
+        # compared linearly (crossings isn't None) EventQueue wakes up where
+        # they cross, otherwise on every tick.
+        self.test, self.names, self.thresholds, self.crossings = compiled
+        self.adrenaline_only = self.names <= set(["adrenaline"])
+        self.reads_clock = "elapsed" in self.names
+        self.reads_timers = self.reads_clock or "cooldown" in self.names
         
-    Action("Dismember", max=188, cooldown=to_ticks(sec=6), modable=False),
-    
-    Action("Assault", max=219, cooldown=to_ticks(sec=30), number_of_hits=4,
-        adrenaline_change= -15, ticks=6, pstate_check=pstate_threshold_melee),
+    def __call__(self, pstate):
+        return self.test(pstate)
         
-    Action("Quake", max=219, cooldown=to_ticks(20), mod=quake_modifier,
-        adrenaline_change= -15, pstate_check=pstate_threshold_melee),
+    def batch(self, pstate):
+        # The check for every scenario of a BatchPState, as a boolean array
+        test = Condition.compiled_batch.get(self.source)
         
-    Action("Slaughter(Still)", min=100, max=250, cooldown=to_ticks(sec=30),
-        adrenaline_change= -15, pstate_check=pstate_threshold_melee,
-        buddy_actions=["Slaughter(Move)"], modable=False),
+        if test is None:
+            test = Condition.compiled_batch[self.source] = Condition.compile(self.source, batch=True)[0]
+            
+        return test(pstate)
         
-    Action("Slaughter(Move)", min=100*3, max=250*3, cooldown=to_ticks(sec=30),
-        adrenaline_change= -15, pstate_check=pstate_threshold_melee,
-        buddy_actions=["Slaughter(Still)"], modable=False, enabled=False),
-]
-
-
-class ActionLoader(object):
-    def __init__(self, action_file):
-        with open(action_file, "r") as f:
-            self.action_data = ast.literal_eval(f.read())
+    def __reduce__(self):
+        return (Condition, (self.source,))
         
-    def get_actions(self, styles=None, filter=None):
-        actions = []
+    def __repr__(self):
+        return "Condition({0!r})".format(self.source)
+        
+    # With batch=True the names are arrays (one entry per scenario) so
+    # and/or/not and chained comparisons become their numpy equivalents
+    @staticmethod
+    def compile(source, batch=False):
+        tree = ast.parse(source.strip(), mode="eval")
+        
+        for node in ast.walk(tree):
+            if not isinstance(node, Condition.NODES):
+                raise ValueError("Unsupported syntax in condition {0!r}: {1}".format(
+                    source, type(node).__name__
+                ))
                 
-        # Iterate over all of our action data
-        for k in self.action_data.keys():
-            # Check if the key is in our keys
-            if styles is None or k in styles:                
-                # Iterate over our actions to check our filter
-                for action in self.action_data[k]:
-                    filter_check = True
-                
-                    # If we have a filter, need to check it over
-                    if filter is not None:
-                        for k in filter.keys():
-                            if k in action and action.get(k, None) != filter[k]:
-                                filter_check = False
-                                break # Filter failed - moving to next action
-                    
-                    if filter_check is False:
-                        continue
+            if isinstance(node, ast.Constant) and type(node.value) not in (int, float, bool, str):
+                raise ValueError("Unsupported value in condition {0!r}: {1!r}".format(source, node.value))
+                
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in Condition.FUNCTIONS or \
+                    len(node.args) != 1 or len(node.keywords) != 0 or \
+                    not isinstance(node.args[0], ast.Constant) or type(node.args[0].value) is not str:
+                    raise ValueError("Unsupported call in condition {0!r}, expected one of {1}(\"Name\")".format(
+                        source, "/".join(Condition.FUNCTIONS)
+                    ))
                     
-                    # Convert our cooldown into ticks
-                    if action.get("cooldown", None) is not None:
-                        action["cooldown"] = to_ticks(sec=action.get("cooldown"))
+        # Every name/function the condition reads
+        names = frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+        thresholds = Condition.adrenaline_thresholds(tree)
+        crossings = None if batch else Condition.cooldown_crossings(tree)
+        
+        # Names become pstate attributes, calls get the pstate passed in
+        # and the whole thing becomes "lambda pstate: bool(...)"
+        prefix = "batch_condition_" if batch else "condition_"
+        
+        class Rewrite(ast.NodeTransformer):
+            def visit_Name(self, node):
+                if node.id in Condition.FUNCTIONS or node.id == "timer_value":
+                    return node
+                if node.id not in Condition.NAMES:
+                    raise ValueError("Unknown name in condition {0!r}: {1}".format(source, node.id))
+                return ast.copy_location(ast.Attribute(
+                    value=ast.Name(id="pstate", ctx=ast.Load()), attr=Condition.NAMES[node.id], ctx=ast.Load()
+                ), node)
+                
+            def visit_Call(self, node):
+                node.func = ast.Name(id=prefix + node.func.id, ctx=ast.Load())
+                node.args = [ast.Name(id="pstate", ctx=ast.Load())] + node.args
+                return node
+                
+        def call(name, args, node):
+            return ast.copy_location(ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[]), node)
+            
+        class BatchRewrite(Rewrite):
+            def visit_BoolOp(self, node):
+                self.generic_visit(node)
+                return call("batch_and" if isinstance(node.op, ast.And) else "batch_or", node.values, node)
+                
+            def visit_UnaryOp(self, node):
+                self.generic_visit(node)
+                return call("batch_not", [node.operand], node) if isinstance(node.op, ast.Not) else node
+                
+            def visit_Compare(self, node):
+                # a < b < c is (a < b) and (b < c)
+                self.generic_visit(node)
+                if len(node.ops) == 1:
+                    return node
                     
-                    # Append the action to our list since it passed the filters
-                    actions.append(Action(**action))
-    
-        return actions
-
-##############################################################
+                operands = [node.left] + node.comparators
+                return call("batch_and", [
+                    ast.Compare(left=operands[i], ops=[node.ops[i]], comparators=[operands[i + 1]])
+                    for i in range(0, len(node.ops))
+                ], node)
+                
+        body = (BatchRewrite() if batch else Rewrite()).visit(tree.body)
+        function = ast.Expression(body=ast.Lambda(
+            args=ast.arguments(posonlyargs=[], args=[ast.arg(arg="pstate")], vararg=None,
+                kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
+            body=ast.Call(func=ast.Name(id="batch_result" if batch else "bool", ctx=ast.Load()),
+                args=([ast.Name(id="pstate", ctx=ast.Load())] if batch else []) + [body], keywords=[])
+        ))
         
-TEST_MODE = False
+        namespace = {"__builtins__": {}, "bool": bool}
+        for name in Condition.FUNCTIONS:
+            namespace[prefix + name] = globals()[prefix + name]
+            
+        if batch:
+            for name in ("batch_and", "batch_or", "batch_not", "batch_result"):
+                namespace[name] = globals()[name]
+            
+        if crossings is not None:
+            crossings = [
+                (name, eval(compile(ast.fix_missing_locations(ast.Expression(body=ast.Lambda(
+                    args=ast.arguments(posonlyargs=[], args=[ast.arg(arg="pstate"), ast.arg(arg="timer_value")],
+                        vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
+                    body=Rewrite().visit(difference)
+                ))), "<condition>", "eval"), namespace))
+                for name, difference in crossings
+            ]
+            
+        return (
+            eval(compile(ast.fix_missing_locations(function), "<condition>", "eval"), namespace),
+            names,
+            thresholds,
+            crossings
+        )
         
-def test():
-    
-    al = ActionLoader("abilities.json")
-    
+    @staticmethod
+    def cooldown_crossings(tree):
+        # While idle adrenaline, mods and readiness (up to the cooldown
+        # events) stay put and every cooldown drops by one a tick, so a
+        # comparison that is linear in a single cooldown can only flip where
+        # it crosses the comparison's other side. Returns (name, left - right
+        # with the cooldown as timer_value) for every such comparison, None
+        # if a cooldown is read any other way.
+        def cooldown_name(node):
+            if isinstance(node, ast.Call) and node.func.id == "cooldown":
+                return node.args[0].value
+            return None
+            
+        def linear(node, name):
+            # node is linear in cooldown(name) (and reads no other cooldown)
+            if cooldown_name(node) is not None:
+                return cooldown_name(node) == name
+            if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+                return linear(node.left, name) and linear(node.right, name)
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+                return linear(node.left, name) and linear(node.right, name) and \
+                    not (reads(node.left) and reads(node.right))
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+                return linear(node.left, name) and not reads(node.right)
+            if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+                return linear(node.operand, name)
+            return not reads(node)
+            
+        def reads(node):
+            return any(cooldown_name(n) is not None for n in ast.walk(node))
+            
+        class Substitute(ast.NodeTransformer):
+            def visit_Call(self, node):
+                if cooldown_name(node) is not None:
+                    return ast.copy_location(ast.Name(id="timer_value", ctx=ast.Load()), node)
+                return node
+                
+        crossings = []
+        covered = set()
+        
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Compare):
+                continue
+                
+            operands = [node.left] + node.comparators
+            for left, right in zip(operands, operands[1:]):
+                timers = set(cooldown_name(n) for n in ast.walk(left) if cooldown_name(n) is not None) | \
+                    set(cooldown_name(n) for n in ast.walk(right) if cooldown_name(n) is not None)
+                    
+                if len(timers) != 1:
+                    continue
+                    
+                name = timers.pop()
+                if not (linear(left, name) and linear(right, name)):
+                    return None
+                    
+                covered.update(id(n) for n in ast.walk(left) if cooldown_name(n) is not None)
+                covered.update(id(n) for n in ast.walk(right) if cooldown_name(n) is not None)
+                crossings.append((name, Substitute().visit(ast.BinOp(
+                    left=copy.deepcopy(left), op=ast.Sub(), right=copy.deepcopy(right)
+                ))))
+                
+        # A cooldown read outside of a comparison (or with another one)
+        if any(cooldown_name(n) is not None and id(n) not in covered for n in ast.walk(tree)):
+            return None
+            
+        return crossings
+        
+    @staticmethod
+    def adrenaline_thresholds(tree):
+        # The numbers adrenaline is compared against when it is only ever
+        # compared directly with numbers (the result can then only change
+        # when adrenaline crosses or lands on one of them), otherwise None
+        thresholds = set()
+        compared = set()
+        
+        def number(node):
+            if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+                value = number(node.operand)
+                return None if value is None else (-value if isinstance(node.op, ast.USub) else value)
+            if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+                return node.value
+            return None
+            
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Compare):
+                continue
+                
+            operands = [node.left] + node.comparators
+            names = [o for o in operands if isinstance(o, ast.Name) and o.id == "adrenaline"]
+            values = [number(o) for o in operands if not isinstance(o, ast.Name) or o.id != "adrenaline"]
+            
+            if len(names) > 0 and None not in values:
+                compared.update(id(o) for o in names)
+                thresholds.update(values)
+                
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id == "adrenaline" and id(node) not in compared:
+                return None
+                
+        return tuple(sorted(thresholds))
+        
+        
+def condition_ready(pstate, name):
+    i = Action.find_by_name(name, pstate.actions)
+    return i is not None and pstate.actions[i].is_ready()
+    
+def condition_cooldown(pstate, name):
+    i = Action.find_by_name(name, pstate.actions)
+    return 0 if i is None else pstate.actions[i].time_remaining
+    
+def condition_has(pstate, name):
+    return Action.find_by_name(name, pstate.actions) is not None
+    
+def condition_active(pstate, name):
+    return any(m.name == name and m.is_active for m in pstate.active_mods)
+    
+# Condition functions for a BatchPState (or BatchAdrenalineView), one
+# result per scenario
+def batch_condition_ready(pstate, name):
+    i = pstate.find(name)
+    if i is None:
+        return np.zeros(pstate.size, dtype=bool)
+    return (pstate.last_used[:, i] >= pstate.cooldown[i]) & pstate.enabled[:, i]
+    
+def batch_condition_cooldown(pstate, name):
+    i = pstate.find(name)
+    return np.zeros(pstate.size) if i is None else pstate.cooldown[i] - pstate.last_used[:, i]
+    
+def batch_condition_has(pstate, name):
+    return np.full(pstate.size, pstate.find(name) is not None)
+    
+def batch_condition_active(pstate, name):
+    j = pstate.find_mod(name)
+    return np.zeros(pstate.size, dtype=bool) if j is None else pstate.mod_active[:, j]
+    
+def batch_and(*values):
+    return functools.reduce(np.logical_and, values)
+    
+def batch_or(*values):
+    return functools.reduce(np.logical_or, values)
+    
+def batch_not(value):
+    return np.logical_not(value)
+    
+def batch_result(pstate, value):
+    return np.broadcast_to(np.asarray(value, dtype=bool), (pstate.size,))
+    
+def is_pstate_check(check):
+    # Conditions and python functions are checks, anything else
+    # (None) means the action has no check
+    return type(check) is Condition or inspect.isfunction(check)
+
+
+pstate_threshold = Condition("adrenaline >= 50")
+
+# Check if using this threshold is going to make it so we can't
+# use Bersker/Death's Swiftness immediately when it's off CD
+pstate_threshold_melee = Condition(
+    "not (has('Bersker') and (ready('Bersker') or "
+    "((adrenaline - 15) + (cooldown('Bersker') * (8 / 3.0))) < 100)) and adrenaline >= 50"
+)
+
+pstate_threshold_range = Condition(
+    "not (has(\"Death's Swiftness\") and (ready(\"Death's Swiftness\") or "
+    "((adrenaline - 15) + (cooldown(\"Death's Swiftness\") * (8 / 3.0))) < 100)) and adrenaline >= 50"
+)
+
+pstate_ultimate = Condition("adrenaline == 100")
+
+# Checks a definition can name instead of spelling out a condition (see
+# Action.from_definition). Python function checks have to be registered
+# with register_pstate_check to survive to_definition/from_definition.
+pstate_checks = {
+    "pstate_threshold": pstate_threshold,
+    "pstate_threshold_melee": pstate_threshold_melee,
+    "pstate_threshold_range": pstate_threshold_range,
+    "pstate_ultimate": pstate_ultimate,
+}
+
+def register_pstate_check(check):
+    # Usable as a decorator on a module level check function
+    pstate_checks[check.__name__] = check
+    return check
+
+
+def get_total(actions):
+    total = 0
+    
+    for a in actions:
+        total += (a["value"] * getattr(a["action"], "ticks", 1))
+        
+    return total
+
+def rotation_summary(pstate, rotation, total_ticks):
+    # Everything main() reports about a finished rotation
+    actions_used = len([a for a in rotation if a["action"] is not None])
+    return pstate_summary(pstate, get_total(rotation), actions_used, total_ticks)
+    
+def pstate_summary(pstate, total_value, actions_used, total_ticks):
+    most_used,uses = pstate.get_most_used()
+    most_value,value = pstate.get_most_value()
+    adrenaline_value = sum([a.total_used_value for a in pstate.actions if a.adrenaline_change < 0])
+    
+    return {
+        "ticks": total_ticks,
+        "damage": total_value,
+        "dpt": total_value / total_ticks,
+        "most_used": (getattr(most_used, "name", None), uses),
+        "most_value": (getattr(most_value, "name", None), (value / total_value) * 100 if total_value else 0),
+        "gained_adrenaline": pstate.gained_adrenaline,
+        "spent_adrenaline": pstate.spent_adrenaline,
+        "excess_adrenaline": pstate.excess_adrenaline,
+        "damage_per_adrenaline": adrenaline_value / pstate.spent_adrenaline if pstate.spent_adrenaline else 0,
+        "actions_used": actions_used,
+        "usage": [(a.name, a.times_used) for a in sorted(pstate.actions, key=lambda a: a.times_used, reverse=True)],
+    }
+    
+def skip_ticks(pstate, events, ticks_left):
+    # Number of idle ticks until the next decision point (next event in
+    # the queue), capped to the ticks we have left to simulate
+    next_tick = events.next_event(pstate.elapsed_ticks)
+    
+    if next_tick is None:
+        return ticks_left
+        
+    return min(next_tick - pstate.elapsed_ticks, ticks_left)
+
+class Step(object):
+    # One step of a streamed rotation. Same fields as a greedy_value record
+    # but the mods string is only built when it's asked for.
+    __slots__ = ("action", "value", "adrenaline", "mod_names")
+    
+    def __init__(self, action, value, adrenaline, mod_names):
+        self.action = action
+        self.value = value
+        self.adrenaline = adrenaline
+        self.mod_names = mod_names
+        
+    @property
+    def ticks(self):
+        return getattr(self.action, "ticks", 1)
+        
+    @property
+    def damage(self):
+        return self.value * self.ticks
+        
+    @property
+    def mods(self):
+        return "" if len(self.mod_names) == 0 else "[{0}]".format(" | ".join(self.mod_names))
+        
+    def to_record(self):
+        return {
+            "action": self.action,
+            "value": self.value,
+            "adrenaline": self.adrenaline,
+            "mods": self.mods
+        }
+        
+        
+class RotationStats(object):
+    # Running totals over a stream of steps, everything rotation_summary
+    # reports without keeping the rotation in memory. Adrenaline totals are
+    # the pstate's own counters since the stats were started.
+    def __init__(self, pstate):
+        self.pstate = pstate
+        self.ticks = 0
+        self.damage = 0
+        self.actions_used = 0
+        self.counts = collections.Counter()
+        self.damages = collections.Counter()
+        self.start = (pstate.gained_adrenaline, pstate.spent_adrenaline, pstate.excess_adrenaline)
+        
+        # Set by steady_state_value (the Cycle that was extrapolated)
+        self.cycle = None
+        
+    def add(self, step):
+        damage = step.damage
+        self.ticks += step.ticks
+        self.damage += damage
+        
+        if step.action is not None:
+            self.actions_used += 1
+            self.counts[step.action.name] += 1
+            self.damages[step.action.name] += damage
+            
+    def stream(self, steps):
+        # Pass the steps through, counting them on the way
+        for step in steps:
+            self.add(step)
+            yield step
+            
+    def consume(self, steps):
+        for step in steps:
+            self.add(step)
+        return self
+        
+    @property
+    def dpt(self):
+        return self.damage / self.ticks if self.ticks else 0
+        
+    @property
+    def gained_adrenaline(self):
+        return self.pstate.gained_adrenaline - self.start[0]
+        
+    @property
+    def spent_adrenaline(self):
+        return self.pstate.spent_adrenaline - self.start[1]
+        
+    @property
+    def excess_adrenaline(self):
+        return self.pstate.excess_adrenaline - self.start[2]
+        
+    def summary(self, total_ticks):
+        return pstate_summary(self.pstate, self.damage, self.actions_used, total_ticks)
+        
+# Generator form of greedy_value, yields a Step for every action (or idle
+# tick) once it has been activated so long runs don't have to keep the
+# rotation around. With event_driven=True, idle stretches (no available
+# actions) jump straight to the next cooldown/modifier expiry instead of
+# ticking one at a time. This produces the same rotation as the tick by
+# tick path, and only pays off on bars with long idle stretches (the
+# built-in bars always have something available, so it's about even there).
+#
+# cycles (a CycleDetector) is checked at every decision point and can skip
+# the rest of the run ahead by whole cycles once the rotation repeats.
+# policy (anything with choose(pstate), e.g. a PriorityPolicy) picks the
+# actions instead of get_greedy_best.
+def greedy_steps(pstate, ticks, event_driven=False, cycles=None, policy=None):
+    current_tick = 0
+    events = None
+    
+    while current_tick <= ticks:
+        
+        if cycles is not None:
+            current_tick += cycles.check(current_tick, ticks)
+        
+        if policy is not None:
+            action = policy.choose(pstate)
+        elif pstate.instruments is not None:
+            pstate.instruments.start("get_greedy_best")
+            action = pstate.get_greedy_best()
+            pstate.instruments.stop()
+        else:
+            action = pstate.get_greedy_best()
+            
+        mods = tuple(m.name for m in pstate.active_mods if m.is_active)
+        
+        if action is None and event_driven:
+            # Nothing changes until the next event, so every idle tick
+            # is the same step (adrenaline/mods are constant until then)
+            if events is None:
+                events = EventQueue.from_pstate(pstate)
+            
+            idle = skip_ticks(pstate, events, ticks - current_tick + 1)
+            step = Step(None, 0, pstate.adrenaline, mods)
+            
+            if pstate.instruments is not None:
+                pstate.instruments.skip(idle)
+            pstate.tick(idle)
+            current_tick += idle
+            
+            for _ in range(0, idle):
+                yield step
+            continue
+        
+        events = None
+        step = Step(action, pstate.value(action, mod_value_prediction=False), pstate.adrenaline, mods)
+        
+        pstate.activate(getattr(action, "name", None))
+        current_tick += 1 if action is None else action.ticks
+        
+        yield step
+
+def greedy_value(pstate, ticks, event_driven=False):
+    return [step.to_record() for step in greedy_steps(pstate, ticks, event_driven)]
+
+class Cycle(object):
+    # Repeating stretch of a rotation, it first starts on tick `start` and
+    # takes `ticks` ticks (`steps` decisions). `repeats` is how many times
+    # it was added on without being simulated.
+    def __init__(self, start, ticks, steps):
+        self.start = start
+        self.ticks = ticks
+        self.steps = steps
+        self.repeats = 0
+        
+    def __repr__(self):
+        return "Cycle(start={0}, ticks={1}, steps={2}, repeats={3})".format(
+            self.start, self.ticks, self.steps, self.repeats
+        )
+        
+class CycleDetector(object):
+    # Finds the point where a greedy run starts repeating itself. At every
+    # decision point the pstate's signature (cooldowns, adrenaline, active
+    # mods) is looked up, the first repeat means everything from there on
+    # is a loop. The next cycle is simulated to measure what one cycle adds
+    # (damage, times_used, total_used_value, adrenaline), after that as
+    # many whole cycles as fit are added to stats/pstate at once and the
+    # run continues with whatever is left.
+    #
+    # pstate.elapsed_ticks doesn't include the skipped cycles. Checks that
+    # read the clock (Conditions using elapsed) turn detection off, plain
+    # python checks are assumed to only depend on the signature (the
+    # signature is compared again after the measured cycle either way).
+    def __init__(self, stats, max_states=100000):
+        self.stats = stats
+        self.pstate = stats.pstate
+        self.max_states = max_states
+        self.decisions = 0
+        self.cycle = None
+        
+        # signature -> (tick, decision), None once detection is done
+        self.seen = {}
+        
+        # Signature and counters at the start of the cycle being measured
+        self.measure_at = None
+        self.key = None
+        self.counters = None
+        
+        if self.pstate.use_prng:
+            raise ValueError("CycleDetector needs use_prng=False")
+        
+        if any(type(a.pstate_check) is Condition and a.pstate_check.reads_clock for a in self.pstate.actions):
+            self.seen = None
+            
+    def check(self, current_tick, ticks):
+        # Number of ticks to skip ahead (0 until the cycle is measured)
+        self.decisions += 1
+        
+        if self.seen is not None:
+            key = self.pstate.signature()
+            first = self.seen.get(key)
+            
+            if first is None:
+                if len(self.seen) < self.max_states:
+                    self.seen[key] = (current_tick, self.decisions)
+                return 0
+                
+            self.cycle = Cycle(first[0], current_tick - first[0], self.decisions - first[1])
+            self.measure_at = current_tick + self.cycle.ticks
+            self.key = key
+            self.counters = self.snapshot()
+            self.seen = None
+            return 0
+            
+        if current_tick != self.measure_at:
+            return 0
+            
+        self.measure_at = None
+        
+        if self.pstate.signature() != self.key:
+            # Didn't repeat after all, simulate the rest normally
+            self.cycle = None
+            return 0
+            
+        repeats = (ticks - current_tick) // self.cycle.ticks
+        self.extrapolate(self.counters, self.snapshot(), repeats)
+        self.cycle.repeats = repeats
+        
+        return repeats * self.cycle.ticks
+        
+    def snapshot(self):
+        stats = self.stats
+        pstate = self.pstate
+        
+        return (
+            stats.ticks, stats.damage, stats.actions_used,
+            collections.Counter(stats.counts), collections.Counter(stats.damages),
+            pstate.gained_adrenaline, pstate.spent_adrenaline, pstate.excess_adrenaline,
+            [(a.times_used, a.total_used_value) for a in pstate.actions],
+        )
+        
+    def extrapolate(self, start, end, repeats):
+        # Add `repeats` more of the cycle measured between the two snapshots
+        stats = self.stats
+        pstate = self.pstate
+        
+        stats.ticks += (end[0] - start[0]) * repeats
+        stats.damage += (end[1] - start[1]) * repeats
+        stats.actions_used += (end[2] - start[2]) * repeats
+        
+        for name in end[3]:
+            stats.counts[name] += (end[3][name] - start[3][name]) * repeats
+            stats.damages[name] += (end[4][name] - start[4][name]) * repeats
+            
+        pstate.gained_adrenaline += (end[5] - start[5]) * repeats
+        pstate.spent_adrenaline += (end[6] - start[6]) * repeats
+        pstate.excess_adrenaline += (end[7] - start[7]) * repeats
+        
+        for a, before, after in zip(pstate.actions, start[8], end[8]):
+            a.times_used += (after[0] - before[0]) * repeats
+            a.total_used_value += (after[1] - before[1]) * repeats
+            
+# greedy_value totals (RotationStats) for long runs, once the rotation
+# settles into a loop the remaining whole cycles are added analytically
+# (see CycleDetector) so the cost stops growing with ticks. stats.cycle is
+# the Cycle found (None if the rotation never repeated). Totals match a
+# full greedy run up to float rounding.
+def steady_state_value(pstate, ticks, event_driven=False, max_states=100000):
+    stats = RotationStats(pstate)
+    cycles = CycleDetector(stats, max_states)
+    
+    stats.consume(greedy_steps(pstate, ticks, event_driven, cycles))
+    stats.cycle = cycles.cycle
+    
+    return stats
+
+# Beam search keeps the best `width` partial rotations that end on each tick
+# (so they are compared after the same amount of time) and expands all of
+# their available actions. Partial rotations are ranked by their damage
+# including the predicted gain from any mods they applied, otherwise Bersker
+# and Death's Swiftness would always be pruned before their mod pays off.
+# Runtime grows linearly with width. The greedy_value rotation is used as
+# the starting best, so the result is never worse than greedy.
+#
+# The best rotation found is replayed on pstate, so pstate and the returned
+# list end up exactly as they would from greedy_value.
+def beam_search_value(pstate, ticks, width=8):
+    # Each beam is (score, damage, pstate, rotation) where the rotation is a
+    # linked list of (action name, previous) to avoid copying it per branch
+    buckets = {0: [(0, 0, pstate.branch(), None)]}
+    current_tick = 0
+    
+    greedy = greedy_value(pstate.branch(), ticks)
+    best = (get_total(greedy), None)
+    
+    for a in greedy:
+        best = (best[0], (getattr(a["action"], "name", None), best[1]))
+    
+    while current_tick <= ticks:
+        beams = buckets.pop(current_tick, None)
+        current_tick += 1
+        
+        if beams is None:
+            continue
+            
+        # Different orders of the same actions often end up in the same
+        # pstate, only keep the best of those so they don't fill the beam
+        unique = {}
+        for beam in beams:
+            key = beam[2].signature()
+            if key not in unique or unique[key][0] < beam[0]:
+                unique[key] = beam
+        
+        beams = heapq.nlargest(width, unique.values(), key=lambda b: b[0])
+        
+        for score, damage, state, rotation in beams:
+            available = state.get_available_actions()
+            
+            if len(available) == 0:
+                available = [None]
+            
+            for i in range(0, len(available)):
+                action = available[i]
+                name = getattr(action, "name", None)
+                action_ticks = getattr(action, "ticks", 1)
+                value = state.value(action, mod_value_prediction=False) * action_ticks
+                predicted = state.value(action) * action_ticks
+                
+                # Re-use the state we are expanding for the last child
+                child = state if i == len(available) - 1 else state.branch()
+                child.activate(name)
+                
+                tick = current_tick - 1 + action_ticks
+                beam = (score + predicted, damage + value, child, (name, rotation))
+                
+                if tick > ticks:
+                    if best[0] < beam[1]:
+                        best = (beam[1], beam[3])
+                else:
+                    buckets.setdefault(tick, []).append(beam)
+    
+    names = []
+    rotation = best[1]
+    
+    while rotation is not None:
+        names.append(rotation[0])
+        rotation = rotation[1]
+        
+    return replay_rotation(pstate, reversed(names))
+
+def replay_rotation(pstate, names):
+    # Activate a list of action names (None for a 1 tick skip) on pstate and
+    # record it in the same format as greedy_value
+    actions = []
+    
+    for name in names:
+        i = None if name is None else Action.find_by_name(name, pstate.actions)
+        action = None if i is None else pstate.actions[i]
+        mods = [m.name for m in pstate.active_mods if m.is_active]
+        
+        actions.append({
+            "action": action,
+            "value": pstate.value(action, mod_value_prediction=False),
+            "adrenaline": pstate.adrenaline,
+            "mods": "" if len(mods) == 0 else "[{0}]".format(" | ".join(mods))
+        })
+        
+        pstate.activate(name)
+        
+    return actions
+
+# Scores many candidate rotations (lists of action names, None for a 1 tick
+# skip, or greedy_value records) from the same starting pstate. Candidates
+# are put in a prefix trie and every shared prefix is only simulated once,
+# sibling branches roll back to it with snapshot/restore. pstate itself is
+# left untouched.
+#
+# Returns a dict per candidate (in order) with its damage, ticks and the
+# adrenaline gained/spent/wasted. A candidate is invalid from the first step
+# that is an unknown action, on cooldown (or disabled) or fails its
+# pstate_check, its totals are the ones up to that step. With use_prng the
+# rolls come from one rng across all candidates (not rewound).
+def evaluate_rotations(pstate, rotations, stats=None):
+    results = [None] * len(rotations)
+    
+    # Trie node: [{name: child node}, indexes of the candidates ending here]
+    root = [{}, []]
+    steps = 0
+    
+    for c in range(0, len(rotations)):
+        node = root
+        
+        for step in rotations[c]:
+            name = step if step is None or isinstance(step, str) else getattr(step["action"], "name", None)
+            node = node[0].setdefault(name, [{}, []])
+            
+        node[1].append(c)
+        steps += len(rotations[c])
+        
+    search = pstate.branch()
+    start = (search.gained_adrenaline, search.spent_adrenaline, search.excess_adrenaline)
+    activations = 0
+    
+    def result(damage, ticks, invalid_at=None, reason=None):
+        return {
+            "damage": damage,
+            "ticks": ticks,
+            "valid": invalid_at is None,
+            "invalid_at": invalid_at,
+            "reason": reason,
+            "adrenaline": search.adrenaline,
+            "gained_adrenaline": search.gained_adrenaline - start[0],
+            "spent_adrenaline": search.spent_adrenaline - start[1],
+            "excess_adrenaline": search.excess_adrenaline - start[2],
+        }
+        
+    def invalidate(node, depth, damage, ticks, reason):
+        # Every candidate under node fails at step `depth`
+        nodes = [node]
+        
+        while len(nodes) > 0:
+            node = nodes.pop()
+            for c in node[1]:
+                results[c] = result(damage, ticks, depth, reason)
+            nodes.extend(node[0].values())
+    
+    for c in root[1]:
+        results[c] = result(0, 0)
+    
+    # Depth first, each entry is (name, node, step index, token of the
+    # parent's state, damage and ticks so far)
+    token = search.snapshot()
+    stack = [(name, child, 0, token, 0, 0) for name, child in root[0].items()]
+    
+    while len(stack) > 0:
+        name, node, depth, token, damage, ticks = stack.pop()
+        search.restore(token)
+        
+        action = None
+        if name is not None:
+            i = Action.find_by_name(name, search.actions)
+            
+            if i is None:
+                invalidate(node, depth, damage, ticks, "unknown action")
+                continue
+                
+            action = search.actions[i]
+            
+            if not action.is_ready():
+                invalidate(node, depth, damage, ticks, "on cooldown" if action.enabled else "disabled")
+                continue
+                
+            if not search.check_pstate(action):
+                invalidate(node, depth, damage, ticks, "failed pstate_check")
+                continue
+                
+        action_ticks = getattr(action, "ticks", 1)
+        damage += search.value(action, mod_value_prediction=False) * action_ticks
+        ticks += action_ticks
+        
+        search.activate(name)
+        activations += 1
+        
+        for c in node[1]:
+            results[c] = result(damage, ticks)
+            
+        token = search.snapshot()
+        for child_name, child in node[0].items():
+            stack.append((child_name, child, depth + 1, token, damage, ticks))
+            
+    search.release()
+    
+    if stats is not None:
+        stats["candidates"] = len(rotations)
+        stats["steps"] = steps
+        stats["activations"] = activations
+        
+    return results
+
+# Parameters a SensitivityAnalysis can nudge (mod fields are looked up by
+# the mod's name, the rest by action name)
+SENSITIVITY_ACTION_FIELDS = ["min", "max", "cooldown", "accuracy_mod", "number_of_hits"]
+SENSITIVITY_MOD_FIELDS = ["multiplier"]
+
+# Damage change of the greedy rotation when one ability parameter is nudged,
+# without rerunning the whole fight for every parameter. The base run records
+# every decision (available actions, mod predictions, active mods, the choice
+# and the pstate's signature) and keeps a checkpoint (branch) every
+# `interval` decisions.
+#
+# A nudged run walks the base decisions while it's in step with the base run.
+# Decisions the parameter can't touch are taken as they are, the others are
+# re-scored with the nudged parameter, which is enough as long as the choice
+# stays the same (only the damage changes). At the first decision that comes
+# out differently (or can't be re-scored, cooldowns change what's available)
+# the pstate is resumed from the last checkpoint before it and the run is
+# simulated from there until it lines up with the base run again (same tick
+# and signature).
+#
+# A parameter can touch a decision when:
+#   min/max/accuracy_mod/number_of_hits   the action is available, or it's
+#                                         modable and a mod action is (its
+#                                         value is part of the prediction)
+#   cooldown                              the action (or a buddy) has been
+#                                         used since the runs lined up, or
+#                                         it's available (cooldowns break
+#                                         ties in get_greedy_best)
+#   multiplier                            the mod is active or an action
+#                                         with the mod is available
+#
+# Values are worked out with the same steps as PState.value and totals are
+# summed in the same order as a full run, so the results match it exactly.
+class SensitivityAnalysis(object):
+    def __init__(self, pstate, ticks, interval=16):
+        if isinstance(pstate, ArrayPState):
+            raise ValueError("SensitivityAnalysis needs a PState (ArrayPState keeps its own copies of the parameters)")
+        if pstate.use_prng:
+            raise ValueError("SensitivityAnalysis needs use_prng off, random rolls don't repeat between runs")
+            
+        self.pstate = pstate
+        self.ticks = ticks
+        self.interval = interval
+        
+        # Mod name -> actions that apply it (and its definition), and
+        # the modable actions
+        self.mod_users = {}
+        self.mod_definitions = {}
+        self.modable = set()
+        for a in pstate.actions:
+            if a.mod is not None:
+                self.mod_users.setdefault(a.mod.name, set()).add(a.name)
+                self.mod_definitions.setdefault(a.mod.name, a.mod.definition)
+            if a.modable:
+                self.modable.add(a.name)
+                
+        self.mod_action_names = set().union(*self.mod_users.values())
+        
+        # Checked against for duration mod predictions (like ValueCache)
+        self.adrenaline_pstate = PState(actions=[], use_value_cache=False)
+        
+        self.run_base()
+        
+    def run_base(self):
+        base = self.pstate.branch()
+        self.decisions = []
+        self.tick_index = {}
+        self.checkpoints = {}
+        self.damages = []
+        
+        # Action name -> decisions it was reset on (used or by a buddy)
+        self.resets = {}
+        
+        self.record(base, 0)
+        clock = 0
+        
+        for step in greedy_steps(base, self.ticks):
+            i = len(self.damages)
+            
+            if step.action is not None:
+                self.decisions[i]["chosen"] = Action.find_by_name(step.action.name, base.actions)
+                for name in (step.action.name,) + (step.action.buddy_actions or ()):
+                    self.resets.setdefault(name, []).append(i)
+                    
+            self.damages.append(step.damage)
+            clock += step.ticks
+            
+            if clock <= self.ticks:
+                self.record(base, clock)
+                
+        self.damage = self.add_damages(self.damages)
+        
+    def record(self, pstate, tick):
+        i = len(self.decisions)
+        available = pstate.get_available_actions()
+        predictions = {}
+        included = {}
+        
+        for a in available:
+            if a.mod is not None:
+                cache = pstate.value_cache
+                predictions[a.name] = pstate.mod_value_increase(a) if cache is None else cache.mod_value_increase(a)
+                included[a.name] = self.prediction_actions(pstate, a)
+                
+        self.decisions.append({
+            "tick": tick,
+            "signature": pstate.signature(),
+            "available": [Action.find_by_name(a.name, pstate.actions) for a in available],
+            "available_names": frozenset(a.name for a in available),
+            "predictions": predictions,
+            "included": included,
+            "mods": [m.name for m in pstate.active_mods if m.is_active],
+            "chosen": None,
+        })
+        self.tick_index[tick] = i
+        
+        if i % self.interval == 0:
+            self.checkpoints[i] = pstate.branch()
+            
+    def prediction_actions(self, pstate, action):
+        # Indexes of the actions whose values go into the mod prediction
+        # of action (see PState.mod_value_increase)
+        mod = action.mod
+        window = action.ticks if mod.one_time_use else mod.duration
+        checks = pstate
+        
+        if not mod.one_time_use:
+            checks = self.adrenaline_pstate
+            checks.adrenaline = int(pstate.adrenaline + ((window - 3) / 3.0) * 8)
+            
+        return [
+            j for j, a in enumerate(pstate.actions)
+            if a.modable and a.time_remaining <= window and checks.check_pstate(a)
+        ]
+        
+    def prediction(self, action, included, actions, multiplier):
+        # Mod prediction of action with the nudged actions/multiplier,
+        # same steps as ValueCache.mod_value_increase
+        mod = action.mod
+        value_increase = lambda v,m : v - (v / (1 + m))
+        values = []
+        
+        for j in included:
+            a = actions.get(j, self.pstate.actions[j])
+            value = a.value()
+            values.append((value + (value * multiplier)) / a.ticks)
+            
+        if mod.one_time_use:
+            return value_increase(max([0] + values), multiplier)
+            
+        average_tick_value = sum(values) / len(values) if len(values) > 0 else 0
+        return value_increase(average_tick_value, multiplier) * mod.duration
+        
+    def affects(self, name, field, i, since=0):
+        # Whether the parameter can change decision i of a run that has
+        # been in step with the base run since decision `since`
+        decision = self.decisions[i]
+        
+        if field in SENSITIVITY_MOD_FIELDS:
+            return name in decision["mods"] or len(decision["available_names"] & self.mod_users.get(name, set())) > 0
+            
+        if field == "cooldown":
+            return self.reset_since(name, i, since) or name in decision["available_names"]
+            
+        return name in decision["available_names"] or \
+            (name in self.modable and len(decision["available_names"] & self.mod_action_names) > 0)
+            
+    def reset_since(self, name, i, since):
+        # Whether name was reset between decisions since and i
+        resets = self.resets.get(name, [])
+        r = bisect.bisect_left(resets, since)
+        return r < len(resets) and resets[r] < i
+        
+    def rescore(self, i, name, field, actions, multiplier, since=0):
+        # Damage of decision i with the nudged actions (by index) or mod
+        # multiplier, None when the choice changes (and the run has to be
+        # simulated). A nudged cooldown only changes the tie breaks until
+        # the action is reset, after that it changes what's available.
+        if field == "cooldown" and self.reset_since(name, i, since):
+            return None
+            
+        decision = self.decisions[i]
+        best = None
+        best_value = 0
+        best_base = 0
+        
+        for j in decision["available"]:
+            action = actions.get(j, self.pstate.actions[j])
+            
+            # PState.base_value, with the nudged mod multiplier
+            value = action.value()
+            if action.modable:
+                for mod_name in decision["mods"]:
+                    m = multiplier if mod_name == name and multiplier is not None else \
+                        self.mod_definitions[mod_name].multiplier
+                    value = value + (value * m)
+                    
+            base = value
+            
+            if action.mod is not None:
+                included = decision["included"][action.name]
+                
+                if multiplier is not None and action.mod.name == name:
+                    value += self.prediction(action, included, actions, multiplier)
+                elif any(k in actions for k in included):
+                    value += self.prediction(action, included, actions, action.mod.multiplier)
+                else:
+                    value += decision["predictions"][action.name]
+                    
+            # Same order and tie break as PState.get_greedy_best
+            if best is None or (value == best_value and action.cooldown < actions.get(best, self.pstate.actions[best]).cooldown) or \
+                value > best_value:
+                best = j
+                best_value = value
+                best_base = base
+                
+        if best != decision["chosen"]:
+            return None
+            
+        return 0 if best is None else best_base * self.pstate.actions[best].ticks
+        
+    def value_of(self, name, field):
+        for a in self.pstate.actions:
+            if field in SENSITIVITY_MOD_FIELDS and a.mod is not None and a.mod.name == name:
+                return getattr(a.mod, field)
+            if field in SENSITIVITY_ACTION_FIELDS and a.name == name:
+                return getattr(a, field)
+                
+        raise ValueError("Nothing to nudge for {0} {1}".format(name, field))
+        
+    def resume(self, i, name, field, value, reset=False):
+        # Branch of the checkpoint at decision i with the parameter changed
+        # (reset when the nudged run has reset the action since it lined
+        # up, see below)
+        pstate = self.checkpoints[i].branch()
+        
+        if field in SENSITIVITY_MOD_FIELDS:
+            definition = None
+            for a in pstate.actions:
+                if a.mod is not None and a.mod.name == name:
+                    definition = a.mod.definition.replace(**{field: value})
+                    a.mod = Modifier.new(definition)
+                    
+            for m in pstate.active_mods:
+                if m.name == name:
+                    m.definition = definition
+        else:
+            for a in pstate.actions:
+                if a.name != name:
+                    continue
+                    
+                # Until the nudged run resets it the action keeps the time
+                # it has left (like a fresh run has it ready from the start)
+                if field == "cooldown" and not reset:
+                    a.last_used += value - a.cooldown
+                    
+                setattr(a, field, value)
+                
+        # The value cache and ready set are built from the parameters
+        pstate.update_definitions()
+            
+        return pstate
+        
+    def perturb(self, name, field, value):
+        # Result of the greedy run with name's field set to value
+        old = self.value_of(name, field)
+        
+        # Nudged copies of the actions (by index) or the nudged multiplier
+        # for rescore
+        actions = {}
+        multiplier = None
+        if field in SENSITIVITY_MOD_FIELDS:
+            multiplier = value
+        else:
+            for j, a in enumerate(self.pstate.actions):
+                if a.name == name:
+                    actions[j] = Action.new(a.definition.replace(**{field: value}))
+                    
+        damages = []
+        i = 0
+        resumed_at = None
+        simulated = 0
+        
+        # A pstate in step with the base run at decision `position`
+        # (from the last time the nudged run lined up with it)
+        pstate = None
+        position = 0
+        
+        while i < len(self.decisions):
+            if not self.affects(name, field, i, position):
+                damage = self.damages[i]
+            else:
+                damage = self.rescore(i, name, field, actions, multiplier, position)
+            
+            if damage is not None:
+                damages.append(damage)
+                i += 1
+                continue
+                
+            # The run changes at i, catch up to it by replaying the base
+            # choices from the closest checkpoint (or the pstate when it's
+            # not much further back, resuming costs about as much as
+            # replaying `interval` decisions)
+            checkpoint = (i // self.interval) * self.interval
+            
+            if pstate is None or checkpoint - position > self.interval:
+                reset = self.reset_since(name, checkpoint, position)
+                pstate = self.resume(checkpoint, name, field, value, reset=reset)
+                position = checkpoint
+                
+            for j in range(position, i):
+                chosen = self.decisions[j]["chosen"]
+                pstate.activate(None if chosen is None else pstate.actions[chosen].name)
+                
+            if resumed_at is None:
+                resumed_at = self.decisions[checkpoint]["tick"]
+                
+            clock = self.decisions[i]["tick"]
+            diverged = i
+            i = len(self.decisions)
+            
+            for step in greedy_steps(pstate, self.ticks - clock):
+                damages.append(step.damage)
+                simulated += 1
+                clock += step.ticks
+                
+                j = self.tick_index.get(clock)
+                if j is not None and j > diverged and pstate.adrenaline == self.decisions[j]["signature"][0] and \
+                    pstate.signature() == self.decisions[j]["signature"]:
+                    i = position = j
+                    break
+                    
+        total = self.add_damages(damages)
+        change = total - self.damage
+        
+        return {
+            "name": name,
+            "field": field,
+            "value": old,
+            "perturbed": value,
+            "damage": total,
+            "change": change,
+            "marginal": change / (value - old) if value != old else 0,
+            "resumed_at": resumed_at,
+            "simulated": simulated,
+            "decisions": len(self.damages),
+        }
+        
+    @staticmethod
+    def add_damages(damages):
+        # One at a time so the total rounds like a full run
+        total = 0
+        for damage in damages:
+            total += damage
+        return total
+        
+    def parameters(self):
+        # max, cooldown and accuracy_mod of every action and the
+        # multiplier of every mod
+        parameters = []
+        
+        for a in self.pstate.actions:
+            for field in ["max", "cooldown", "accuracy_mod"]:
+                if (a.name, field) not in parameters:
+                    parameters.append((a.name, field))
+                    
+        for name in self.mod_users:
+            parameters.append((name, "multiplier"))
+            
+        return parameters
+        
+    def run(self, parameters=None, step=0.05):
+        # Nudges every parameter up by step (a fraction of its value, or by
+        # step itself when it's 0), biggest damage changes first
+        results = []
+        
+        for name, field in (self.parameters() if parameters is None else parameters):
+            old = self.value_of(name, field)
+            results.append(self.perturb(name, field, old * (1 + step) if old else step))
+            
+        return sorted(results, key=lambda r: abs(r["change"]), reverse=True)
+        
+def sensitivity_analysis(pstate, ticks, parameters=None, step=0.05, interval=16):
+    return SensitivityAnalysis(pstate, ticks, interval).run(parameters, step)
+
+
+
+
+class TranspositionTable(object):
+    # Bounded memo of solved states, least recently used entries are
+    # evicted once it is full
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, key):
+        entry = self.entries.get(key)
+        
+        if entry is None:
+            self.misses += 1
+            return None
+            
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+        
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups > 0 else 0.0
+        
+    def __len__(self):
+        return len(self.entries)
+
+
+class ExactSearch(object):
+    # Finds the rotation with the most damage over `ticks` by searching every
+    # choice greedy_value could have made (available actions, a 1 tick skip
+    # when there are none). States are the pstate signature (cooldowns,
+    # adrenaline, active mod timers) plus the ticks left, and the best damage
+    # from each one is kept in a transposition table. Branches are explored
+    # with snapshot/restore. Meant for short windows (openers, burst windows),
+    # the number of states grows quickly with the ticks.
+    #
+    # Branches that can't beat the best rotation known so far (starting with
+    # beam_search_value's) are cut using an optimistic bound, the table
+    # entries for those are only an upper bound and are searched again if
+    # they're needed.
+    def __init__(self, pstate, ticks, table_size=100000):
+        if pstate.use_prng:
+            raise ValueError("ExactSearch needs use_prng=False")
+            
+        self.pstate = pstate
+        self.ticks = ticks
+        self.table = TranspositionTable(table_size)
+        self.nodes = 0
+        self.pruned = 0
+        self.max_ticks = max([a.ticks for a in pstate.actions] + [1])
+        
+        # Every action takes a multiple of this many ticks
+        self.granularity = 0
+        for a in pstate.actions:
+            self.granularity = math.gcd(self.granularity, int(a.ticks))
+        self.granularity = max(self.granularity, 1)
+        
+        # Most adrenaline that can be gained per tick, to work out how soon
+        # an action that spends adrenaline could be used
+        self.adrenaline_rate = max([
+            float(self.adrenaline_change(a)) / a.ticks for a in pstate.actions
+            if self.adrenaline_change(a) > 0
+        ] + [0])
+        
+        # Damage per adrenaline to try in bound(), from the average action
+        average = statistics.mean([a.value() for a in pstate.actions] + [0])
+        self.prices = [average * scale for scale in (0.25, 0.5, 1, 2, 4)]
+        
+        # Mods that can stack have no useful bound
+        self.stacking_mods = any(
+            not a.mod.is_unqiue for a in pstate.actions if type(getattr(a, "mod", None)) == Modifier
+        ) or any(not m.is_unqiue for m in pstate.active_mods)
+        
+    @property
+    def hit_rate(self):
+        return self.table.hit_rate
+        
+    def run(self):
+        # Solve, then follow the best choices from the start and
+        # replay them on the pstate (greedy_value's output format)
+        incumbent = beam_search_value(self.pstate.branch(), self.ticks)
+        best = get_total(incumbent)
+        tolerance = 1e-9 * max(1.0, abs(best))
+        
+        search = self.pstate.branch()
+        search.snapshot()
+        
+        damage, name, exact = self.solve(search, self.ticks, best - tolerance)
+        if not exact:
+            return replay_rotation(self.pstate, [getattr(a["action"], "name", None) for a in incumbent])
+            
+        best = damage
+        names = []
+        remaining = self.ticks
+        
+        while remaining >= 0:
+            damage, name, exact = self.solve(search, remaining, best - tolerance)
+            names.append(name)
+            
+            action_ticks = self.action_ticks(search, name)
+            i = Action.find_by_name(name, search.actions) if name is not None else None
+            best -= 0 if i is None else search.value(search.actions[i], mod_value_prediction=False) * action_ticks
+            
+            search.activate(name)
+            remaining -= action_ticks
+            
+        return replay_rotation(self.pstate, names)
+        
+    def action_ticks(self, pstate, name):
+        if name is None:
+            return 1
+        return pstate.actions[Action.find_by_name(name, pstate.actions)].ticks
+        
+    def adrenaline_change(self, action):
+        # What adjust_adrenaline will change adrenaline by
+        change = action.adrenaline_change if action.adrenaline_change is not None else 0
+        if change == -100 and self.pstate.use_ringofvigour:
+            return -90
+        return change
+        
+    def earliest(self, pstate, action, remaining):
+        # Soonest tick the action could be used, assuming an action that
+        # spends adrenaline needs at least that much to be used and ignoring
+        # everything else in its pstate_check (None if it can't be used)
+        if not action.enabled:
+            return None
+            
+        start = max(0, action.time_remaining)
+        cost = -self.adrenaline_change(action)
+        
+        if cost > pstate.adrenaline:
+            if self.adrenaline_rate <= 0:
+                return None
+            start = max(start, int(math.ceil((cost - pstate.adrenaline) / self.adrenaline_rate)))
+            
+        return start if start <= remaining else None
+        
+    def bound(self, pstate, remaining):
+        # Optimistic damage from here. Every action but the last one has to
+        # fit in the ticks left, so that's filled with the best damage per
+        # tick and the best single use is added on. Every action is used as
+        # often as its cooldown allows and mods are active from the first
+        # tick they could be.
+        #
+        # Adrenaline can't be spent before it's gained, which is priced in by
+        # charging `price` damage per adrenaline spent (and paying it back for
+        # adrenaline gained). Any price gives a valid bound so the smallest of
+        # a few is used.
+        if self.stacking_mods:
+            return float("inf")
+            
+        # Multipliers for an action starting on each tick, the ones that
+        # aren't the last have to fit in a multiple of granularity ticks
+        size = int(remaining) + 1
+        capacity = int(remaining // self.granularity) * self.granularity
+        multipliers = [1.0] * size
+        windows = {}
+        
+        for m in pstate.active_mods:
+            if m.is_active:
+                end = size if m.duration is None else min(size, max(1, m.duration - m.last_used))
+                windows.setdefault(m.name, [m, set()])[1].update(range(0, int(end)))
+                
+        uses = []
+        
+        for a in pstate.actions:
+            start = self.earliest(pstate, a, remaining)
+            if start is None:
+                continue
+                
+            times = 1 + int((remaining - start) // max(a.cooldown, 1))
+            uses.append((a.value(), a, times))
+            
+            if type(getattr(a, "mod", None)) == Modifier:
+                end = size
+                if a.mod.duration is not None and start + a.cooldown > remaining:
+                    end = min(size, start + a.mod.duration + 1)
+                windows.setdefault(a.mod.name, [a.mod, set()])[1].update(range(start, int(end)))
+                
+        for mod, ticks in windows.values():
+            for t in ticks:
+                multipliers[t] = mod.apply_mod(multipliers[t])
+                
+        multipliers.sort(reverse=True)
+        best = multipliers[0]
+        
+        # Without pricing adrenaline modable actions get paired with the
+        # biggest multipliers, running totals of the best damage per tick
+        def best_ticks(modable):
+            totals = [0]
+            for rate, a, times in sorted(uses, key=lambda u: u[0], reverse=True):
+                if a.modable != modable:
+                    continue
+                for _ in range(0, times * a.ticks):
+                    if len(totals) > capacity:
+                        return totals
+                    totals.append(totals[-1] + rate * (multipliers[len(totals) - 1] if modable else 1))
+            return totals
+            
+        modable = best_ticks(True)
+        other = best_ticks(False)
+        last = max([rate * a.ticks * (best if a.modable else 1) for rate, a, times in uses] + [0])
+        
+        # Non-modable actions don't care about the multipliers, so they get
+        # the ticks after the modable ones
+        total = last + max(
+            other[k] + modable[min(capacity - k, len(modable) - 1)]
+            for k in range(0, min(capacity, len(other) - 1) + 1)
+        )
+        
+        for price in self.prices:
+            last = 0
+            items = []
+            
+            for rate, a, times in uses:
+                damage = rate * a.ticks * (best if a.modable else 1) + price * self.adrenaline_change(a)
+                if damage > 0:
+                    items.append((damage / a.ticks, a.ticks * times))
+                    last = max(last, damage)
+                    
+            priced = price * max(0, pstate.adrenaline) + last
+            space = capacity
+            
+            for rate, ticks in sorted(items, reverse=True):
+                if space <= 0:
+                    break
+                priced += rate * min(ticks, space)
+                space -= ticks
+                
+            total = min(total, priced)
+            
+        return total
+        
+    def solve(self, pstate, remaining, need):
+        # Returns (damage, first action name, exact) for this pstate with
+        # `remaining` ticks left (actions start while remaining >= 0, like
+        # greedy_value). When the damage can't be more than `need` the result
+        # might only be an upper bound (exact=False).
+        if remaining < 0:
+            return 0, None, True
+            
+        key = (pstate.signature(), remaining)
+        entry = self.table.get(key)
+        if entry is not None and (entry[2] or entry[0] <= need):
+            return entry
+            
+        bound = self.bound(pstate, remaining)
+        if bound <= need:
+            self.pruned += 1
+            entry = (bound, None, False)
+            self.table.put(key, entry)
+            return entry
+            
+        self.nodes += 1
+        best = None
+        best_bound = None
+        available = pstate.get_available_actions()
+        
+        if len(available) == 0:
+            available = [None]
+            
+        # Most promising first so the later ones are more likely to be cut
+        available = sorted(available, key=lambda a: pstate.value(a), reverse=True)
+            
+        for action in available:
+            name = getattr(action, "name", None)
+            action_ticks = getattr(action, "ticks", 1)
+            value = pstate.value(action, mod_value_prediction=False) * action_ticks
+            target = need if best is None else max(need, best[0])
+            
+            token = pstate.snapshot()
+            pstate.activate(name)
+            damage, _, exact = self.solve(pstate, remaining - action_ticks, target - value)
+            pstate.restore(token)
+            
+            damage += value
+            
+            if not exact:
+                best_bound = damage if best_bound is None else max(best_bound, damage)
+            elif best is None or damage > best[0]:
+                best = (damage, name, True)
+                
+        # Exact only if nothing that was cut could have been better
+        if best is None:
+            entry = (best_bound, None, False)
+        elif best_bound is not None and best_bound > best[0]:
+            entry = (best_bound, None, False)
+        else:
+            entry = best
+            
+        self.table.put(key, entry)
+        return entry
+        
+        
+# Optimal rotation for a short window, pass a dict as stats to get the
+# search counters back
+def exact_value(pstate, ticks, table_size=100000, stats=None):
+    search = ExactSearch(pstate, ticks, table_size=table_size)
+    rotation = search.run()
+    
+    if stats is not None:
+        stats.update({
+            "nodes": search.nodes,
+            "pruned": search.pruned,
+            "table_size": len(search.table),
+            "hit_rate": search.hit_rate,
+        })
+        
+    return rotation
+
+
+class MCTSNode(object):
+    # untried are the action names that haven't been expanded yet
+    __slots__ = ("children", "untried", "visits", "total")
+    
+    def __init__(self, untried):
+        self.children = {}
+        self.untried = untried
+        self.visits = 0
+        self.total = 0.0
+        
+# Monte Carlo tree search over rotations. Each iteration follows the tree by
+# UCT (rewards scaled by the lowest/highest damage seen), adds one new
+# action, plays the rest of the fight out with the rollout policy
+# (get_greedy_best unless one is passed in) and adds the total damage to
+# every node on the way. Iterations run on one branch of the pstate that is
+# rolled back with snapshot/restore.
+#
+# With use_prng the damage rolls (and ASR procs) are sampled, so a single
+# playout's damage is noisy: the most visited path is recommended instead
+# of the best single playout. A tree action that isn't available on a
+# later visit (ASR changing adrenaline) ends the selection there.
+class MonteCarloTreeSearch(object):
+    def __init__(self, pstate, ticks, exploration=0.5, seed=None, rollout=None):
+        self.pstate = pstate
+        self.ticks = ticks
+        self.exploration = exploration
+        self.rng = random.Random(seed)
+        self.rollout = rollout
+        
+        self.search = pstate.branch()
+        self.token = self.search.snapshot()
+        self.root = None
+        self.iterations = 0
+        self.nodes = 0
+        
+        # Best playout so far as (damage, action names), and the range of
+        # playout damage used to scale the rewards
+        self.best = (float("-inf"), None)
+        self.low = None
+        self.high = None
+        
+    def new_node(self, pstate, tick):
+        self.nodes += 1
+        
+        if tick > self.ticks:
+            return MCTSNode([])
+            
+        names = [a.name for a in pstate.get_available_actions()]
+        if len(names) == 0:
+            names = [None]
+            
+        self.rng.shuffle(names)
+        return MCTSNode(names)
+        
+    def step(self, pstate, name):
+        # Activate name, returns its damage and ticks
+        i = None if name is None else Action.find_by_name(name, pstate.actions)
+        action = None if i is None else pstate.actions[i]
+        action_ticks = getattr(action, "ticks", 1)
+        damage = pstate.value(action, mod_value_prediction=False) * action_ticks
+        
+        pstate.activate(name)
+        return damage, action_ticks
+        
+    def available(self, pstate, name):
+        if name is None:
+            return True
+            
+        action = pstate.actions[Action.find_by_name(name, pstate.actions)]
+        return action.is_ready() and pstate.check_pstate(action)
+        
+    def select(self, node):
+        log_visits = math.log(node.visits)
+        scale = self.high - self.low
+        best = None
+        
+        for name, child in node.children.items():
+            mean = child.total / child.visits
+            score = ((mean - self.low) / scale if scale > 0 else 0) + \
+                self.exploration * math.sqrt(log_visits / child.visits)
+                
+            if best is None or score > best[0]:
+                best = (score, name, child)
+                
+        return best[1], best[2]
+        
+    def iterate(self):
+        search = self.search
+        search.restore(self.token)
+        
+        if self.root is None:
+            self.root = self.new_node(search, 0)
+            
+        node = self.root
+        path = [node]
+        names = []
+        damage = 0
+        tick = 0
+        
+        # Selection
+        while len(node.untried) == 0 and len(node.children) > 0:
+            name, child = self.select(node)
+            
+            if not self.available(search, name):
+                break
+                
+            value, action_ticks = self.step(search, name)
+            damage += value
+            tick += action_ticks
+            names.append(name)
+            node = child
+            path.append(node)
+            
+        # Expansion
+        if len(node.untried) > 0 and tick <= self.ticks:
+            name = node.untried.pop()
+            value, action_ticks = self.step(search, name)
+            damage += value
+            tick += action_ticks
+            names.append(name)
+            
+            node.children[name] = node = self.new_node(search, tick)
+            path.append(node)
+            
+        # Rollout
+        while tick <= self.ticks:
+            action = search.get_greedy_best() if self.rollout is None else self.rollout(search)
+            name = getattr(action, "name", None)
+            value, action_ticks = self.step(search, name)
+            damage += value
+            tick += action_ticks
+            names.append(name)
+            
+        for n in path:
+            n.visits += 1
+            n.total += damage
+            
+        self.low = damage if self.low is None else min(self.low, damage)
+        self.high = damage if self.high is None else max(self.high, damage)
+        
+        if damage > self.best[0]:
+            self.best = (damage, names)
+            
+        self.iterations += 1
+        
+    def run(self, iterations=None, seconds=None):
+        # Runs until either budget is used up (1000 iterations if neither is
+        # given), always at least one iteration
+        if iterations is None and seconds is None:
+            iterations = 1000
+            
+        deadline = None if seconds is None else time.perf_counter() + seconds
+        
+        while self.iterations == 0 or \
+            ((iterations is None or self.iterations < iterations) and \
+            (deadline is None or time.perf_counter() < deadline)):
+            self.iterate()
+            
+        return self
+        
+    def root_stats(self):
+        # {name: (visits, total damage)} for the first action
+        return dict((name, (child.visits, child.total)) for name, child in self.root.children.items())
+        
+    def recommendation(self):
+        # Action names to play (greedy finishes the fight after them)
+        if not self.pstate.use_prng:
+            return self.best[1]
+            
+        names = []
+        node = self.root
+        
+        while len(node.children) > 0:
+            name, node = max(node.children.items(), key=lambda c: c[1].visits)
+            names.append(name)
+            
+        return names
+        
+def play_rotation(pstate, ticks, names):
+    # replay_rotation for names, then greedy for whatever is left of ticks
+    rotation = replay_rotation(pstate, names)
+    played = sum(getattr(a["action"], "ticks", 1) for a in rotation)
+    
+    return rotation + greedy_value(pstate, ticks - played)
+    
+def run_mcts_worker(pstate, ticks, iterations, seconds, seed, exploration):
+    mcts = MonteCarloTreeSearch(pstate, ticks, exploration=exploration, seed=seed).run(iterations, seconds)
+    return mcts.best[0], mcts.recommendation(), mcts.root_stats(), mcts.iterations, mcts.nodes
+    
+# Anytime MCTS optimizer (see MonteCarloTreeSearch), the budget is a number
+# of iterations and/or seconds of wall-clock time. processes > 1 runs that
+# many independent searches in parallel (root parallelization, each with its
+# own seed) and combines them: the best playout without use_prng, otherwise
+# the first action with the most visits over all searches, followed by the
+# recommendation of the search that visited it most among those that
+# recommend it (just the first action when none do, greedy finishes the
+# fight). The recommended rotation is played on pstate (same output as
+# greedy_value).
+def mcts_value(pstate, ticks, iterations=None, seconds=None, processes=1, seed=None, exploration=0.5, stats=None):
+    seeds = [None if seed is None else seed + k for k in range(0, max(1, processes))]
+    
+    if processes > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(run_mcts_worker, pstate, ticks, iterations, seconds, s, exploration) for s in seeds]
+            results = [f.result() for f in futures]
+    else:
+        results = [run_mcts_worker(pstate, ticks, iterations, seconds, seeds[0], exploration)]
+        
+    if pstate.use_prng:
+        visits = collections.Counter()
+        for result in results:
+            for name, (n, total) in result[2].items():
+                visits[name] += n
+                
+        first = visits.most_common(1)[0][0]
+        candidates = [r for r in results if len(r[1]) > 0 and r[1][0] == first]
+        names = max(candidates, key=lambda r: r[2][first][0])[1] if len(candidates) > 0 else [first]
+    else:
+        names = max(results, key=lambda r: r[0])[1]
+        
+    if stats is not None:
+        stats.update({
+            "iterations": sum(r[3] for r in results),
+            "nodes": sum(r[4] for r in results),
+            "searches": len(results),
+        })
+        
+    return play_rotation(pstate, ticks, names)
+
+
+class PriorityPolicy(object):
+    # Rotation the way players write them: use the first action in order
+    # that is available (off cooldown, passes its pstate_check) and whose
+    # adrenaline gate is met, otherwise wait a tick. gates[i] is the least
+    # adrenaline order[i] can be used with (0 for no gate).
+    def __init__(self, order, gates=None):
+        self.order = tuple(order)
+        self.gates = tuple(0 for _ in self.order) if gates is None else tuple(gates)
+        self.rank = dict((name, i) for i, name in enumerate(self.order))
+        
+    @property
+    def key(self):
+        return (self.order, self.gates)
+        
+    def __repr__(self):
+        return "PriorityPolicy({0})".format(", ".join(
+            name if gate == 0 else "{0} (>= {1})".format(name, gate) for name, gate in zip(self.order, self.gates)
+        ))
+        
+    def choose(self, pstate):
+        best = None
+        
+        for a in pstate.get_available_actions():
+            i = self.rank.get(a.name)
+            
+            if i is None or pstate.adrenaline < self.gates[i]:
+                continue
+                
+            if best is None or i < best[0]:
+                best = (i, a)
+                
+        return None if best is None else best[1]
+        
+def priority_value(pstate, ticks, policy, event_driven=False):
+    return [step.to_record() for step in greedy_steps(pstate, ticks, event_driven, policy=policy)]
+    
+def max_damage_per_tick(pstate):
+    # Upper bound on the damage of any one tick: the best roll of the best
+    # action with every mod on the bar (or active) applied
+    multiplier = 1.0
+    mods = dict((m.name, m.multiplier) for m in pstate.active_mods)
+    
+    for a in pstate.actions:
+        if getattr(a, "mod", None) is not None:
+            mods[a.mod.name] = max(a.mod.multiplier, mods.get(a.mod.name, 0))
+            
+    for m in mods.values():
+        multiplier *= 1 + max(0, m)
+        
+    best = 0
+    for a in pstate.actions:
+        value = a.max * (1 + a.accuracy_mod) / a.ticks * a.number_of_hits
+        best = max(best, value * (multiplier if a.modable else 1))
+        
+    return best
+    
+def priority_fitness(pstate, ticks, policy, cutoff=None):
+    # Damage of the policy over ticks as (damage, finished). Once the damage
+    # so far plus the most the rest of the fight could add is below cutoff
+    # the run is dropped (finished is False, damage is what it had so far).
+    damage = 0
+    tick = 0
+    bound = max_damage_per_tick(pstate)
+    longest = max([a.ticks for a in pstate.actions] + [1])
+    
+    for step in greedy_steps(pstate, ticks, policy=policy):
+        damage += step.damage
+        tick += step.ticks
+        
+        if cutoff is not None and damage + (ticks + longest - tick) * bound < cutoff:
+            return damage, False
+            
+    return damage, True
+    
+priority_template = None
+
+def init_priority_worker(pstate):
+    global priority_template
+    priority_template = pstate
+    
+def run_priority_fitness(key, ticks, cutoff):
+    # Pool worker, every candidate runs on a branch of the same pstate so
+    # the value cache stays warm
+    return priority_fitness(priority_template.branch(), ticks, PriorityPolicy(*key), cutoff)
+    
+def run_priority_fitness_on(pstate, key, ticks, cutoff):
+    return priority_fitness(pstate.branch(), ticks, PriorityPolicy(*key), cutoff)
+    
+# Genetic search over PriorityPolicies. Candidates are orderings of the bar
+# plus an adrenaline gate per action, their fitness is the damage from
+# simulating them for ticks. Each generation keeps the `elite` best, the
+# rest are children of tournament picks (order crossover, then mutations
+# that move an action, swap two or nudge a gate).
+#
+# Fitness is cached by (order, gates). Runs that can't beat the best so far
+# any more (see priority_fitness) are cut short, their partial damage is
+# used as the fitness. processes > 1 evaluates each generation on a pool.
+#
+# The search starts from the bar ranked by value at the start of the fight,
+# not from the greedy rotation (greedy re-ranks at every decision, which a
+# fixed priority list can't express). So it can end up worse than
+# greedy_value, most likely with few generations (melee_2h at 50
+# adrenaline over 300 ticks is below greedy after 5).
+class PrioritySearch(object):
+    GATES = [0, 15, 25, 35, 50, 60, 75, 90, 100]
+    
+    def __init__(self, pstate, ticks, population=32, elite=4, mutation=0.6, seed=None):
+        self.pstate = pstate
+        self.ticks = ticks
+        self.population_size = max(2, population)
+        self.elite = min(elite, self.population_size)
+        self.mutation = mutation
+        self.rng = random.Random(seed)
+        self.names = [a.name for a in pstate.actions]
+        
+        self.fitness = {}
+        self.best = (float("-inf"), None)
+        self.generations = 0
+        self.evaluations = 0
+        self.cache_hits = 0
+        self.pruned = 0
+        
+    def initial_population(self):
+        # The bar ranked by value at the start and random orderings
+        values = dict((a.name, self.pstate.value(a)) for a in self.pstate.actions)
+        ranked = sorted(self.names, key=lambda name: values[name], reverse=True)
+        population = [(tuple(ranked), tuple(0 for _ in ranked))]
+        
+        while len(population) < self.population_size:
+            order = list(self.names)
+            self.rng.shuffle(order)
+            population.append((tuple(order), tuple(0 for _ in order)))
+            
+        return population
+        
+    def crossover(self, a, b):
+        # Order crossover: a slice of a's order (with its gates), the other
+        # actions in b's order (with b's gates)
+        i, j = sorted(self.rng.sample(range(0, len(a[0]) + 1), 2))
+        kept = set(a[0][i:j])
+        gates = dict(zip(b[0], b[1]))
+        gates.update(zip(a[0][i:j], a[1][i:j]))
+        
+        rest = [name for name in b[0] if name not in kept]
+        order = rest[:i] + list(a[0][i:j]) + rest[i:]
+        
+        return (tuple(order), tuple(gates[name] for name in order))
+        
+    def mutate(self, candidate):
+        order, gates = list(candidate[0]), list(candidate[1])
+        
+        while self.rng.random() < self.mutation:
+            kind = self.rng.randrange(0, 3)
+            i, j = self.rng.randrange(0, len(order)), self.rng.randrange(0, len(order))
+            
+            if kind == 0:
+                order.insert(j, order.pop(i))
+                gates.insert(j, gates.pop(i))
+            elif kind == 1:
+                order[i], order[j] = order[j], order[i]
+                gates[i], gates[j] = gates[j], gates[i]
+            else:
+                gates[i] = self.rng.choice(PrioritySearch.GATES)
+                
+        return (tuple(order), tuple(gates))
+        
+    def tournament(self, population, size=3):
+        picks = [self.rng.choice(population) for _ in range(0, size)]
+        return max(picks, key=lambda c: self.fitness[c][0])
+        
+    def evaluate(self, population, pool=None):
+        keys = []
+        for key in population:
+            if key in self.fitness:
+                self.cache_hits += 1
+            elif key not in keys:
+                keys.append(key)
+                
+        cutoff = self.best[0] if self.best[1] is not None else None
+        
+        if pool is None:
+            results = [run_priority_fitness_on(self.pstate, key, self.ticks, cutoff) for key in keys]
+        else:
+            results = list(pool.map(run_priority_fitness, keys,
+                [self.ticks] * len(keys), [cutoff] * len(keys)))
+            
+        for key, (damage, finished) in zip(keys, results):
+            self.fitness[key] = (damage, finished)
+            self.evaluations += 1
+            
+            if not finished:
+                self.pruned += 1
+            elif damage > self.best[0]:
+                self.best = (damage, key)
+                
+    def run(self, generations=20, processes=1):
+        pool = None
+        if processes > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes, initializer=init_priority_worker, initargs=(self.pstate,)
+            )
+            
+        try:
+            population = self.initial_population()
+            self.evaluate(population, pool)
+            
+            for _ in range(0, generations):
+                # Duplicates dropped in order and ties broken by the candidate
+                # itself, so a seed gives the same search in any process (set
+                # order changes with string hashing)
+                population = sorted(dict.fromkeys(population), key=lambda c: (-self.fitness[c][0], c))
+                children = population[:self.elite]
+                
+                while len(children) < self.population_size:
+                    child = self.crossover(self.tournament(population), self.tournament(population))
+                    children.append(self.mutate(child))
+                    
+                population = children
+                self.evaluate(population, pool)
+                self.generations += 1
+        finally:
+            if pool is not None:
+                pool.shutdown()
+                
+        return self
+        
+    def policy(self):
+        return PriorityPolicy(*self.best[1])
+        
+# Best priority list PrioritySearch finds, played on pstate (greedy_value's
+# output format). stats gets the policy and the search counters.
+def priority_search_value(pstate, ticks, generations=20, population=32, processes=1, seed=None, stats=None):
+    search = PrioritySearch(pstate, ticks, population=population, seed=seed).run(generations, processes)
+    policy = search.policy()
+    
+    if stats is not None:
+        stats.update({
+            "policy": policy,
+            "damage": search.best[0],
+            "generations": search.generations,
+            "evaluations": search.evaluations,
+            "cache_hits": search.cache_hits,
+            "pruned": search.pruned,
+        })
+        
+    return priority_value(pstate, ticks, policy)
+
+
+class Distribution(object):
+    # Summary statistics over the samples of one Monte Carlo measurement
+    def __init__(self, samples):
+        self.samples = sorted(float(s) for s in samples)
+        self.count = len(self.samples)
+        self.mean = sum(self.samples) / self.count if self.count > 0 else 0.0
+        
+        if self.count > 1:
+            variance = sum((s - self.mean) ** 2 for s in self.samples) / (self.count - 1)
+        else:
+            variance = 0.0
+            
+        self.std = math.sqrt(variance)
+        
+    @property
+    def min(self):
+        return self.samples[0] if self.count > 0 else 0.0
+        
+    @property
+    def max(self):
+        return self.samples[-1] if self.count > 0 else 0.0
+        
+    def percentile(self, p):
+        # Linear interpolation between the closest ranks (p from 0 - 100)
+        if self.count == 0:
+            return 0.0
+            
+        rank = (self.count - 1) * (p / 100.0)
+        low = int(math.floor(rank))
+        high = min(low + 1, self.count - 1)
+        
+        return self.samples[low] + (self.samples[high] - self.samples[low]) * (rank - low)
+        
+    def confidence_interval(self, level=0.95):
+        # Normal approximation of the confidence interval for the mean
+        if self.count < 2:
+            return (self.mean, self.mean)
+            
+        z = statistics.NormalDist().inv_cdf(0.5 + level / 2.0)
+        margin = z * self.std / math.sqrt(self.count)
+        
+        return (self.mean - margin, self.mean + margin)
+        
+    def summary(self):
+        low, high = self.confidence_interval()
+        return {
+            "mean": self.mean,
+            "std": self.std,
+            "min": self.min,
+            "p5": self.percentile(5),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+            "ci95": [low, high],
+        }
+        
+    def __repr__(self):
+        low, high = self.confidence_interval()
+        return "{0:.2f} (95% CI {1:.2f} - {2:.2f}, p5 {3:.2f}, p95 {4:.2f})".format(
+            self.mean, low, high, self.percentile(5), self.percentile(95)
+        )
+        
+        
+class MonteCarloResult(object):
+    # invalid: trials left out because they couldn't play the rotation
+    # (see monte_carlo_rotation)
+    def __init__(self, damage, spent_adrenaline, excess_adrenaline, usage, invalid=0):
+        self.trials = len(damage)
+        self.invalid = invalid
+        self.damage = Distribution(damage)
+        self.spent_adrenaline = Distribution(spent_adrenaline)
+        self.excess_adrenaline = Distribution(excess_adrenaline)
+        self.usage = dict((name, Distribution(usage[name])) for name in usage)
+        
+    def summary(self):
+        return {
+            "trials": self.trials,
+            "invalid": self.invalid,
+            "damage": self.damage.summary(),
+            "spent_adrenaline": self.spent_adrenaline.summary(),
+            "excess_adrenaline": self.excess_adrenaline.summary(),
+            "usage": dict((name, self.usage[name].summary()) for name in self.usage),
+        }
+
+# Runs `trials` independent use_prng runs of the optimizer (each one makes its
+# own decisions on its own rolls). Every trial gets a seed drawn from one
+# generator seeded with `seed`, so the whole batch is reproducible. This is
+# a plain loop over the trials, monte_carlo_rotation (a fixed rotation) and
+# monte_carlo_batch (greedy) are the vectorized ones.
+def monte_carlo_value(pstate, ticks, trials=1000, seed=None, optimizer=greedy_value):
+    seeds = random.Random(seed)
+    damage = []
+    spent = []
+    excess = []
+    usage = dict((a.name, []) for a in pstate.actions)
+    
+    for _ in range(0, trials):
+        trial = pstate.branch()
+        trial.use_prng = True
+        trial.seed(seeds.getrandbits(64))
+        
+        rotation = optimizer(trial, ticks)
+        
+        damage.append(get_total(rotation))
+        spent.append(trial.spent_adrenaline - pstate.spent_adrenaline)
+        excess.append(trial.excess_adrenaline - pstate.excess_adrenaline)
+        
+        for a, start in zip(trial.actions, pstate.actions):
+            usage[a.name].append(a.times_used - start.times_used)
+            
+    return MonteCarloResult(damage, spent, excess, usage)
+
+# Vectorized Monte Carlo of a fixed rotation (a greedy_value style list or a
+# list of action names). The rotation is replayed once without rolls for the
+# cooldowns and the mods active on every step (the same in every trial),
+# while all trials are rolled at once as a NumPy batch per step, including
+# the ASR adrenaline procs. With ASR a trial's adrenaline can differ from the
+# replay's, trials where a step's pstate_check fails on their own adrenaline
+# couldn't play the rotation: they are left out of the distributions and
+# counted in `invalid`.
+def monte_carlo_rotation(pstate, rotation, trials=1000, seed=None):
+    if np is None:
+        raise ImportError("monte_carlo_rotation requires numpy")
+        
+    names = [a if a is None or isinstance(a, str) else getattr(a["action"], "name", None) for a in rotation]
+    
+    replay = pstate.branch()
+    replay.use_prng = False
+    
+    rng = np.random.default_rng(seed)
+    damage = np.zeros(trials)
+    adrenaline = np.full(trials, float(pstate.adrenaline))
+    spent = np.zeros(trials)
+    excess = np.zeros(trials)
+    valid = np.ones(trials, dtype=bool)
+    usage = dict((a.name, 0) for a in pstate.actions)
+    
+    for name in names:
+        i = None if name is None else Action.find_by_name(name, replay.actions)
+        action = None if i is None else replay.actions[i]
+        
+        if action is None:
+            replay.activate(name)
+            continue
+            
+        mods = [m.multiplier for m in replay.active_mods if m.is_active] if action.modable else []
+        
+        # The check on every adrenaline the trials are at (the rest of the
+        # pstate is the replay's)
+        if is_pstate_check(action.pstate_check):
+            replayed = replay.adrenaline
+            for level in np.unique(adrenaline[valid]):
+                replay.adrenaline = level.item()
+                if not replay.check_pstate(action):
+                    valid &= adrenaline != level
+            replay.adrenaline = replayed
+            
+        replay.activate(name)
+        usage[action.name] += 1
+        
+        # Same steps as Ability.value with prng, then the active mods
+        values = rng.uniform(action.min, action.max, trials)
+        values = values + values * action.accuracy_mod
+        values = values / action.ticks * action.number_of_hits
+        
+        for m in mods:
+            values = values + values * m
+            
+        damage += values * action.ticks
+        
+        # Same rules as adjust_adrenaline
+        change = action.adrenaline_change
+        if change is None:
+            continue
+            
+        if change == -100 and pstate.use_ringofvigour == True:
+            change = np.full(trials, -90.0)
+        elif change == -15 and pstate.use_ASR:
+            change = np.where(rng.random(trials) <= .1, 0.0, -15.0)
+        else:
+            change = np.full(trials, float(change))
+            
+        adrenaline += change
+        spent += np.where(change > 0, 0, -change)
+        excess += np.maximum(adrenaline - 100, 0)
+        adrenaline = np.minimum(adrenaline, 100)
+        
+    kept = int(valid.sum())
+    usage = dict((name, [usage[name]] * kept) for name in usage)
+    return MonteCarloResult(damage[valid], spent[valid], excess[valid], usage, invalid=trials - kept)
+        
+class BatchAdrenalineView(object):
+    # Batch version of the empty bar pstate the mod predictions check
+    # duration mods against (see ValueCache.adrenaline_pstate)
+    def __init__(self, adrenaline):
+        self.adrenaline = adrenaline
+        self.size = len(adrenaline)
+        self.elapsed_ticks = np.zeros(self.size, dtype=int)
+        
+    def find(self, name):
+        return None
+        
+    def find_mod(self, name):
+        return None
+        
+        
+class BatchPState(object):
+    # Many independent scenarios on the same bar simulated in lockstep. Every
+    # piece of run state is an array with a row per scenario (cooldowns and
+    # use counts are scenarios x actions, mod timers scenarios x mods), so a
+    # decision for all of them is a handful of vector operations instead of
+    # a python loop per scenario. Scenarios can differ in their starting
+    # adrenaline, ring of vigour/ASR/prng and which actions are enabled.
+    #
+    # Without prng every scenario makes the same decisions as a PState with
+    # the same settings (see batch_greedy). Random rolls come from one numpy
+    # generator for the whole batch, or one per scenario when seed is a list
+    # (a scenario's rolls then don't depend on the rest of the batch), so
+    # prng scenarios have the same odds as a PState but not the same rolls.
+    #
+    # Only Condition pstate_checks can be batched (python functions can't be
+    # run on arrays) and mods have to be unique.
+    def __init__(self, actions, size=None, adrenaline=0, use_prng=False, use_ringofvigour=False,
+        use_ASR=False, enabled=None, seed=None):
+        if np is None:
+            raise ImportError("BatchPState requires numpy")
+            
+        # Number of scenarios, from the longest of the per scenario options
+        # when it isn't given (single values are used for every scenario)
+        if size is None:
+            size = max([len(v) for v in (adrenaline, use_prng, use_ringofvigour, use_ASR, enabled)
+                if v is not None and np.ndim(v) > 0] or [1])
+                
+        self.size = size
+        self.actions = list(actions)
+        self.names = {}
+        for i in range(0, len(self.actions)):
+            self.names.setdefault(self.actions[i].name, i)
+            
+        definitions = [a.definition for a in self.actions]
+        
+        self.cooldown = np.array([d.cooldown for d in definitions], dtype=float)
+        self.ticks = np.array([d.ticks for d in definitions], dtype=int)
+        self.min = np.array([d.min for d in definitions], dtype=float)
+        self.max = np.array([d.max for d in definitions], dtype=float)
+        self.accuracy_mod = np.array([d.accuracy_mod for d in definitions], dtype=float)
+        self.number_of_hits = np.array([d.number_of_hits for d in definitions], dtype=float)
+        self.modable = np.array([bool(d.modable) for d in definitions], dtype=bool)
+        self.always_use = np.array([d.always_use == True for d in definitions], dtype=bool)
+        self.negative_check = np.array([bool(d.negative_pstate_check) for d in definitions], dtype=bool)
+        self.has_adrenaline_change = np.array([d.adrenaline_change is not None for d in definitions], dtype=bool)
+        self.adrenaline_change = np.array([d.adrenaline_change or 0 for d in definitions])
+        self.average_values = self.normalize((self.min + self.max) / 2.0)
+        
+        # Distinct checks, each one is run once per decision for the whole batch
+        self.checks = []
+        for d in definitions:
+            if type(d.pstate_check) is Condition:
+                if d.pstate_check not in self.checks:
+                    self.checks.append(d.pstate_check)
+            elif is_pstate_check(d.pstate_check):
+                raise ValueError("BatchPState can't run the python pstate_check of {0}, use a Condition".format(d.name))
+                
+        self.check_ids = np.array(
+            [self.checks.index(d.pstate_check) if type(d.pstate_check) is Condition else -1 for d in definitions],
+            dtype=int
+        )
+        
+        # Distinct mods (by name) and the mod of each action (-1 for none)
+        self.mods = []
+        self.mod_names = {}
+        mod_ids = []
+        for d in definitions:
+            if d.mod is None:
+                mod_ids.append(-1)
+                continue
+                
+            if not d.mod.is_unqiue:
+                raise ValueError("BatchPState only supports unique mods ({0})".format(d.mod.name))
+                
+            if d.mod.name not in self.mod_names:
+                self.mod_names[d.mod.name] = len(self.mods)
+                self.mods.append(d.mod.definition)
+                
+            mod_ids.append(self.mod_names[d.mod.name])
+            
+        self.mod_ids = np.array(mod_ids, dtype=int)
+        self.mod_actions = np.flatnonzero(self.mod_ids >= 0)
+        self.multiplier = np.array([m.multiplier for m in self.mods], dtype=float)
+        self.duration = np.array([np.inf if m.duration is None else m.duration for m in self.mods], dtype=float)
+        
+        # Value per tick of every action with the mod of each mod action
+        # applied, for the mod predictions (see ValueCache.gain_terms)
+        self.gain_terms = {}
+        for i in self.mod_actions:
+            mod = self.mods[self.mod_ids[i]]
+            self.gain_terms[i] = (self.average_values + self.average_values * mod.multiplier) / self.ticks
+            
+        # Actions whose cooldown is reset along with each action's
+        self.buddies = np.zeros((len(self.actions), len(self.actions)), dtype=bool)
+        for i, d in enumerate(definitions):
+            for name in d.buddy_actions or []:
+                if name in self.names:
+                    self.buddies[i, self.names[name]] = True
+                    
+        # Run state, per scenario
+        shape = (size, len(self.actions))
+        self.last_used = np.array(np.broadcast_to([a.last_used for a in self.actions], shape), dtype=float)
+        self.times_used = np.array(np.broadcast_to([a.times_used for a in self.actions], shape), dtype=int)
+        self.total_used_value = np.array(np.broadcast_to([a.total_used_value for a in self.actions], shape), dtype=float)
+        self.enabled = np.array(np.broadcast_to(
+            [a.enabled for a in self.actions] if enabled is None else enabled, shape
+        ), dtype=bool)
+        
+        adrenaline = np.asarray(adrenaline)
+        dtype = np.result_type(adrenaline, self.adrenaline_change)
+        self.adrenaline = np.array(np.broadcast_to(adrenaline, (size,)), dtype=dtype)
+        self.gained_adrenaline = np.zeros(size, dtype=dtype)
+        self.spent_adrenaline = np.zeros(size, dtype=dtype)
+        self.excess_adrenaline = np.zeros(size, dtype=dtype)
+        
+        self.use_prng = np.array(np.broadcast_to(use_prng, (size,)), dtype=bool)
+        self.use_ringofvigour = np.array(np.broadcast_to(use_ringofvigour, (size,)), dtype=bool)
+        self.use_ASR = np.array(np.broadcast_to(use_ASR, (size,)), dtype=bool)
+        
+        # Mod timers, and the order the mods were applied in (mods are
+        # applied to values in that order, like PState.active_mods)
+        self.mod_last_used = np.zeros((size, len(self.mods)))
+        self.mod_active = np.zeros((size, len(self.mods)), dtype=bool)
+        self.mod_applied = np.zeros((size, len(self.mods)), dtype=int)
+        self.mod_sequence = 0
+        
+        self.elapsed_ticks = np.zeros(size, dtype=int)
+        self.damage = np.zeros(size)
+        self.actions_used = np.zeros(size, dtype=int)
+        self.rows = np.arange(size)
+        
+        self.seed(seed)
+        
+    def seed(self, seed=None):
+        if np.ndim(seed) > 0:
+            self.np_rng = None
+            self.row_rngs = [np.random.default_rng(s) for s in seed]
+        else:
+            self.np_rng = np.random.default_rng(seed)
+            self.row_rngs = None
+            
+    def random(self, rows, mask):
+        # Uniform [0, 1) draw for each of rows, with a generator per
+        # scenario only the rows in mask draw one
+        if self.row_rngs is None:
+            return self.np_rng.random(len(rows))
+            
+        draws = np.ones(len(rows))
+        draws[mask] = [self.row_rngs[r].random() for r in rows[mask]]
+        return draws
+        
+    @classmethod
+    def from_pstate(cls, pstate, size, **options):
+        # size copies of pstate as it is now (cooldowns, adrenaline and mods),
+        # options override its settings (i.e. use_prng=True)
+        settings = {
+            "adrenaline": pstate.adrenaline,
+            "use_prng": pstate.use_prng,
+            "use_ringofvigour": pstate.use_ringofvigour,
+            "use_ASR": pstate.use_ASR,
+            "seed": pstate.rng_seed,
+        }
+        settings.update(options)
+        
+        batch = cls(pstate.actions, size, **settings)
+        batch.gained_adrenaline[:] = pstate.gained_adrenaline
+        batch.spent_adrenaline[:] = pstate.spent_adrenaline
+        batch.excess_adrenaline[:] = pstate.excess_adrenaline
+        batch.elapsed_ticks[:] = pstate.elapsed_ticks
+        
+        for m in pstate.active_mods:
+            j = batch.find_mod(m.name)
+            if m.is_active and j is not None:
+                batch.mod_last_used[:, j] = m.last_used
+                batch.mod_active[:, j] = True
+                batch.mod_applied[:, j] = batch.mod_sequence
+                batch.mod_sequence += 1
+                
+        return batch
+        
+    def find(self, name):
+        return self.names.get(name)
+        
+    def find_mod(self, name):
+        return self.mod_names.get(name)
+        
+    def normalize(self, values):
+        # Same steps as Ability.value
+        values = values + values * self.accuracy_mod
+        values = values / self.ticks
+        return values * self.number_of_hits
+        
+    def base_values(self, rows=None):
+        # Value of every action in every scenario with the active mods
+        # applied to the modable ones, in the order they were applied. With
+        # a generator per scenario only the prng scenarios in rows (all by
+        # default) roll, the values of the rest aren't meant to be used.
+        if self.use_prng.any():
+            if self.row_rngs is None:
+                rolls = self.np_rng.uniform(self.min, self.max, self.last_used.shape)
+            else:
+                rolls = np.zeros(self.last_used.shape)
+                for r in np.flatnonzero(self.use_prng) if rows is None else rows[self.use_prng[rows]]:
+                    rolls[r] = self.row_rngs[r].uniform(self.min, self.max)
+                    
+            values = np.where(self.use_prng[:, None], self.normalize(rolls), self.average_values)
+        else:
+            values = np.repeat(self.average_values[None, :], self.size, axis=0)
+            
+        if self.mod_active.any():
+            order = np.argsort(np.where(self.mod_active, self.mod_applied, self.mod_sequence), axis=1, kind="stable")
+            
+            for rank in range(0, len(self.mods)):
+                j = order[:, rank]
+                active = self.mod_active[self.rows, j]
+                if not active.any():
+                    break
+                    
+                boosted = values + values * self.multiplier[j][:, None]
+                values = np.where(self.modable & active[:, None], boosted, values)
+                
+        return values
+        
+    def check_mask(self, pstate=None):
+        # Actions that pass their pstate_check (checked against pstate
+        # when it's given), scenarios x actions
+        pstate = self if pstate is None else pstate
+        mask = np.ones(self.last_used.shape, dtype=bool)
+        
+        for c in range(0, len(self.checks)):
+            columns = self.check_ids == c
+            mask[:, columns] = self.checks[c].batch(pstate)[:, None] ^ self.negative_check[columns]
+            
+        return mask
+        
+    def available_mask(self, live=None):
+        # Same rules as PState.get_available_actions, scenarios that aren't
+        # live have nothing available
+        ready = (self.last_used >= self.cooldown) & self.enabled
+        if live is not None:
+            ready &= live[:, None]
+            
+        available = ready & self.check_mask()
+        always_use = available & self.always_use
+        
+        return np.where(always_use.any(axis=1)[:, None], always_use, available)
+        
+    def mod_value_increase(self, i, checks=None):
+        # PState.mod_value_increase of action i for every scenario
+        mod = self.mods[self.mod_ids[i]]
+        value_increase = lambda v,m : v - (v / (1 + m))
+        window = self.ticks[i] if mod.one_time_use else mod.duration
+        in_window = (self.cooldown - self.last_used <= window) & self.modable
+        terms = self.gain_terms[i]
+        
+        if mod.one_time_use:
+            mask = in_window & (self.check_mask() if checks is None else checks)
+            best = np.where(mask, terms, 0).max(axis=1)
+            return value_increase(np.maximum(best, 0), mod.multiplier)
+            
+        view = BatchAdrenalineView((self.adrenaline + ((window - 3) / 3.0) * 8).astype(int))
+        mask = in_window & self.check_mask(view)
+        
+        # cumsum adds in bar order so the sums round like the scalar path
+        total = np.cumsum(np.where(mask, terms, 0), axis=1)[:, -1]
+        count = mask.sum(axis=1)
+        average_tick_value = np.where(count > 0, total / np.maximum(count, 1), 0)
+        
+        return value_increase(average_tick_value, mod.multiplier) * mod.duration
+        
+    def values(self, base=None):
+        # PState.value (with the mod predictions) of every action
+        values = self.base_values() if base is None else base.copy()
+        checks = None
+        
+        for i in self.mod_actions:
+            if checks is None and self.mods[self.mod_ids[i]].one_time_use:
+                checks = self.check_mask()
+            values[:, i] += self.mod_value_increase(i, checks)
+            
+        return values
+        
+    def choose(self, available, values):
+        # Greedy choice of every scenario (the action index and whether there
+        # was anything available), ties go to the first action with the
+        # lowest cooldown like PState.get_greedy_best
+        values = np.where(available, values, -np.inf)
+        best = available & (values == values.max(axis=1)[:, None])
+        choice = np.argmin(np.where(best, self.cooldown, np.inf), axis=1)
+        
+        return choice, available.any(axis=1)
+        
+    def activate(self, choice, chosen, step_values):
+        # Every on_activate effect of the chosen actions (adrenaline, mods,
+        # buddies and the used values) for the scenarios that chose one
+        rows = np.flatnonzero(chosen)
+        if len(rows) == 0:
+            return
+            
+        columns = choice[rows]
+        
+        self.last_used[rows, columns] = 0
+        self.times_used[rows, columns] += 1
+        self.actions_used[rows] += 1
+        self.damage[rows] += step_values[rows] * self.ticks[columns]
+        
+        # Same rules as adjust_adrenaline
+        change = np.where(self.has_adrenaline_change[columns], self.adrenaline_change[columns], 0)
+        change = np.where((change == -100) & self.use_ringofvigour[rows], -90, change)
+        
+        asr = (change == -15) & self.use_ASR[rows] & self.use_prng[rows]
+        if asr.any():
+            change = np.where(asr & (self.random(rows, asr) <= .1), 0, change)
+            
+        adrenaline = self.adrenaline[rows] + change
+        self.gained_adrenaline[rows] += np.where(change > 0, change, 0)
+        self.spent_adrenaline[rows] += np.where(change > 0, 0, -change)
+        self.excess_adrenaline[rows] += np.maximum(adrenaline - 100, 0)
+        self.adrenaline[rows] = np.minimum(adrenaline, 100)
+        
+        # apply_mods, a mod that's already active is renewed in place
+        mod_ids = self.mod_ids[columns]
+        applied = mod_ids >= 0
+        
+        if applied.any():
+            mod_rows, mod_ids = rows[applied], mod_ids[applied]
+            new = ~self.mod_active[mod_rows, mod_ids]
+            self.mod_applied[mod_rows[new], mod_ids[new]] = self.mod_sequence
+            self.mod_sequence += 1
+            self.mod_last_used[mod_rows, mod_ids] = 0
+            self.mod_active[mod_rows, mod_ids] = True
+            
+        # update_buddies
+        buddy_rows, buddy_columns = np.nonzero(self.buddies[columns])
+        self.last_used[rows[buddy_rows], buddy_columns] = 0
+        
+        # register_action_value, the value is taken after the action's
+        # own mod was applied
+        used_values = step_values[rows]
+        if applied.any():
+            used_values = np.where(applied, self.base_values(rows[applied])[rows, columns], used_values)
+            
+        self.total_used_value[rows, columns] += used_values
+        
+    def tick(self, ticks):
+        # Advance every scenario by its own number of ticks
+        self.last_used += ticks[:, None]
+        self.mod_last_used += ticks[:, None]
+        self.mod_active &= self.mod_last_used < self.duration
+        self.elapsed_ticks += ticks
+        
+    def summaries(self, total_ticks):
+        # pstate_summary of every scenario
+        values = self.values()
+        adrenaline_actions = self.has_adrenaline_change & (self.adrenaline_change < 0)
+        adrenaline_value = np.cumsum(np.where(adrenaline_actions, self.total_used_value, 0), axis=1)[:, -1]
+        
+        most_used = np.argmax(self.times_used, axis=1)
+        most_value = np.argmax(values * self.times_used, axis=1)
+        summaries = []
+        
+        for r in range(0, self.size):
+            total_value = self.damage[r].item()
+            spent = self.spent_adrenaline[r].item()
+            value = (values[r, most_value[r]] * self.times_used[r, most_value[r]]).item()
+            usage = np.argsort(-self.times_used[r], kind="stable")
+            
+            summaries.append({
+                "ticks": total_ticks,
+                "damage": total_value,
+                "dpt": total_value / total_ticks,
+                "most_used": (self.actions[most_used[r]].name, self.times_used[r, most_used[r]].item()),
+                "most_value": (self.actions[most_value[r]].name, (value / total_value) * 100 if total_value else 0),
+                "gained_adrenaline": self.gained_adrenaline[r].item(),
+                "spent_adrenaline": spent,
+                "excess_adrenaline": self.excess_adrenaline[r].item(),
+                "damage_per_adrenaline": adrenaline_value[r].item() / spent if spent else 0,
+                "actions_used": self.actions_used[r].item(),
+                "usage": [(self.actions[i].name, self.times_used[r, i].item()) for i in usage],
+            })
+            
+        return summaries
+        
+# greedy_value for every scenario of a BatchPState at once. Each scenario
+# runs on its own clock (actions take different numbers of ticks), the batch
+# keeps going until the last one is past `ticks`. The batch is left at the
+# end of the run, read the results from batch.summaries(ticks).
+def batch_greedy(batch, ticks):
+    clock = np.zeros(batch.size, dtype=int)
+    live = clock <= ticks
+    
+    while live.any():
+        base = batch.base_values()
+        choice, chosen = batch.choose(batch.available_mask(live), batch.values(base))
+        
+        # The value of the step is its own roll (like greedy_steps)
+        if batch.use_prng.any():
+            base = batch.base_values()
+            
+        batch.activate(choice, chosen, base[batch.rows, choice])
+        
+        # Idle scenarios tick once, finished ones stay where they are
+        step_ticks = np.where(chosen, batch.ticks[choice], 1) * live
+        batch.tick(step_ticks)
+        clock += step_ticks
+        live = clock <= ticks
+        
+    return batch
+    
+# monte_carlo_value of greedy_value on the batched engine, every trial is a
+# prng scenario of one BatchPState
+def monte_carlo_batch(pstate, ticks, trials=1000, seed=None):
+    batch = batch_greedy(BatchPState.from_pstate(pstate, trials, use_prng=True, seed=seed), ticks)
+    start = [a.times_used for a in pstate.actions]
+    
+    usage = dict(
+        (a.name, (batch.times_used[:, i] - start[i]).tolist()) for i, a in enumerate(batch.actions)
+    )
+    
+    return MonteCarloResult(
+        batch.damage.tolist(),
+        (batch.spent_adrenaline - pstate.spent_adrenaline).tolist(),
+        (batch.excess_adrenaline - pstate.excess_adrenaline).tolist(),
+        usage
+    )
+        
+def to_ticks(sec):
+    return math.ceil(sec / .6)
+
+deaths_swiftness_mod = Modifier(
+    name="Death's Swiftness",   # Name to reference the modifier by
+    multiplier=.50,             # 50% increase
+    duration=to_ticks(sec=30),  # Lasts for 30 seconds
+    one_time_use=False          # Lasts full duration, not just until next attack
+)
+
+berserk_mod = Modifier(
+    name="Berserk",
+    multiplier=1.00,
+    duration=to_ticks(sec=20),
+    one_time_use=False
+)
+
+quake_modifier = Modifier(
+    name="Quake",
+    multiplier=.04, # Roughly a 4% dmg increase (5% dmg debuff for 1 minute)
+    duration=to_ticks(sec=60),
+    one_time_use=False,
+    is_unqiue=True
+)
+
+range_2h_actions = [
+    Action("Tuska's Wraith", max=110, cooldown=to_ticks(sec=15)),
+    Action("Sacrifice", max=100, cooldown=to_ticks(sec=30)),
+    
+    # TODO: Add real dmg calculations so we can cap the 12k hits
+    Action("Shadow Tendrils", min=66, max=500, cooldown=to_ticks(sec=45),
+        adrenaline_change= -15, pstate_check=pstate_threshold_range, enabled=True),
+    
+    Action("Bombardment", max=219, cooldown=to_ticks(sec=30), 
+        adrenaline_change= -15, pstate_check=pstate_threshold_range),
+    
+    Action("Snipe", min=125.0, max=219.0, cooldown=to_ticks(sec=10), ticks=4),
+    
+    Action("Piercing Shot", max=94, cooldown=to_ticks(sec=3), always_use=True),
+    
+    Action("Binding Shot", max=100.0, cooldown=to_ticks(sec=15)),
+    
+    Action("Snapshot", min=(100+100), max=(210+120), cooldown=to_ticks(sec=20),
+        adrenaline_change= -15, pstate_check=pstate_threshold_range),
+    
+    Action("Dazing Shot", max=157, cooldown=to_ticks(sec=5)),
+    
+    Action("Fragmentation Shot", min=100, max=188, cooldown=to_ticks(sec=15), modable=False),
+    
+    Action("Rapid Fire", max=94, cooldown=to_ticks(sec=20), number_of_hits=8, ticks=7,
+        adrenaline_change= -15, pstate_check=pstate_threshold_range),
+    
+    Action("Corruption Shot", min=19.8, max=60, cooldown=to_ticks(sec=15),
+        number_of_hits=5, modable=False),
+    
+    Action("Death's Swiftness", min=10, max=20, cooldown=to_ticks(sec=60), number_of_hits=15,
+        adrenaline_change= -100, pstate_check=pstate_ultimate, modable=False,
+        mod=deaths_swiftness_mod
+    ),
+]
+
+melee_2h_actions = [
+    Action("Tuska's Wraith", max=110, cooldown=to_ticks(sec=15)),
+    Action("Sacrifice", max=100, cooldown=to_ticks(sec=30)),
+
+    Action("Cleave", max=188, cooldown=to_ticks(sec=7)),
+    
+    # Enable this to test sweaty swaps for decimate
+    Action("Decimate", max=188, cooldown=to_ticks(sec=7), enabled=False,
+        always_use=True, pstate_check=pstate_ultimate, negative_pstate_check=True),
+    
+    Action("Fury", max=157, cooldown=to_ticks(sec=5)),
+    
+    Action("Sever", max=188, cooldown=to_ticks(sec=15)),
+    
+    Action("Slice", min=30, max=120, cooldown=to_ticks(sec=3)),
+    
+    Action("Smash", max=125, cooldown=to_ticks(sec=10)),
+    
+    Action("Hurricane", min=(66+84), max=(219+161), cooldown=to_ticks(sec=20),
+        adrenaline_change= -15, pstate_check=pstate_threshold_melee),
+        
+    Action("Bersker", max=0, cooldown=to_ticks(sec=60), adrenaline_change= -100,
+        pstate_check=pstate_ultimate, mod=berserk_mod, modable=False),
+        
+    Action("Dismember", max=188, cooldown=to_ticks(sec=6), modable=False),
+    
+    Action("Assault", max=219, cooldown=to_ticks(sec=30), number_of_hits=4,
+        adrenaline_change= -15, ticks=6, pstate_check=pstate_threshold_melee),
+        
+    Action("Quake", max=219, cooldown=to_ticks(20), mod=quake_modifier,
+        adrenaline_change= -15, pstate_check=pstate_threshold_melee),
+        
+    Action("Slaughter(Still)", min=100, max=250, cooldown=to_ticks(sec=30),
+        adrenaline_change= -15, pstate_check=pstate_threshold_melee,
+        buddy_actions=["Slaughter(Move)"], modable=False),
+        
+    Action("Slaughter(Move)", min=100*3, max=250*3, cooldown=to_ticks(sec=30),
+        adrenaline_change= -15, pstate_check=pstate_threshold_melee,
+        buddy_actions=["Slaughter(Still)"], modable=False, enabled=False),
+]
+
+
+class ActionLoader(object):
+    # Loads action definitions from an ability database ({style: [action
+    # dicts]}, cooldowns in seconds), indexed by style and equipment.
+    # The parsed and indexed database is cached in a pickle next to the
+    # file (or in cache_dir), keyed by the file's mtime/size and then its
+    # content hash, so warm loads skip parsing. get_actions always returns
+    # new Action instances, sharing one ActionDefinition per database entry.
+    CACHE_VERSION = 1
+    ANY_EQUIPMENT = ("any",)
+    
+    def __init__(self, action_file, cache=True, cache_dir=None):
+        self.action_file = action_file
+        self.cache_file = None
+        
+        if cache:
+            directory = os.path.dirname(os.path.abspath(action_file)) if cache_dir is None else cache_dir
+            self.cache_file = os.path.join(directory, os.path.basename(action_file) + ".cache")
+            
+        self.from_cache = False
+        self.load()
+        
+    def load(self):
+        stat = os.stat(self.action_file)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.read_cache()
+        
+        if cached is not None and cached["key"] == key:
+            self.from_cache = True
+            self.use(cached)
+            return
+            
+        with open(self.action_file, "rb") as f:
+            content = f.read()
+            
+        digest = hashlib.sha1(content).hexdigest()
+        
+        if cached is not None and cached["hash"] == digest:
+            # Touched but not changed
+            cached["key"] = key
+            self.from_cache = True
+        else:
+            cached = {
+                "version": ActionLoader.CACHE_VERSION,
+                "key": key,
+                "hash": digest,
+                "styles": ActionLoader.compile(ActionLoader.parse(content.decode("utf-8"))),
+            }
+            self.from_cache = False
+            
+        self.use(cached)
+        self.write_cache(cached)
+        
+    @staticmethod
+    def parse(text):
+        # Older databases are python literals (single quotes, True/None)
+        try:
+            return json.loads(text)
+        except ValueError:
+            return ast.literal_eval(text)
+            
+    @staticmethod
+    def compile(action_data):
+        # Cooldowns converted to ticks once, on copies of the definitions
+        styles = {}
+        
+        for style, actions in action_data.items():
+            styles[style] = []
+            
+            for action in actions:
+                action = dict(action)
+                
+                if action.get("cooldown", None) is not None:
+                    action["cooldown"] = to_ticks(sec=action["cooldown"])
+                    
+                styles[style].append(action)
+                
+        return styles
+        
+    def use(self, cached):
+        self.styles = cached["styles"]
+        self.cache_key = cached["key"]
+        self.shared = {}
+        
+        # (style, equipment) -> indexes of the actions for that equipment,
+        # (style, ANY_EQUIPMENT) for the actions without an equipment key
+        # (they match any equipment filter)
+        self.index = {}
+        for style, actions in self.styles.items():
+            for i in range(0, len(actions)):
+                equipment = actions[i]["equipment"] if "equipment" in actions[i] else ActionLoader.ANY_EQUIPMENT
+                self.index.setdefault((style, equipment), []).append(i)
+                
+    def read_cache(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
+            
+        try:
+            with open(self.cache_file, "rb") as f:
+                cached = pickle.load(f)
+        except Exception:
+            return None
+            
+        if not isinstance(cached, dict) or cached.get("version") != ActionLoader.CACHE_VERSION:
+            return None
+            
+        return cached
+        
+    def write_cache(self, cached):
+        if self.cache_file is None:
+            return
+            
+        # Written to a temporary file first so a reader never sees half
+        # a cache (sweep workers can load at the same time)
+        temp_file = "{0}.{1}.tmp".format(self.cache_file, os.getpid())
+        
+        try:
+            with open(temp_file, "wb") as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, self.cache_file)
+        except OSError:
+            # Read-only location, we just don't get a warm load next time
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+                
+    @property
+    def action_data(self):
+        return self.styles
+        
+    def select(self, styles=None, filter=None):
+        # (style, index) of every matching action
+        selected = []
+        filter = {} if filter is None else dict(filter)
+        by_equipment = "equipment" in filter
+        equipment = filter.pop("equipment", None)
+        
+        for style in self.styles.keys():
+            if styles is not None and style not in styles:
+                continue
+                
+            actions = self.styles[style]
+            
+            if not by_equipment:
+                indexes = range(0, len(actions))
+            else:
+                # Keep the file order when merging the actions without equipment
+                indexes = sorted(
+                    self.index.get((style, equipment), []) + self.index.get((style, ActionLoader.ANY_EQUIPMENT), [])
+                )
+                
+            for i in indexes:
+                action = actions[i]
+                
+                # A filter key only rules out actions that have the key
+                if all(k not in action or action[k] == v for k, v in filter.items()):
+                    selected.append((style, i))
+                    
+        return selected
+        
+    def get_definitions(self, styles=None, filter=None):
+        return [self.styles[style][i] for style, i in self.select(styles, filter)]
+        
+    def get_actions(self, styles=None, filter=None):
+        actions = []
+        
+        for key in self.select(styles, filter):
+            if key not in self.shared:
+                self.shared[key] = Action.from_definition(self.styles[key[0]][key[1]]).definition
+            actions.append(Action.new(self.shared[key]))
+            
+        return actions
+
+##############################################################
+
+action_bars = {
+    "melee_2h": melee_2h_actions,
+    "range_2h": range_2h_actions,
+}
+
+# Optimizers that can be summarized step by step without keeping the rotation
+streaming_optimizers = {
+    "greedy": greedy_steps,
+}
+
+optimizers = {
+    "greedy": greedy_value,
+    "beam": beam_search_value,
+    "exact": exact_value,
+    "mcts": mcts_value,
+    "priority": priority_search_value,
+}
+
+# PState options a sweep grid can contain, anything else in the grid
+# is an action name that gets enabled/disabled
+SWEEP_OPTIONS = ["adrenaline", "use_ringofvigour", "use_ASR", "use_prng", "seed"]
+
+# Optimizers whose search is random unless they're given a seed
+randomized_optimizers = ["mcts", "priority"]
+
+# Optimizer results on disk, one file per configuration named by the hash
+# of everything that decides the result (see ResultCache.key). Entries are
+# zlib compressed pickles of the summary and the rotation (as action names)
+# written to a temporary file and renamed into place, so processes sharing
+# the directory only ever see whole entries. Hits touch the entry, and once
+# the directory is over max_bytes the least recently used entries go.
+#
+# The size of the directory is a running total (listed once, on the first
+# put) so puts don't stat every entry. Entries written by other processes
+# are only counted the next time the directory is listed, which is whenever
+# this process' total goes over max_bytes.
+class ResultCache(object):
+    VERSION = 2
+    SUFFIX = ".result"
+    
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = None
+        
+        os.makedirs(directory, exist_ok=True)
+        
+    @staticmethod
+    def key(pstate, ticks, optimizer="greedy", optimizer_kwargs=None):
+        # Hash of the actions (definitions and starting timers), the pstate
+        # options and run state (active mods, clock, adrenaline counters and
+        # where the rolls are up to), ticks and the optimizer, None when the
+        # result can't be reproduced (prng or a randomized optimizer without
+        # a seed, or a wall-clock budget) or the key can't tell the run apart
+        # from another (python checks other than registered ones go in by
+        # name only, on_activate hooks not at all)
+        optimizer_kwargs = optimizer_kwargs or {}
+        
+        if pstate.use_prng and pstate.rng_seed is None:
+            return None
+        if any(inspect.isfunction(a.pstate_check) and pstate_checks.get(a.pstate_check.__name__) is not a.pstate_check
+            for a in pstate.actions):
+            return None
+        if tuple(pstate.on_activate) != default_on_activate:
+            return None
+        if optimizer in randomized_optimizers and optimizer_kwargs.get("seed") is None:
+            return None
+        if optimizer_kwargs.get("seconds") is not None:
+            return None
+            
+        config = {
+            "version": ResultCache.VERSION,
+            "actions": [(a.to_definition(), a.last_used, a.times_used) for a in pstate.actions],
+            "options": {
+                "adrenaline": pstate.adrenaline,
+                "use_ringofvigour": pstate.use_ringofvigour,
+                "use_ASR": pstate.use_ASR,
+                "use_prng": pstate.use_prng,
+                "seed": pstate.rng_seed,
+            },
+            "state": {
+                "active_mods": [(m.to_definition(), m.last_used, m.is_active) for m in pstate.active_mods],
+                "elapsed_ticks": pstate.elapsed_ticks,
+                "gained_adrenaline": pstate.gained_adrenaline,
+                "spent_adrenaline": pstate.spent_adrenaline,
+                "excess_adrenaline": pstate.excess_adrenaline,
+                "rng": ResultCache.rng_state(pstate) if pstate.use_prng else None,
+            },
+            "engine": type(pstate).__name__,
+            "ticks": ticks,
+            "optimizer": optimizer,
+            "optimizer_kwargs": optimizer_kwargs,
+        }
+        
+        text = json.dumps(config, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+        
+    @staticmethod
+    def rng_state(pstate):
+        # Digest of the generator states, a seeded pstate that already
+        # rolled isn't the same as a fresh one
+        state = [pstate.rng.getstate()]
+        if getattr(pstate, "np_rng", None) is not None:
+            state.append(pstate.np_rng.bit_generator.state)
+            
+        return hashlib.sha256(repr(state).encode("utf-8")).hexdigest()
+        
+    def path(self, key):
+        return os.path.join(self.directory, key + ResultCache.SUFFIX)
+        
+    def get(self, key):
+        path = self.path(key)
+        
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            # Missing, evicted by another process or half written by an
+            # older version, either way it's a miss
+            self.misses += 1
+            return None
+            
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted since the read, the entry is still good
+            pass
+            
+        self.hits += 1
+        return entry
+        
+    def put(self, key, entry):
+        path = self.path(key)
+        temp_file = "{0}.{1}.tmp".format(path, os.getpid())
+        data = zlib.compress(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+        
+        if self.bytes is None:
+            self.bytes = self.size()
+            
+        try:
+            with open(temp_file, "wb") as f:
+                f.write(data)
+            replaced = os.stat(path).st_size if os.path.exists(path) else 0
+            os.replace(temp_file, path)
+        except OSError:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            return
+            
+        self.bytes += len(data) - replaced
+        if self.bytes > self.max_bytes:
+            self.evict()
+        
+    def entries(self):
+        # (mtime, size, path) of every entry
+        entries = []
+        
+        for name in os.listdir(self.directory):
+            if not name.endswith(ResultCache.SUFFIX):
+                continue
+                
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+                
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+            
+        return entries
+        
+    def size(self):
+        return sum(e[1] for e in self.entries())
+        
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+                
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process got to it first
+                pass
+                
+            total -= size
+            
+        self.bytes = total
+            
+    def clear(self):
+        for mtime, size, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+                
+        self.bytes = 0
+                
+def encode_rotation(rotation):
+    return [(getattr(a["action"], "name", None), a["value"], a["adrenaline"], a["mods"]) for a in rotation]
+    
+def decode_rotation(pstate, records):
+    # Cached rotation back in greedy_value's format, on pstate's actions
+    rotation = []
+    
+    for name, value, adrenaline, mods in records:
+        i = None if name is None else Action.find_by_name(name, pstate.actions)
+        rotation.append({
+            "action": None if i is None else pstate.actions[i],
+            "value": value,
+            "adrenaline": adrenaline,
+            "mods": mods
+        })
+        
+    return rotation
+    
+# Runs the optimizer on pstate (through cache when there is one) and returns
+# (rotation, summary). Without keep_rotation a streaming optimizer is used
+# when there is one and the rotation is None. On a cache hit pstate itself
+# isn't advanced, everything about the run is in the summary.
+def cached_optimize(pstate, ticks, optimizer="greedy", optimizer_kwargs=None, cache=None, keep_rotation=True):
+    key = None if cache is None else ResultCache.key(pstate, ticks, optimizer, optimizer_kwargs)
+    
+    if key is not None:
+        entry = cache.get(key)
+        
+        if entry is not None and (entry["rotation"] is not None or not keep_rotation):
+            rotation = None if entry["rotation"] is None else decode_rotation(pstate, entry["rotation"])
+            return rotation, dict(entry["summary"])
+            
+    if not keep_rotation and optimizer in streaming_optimizers:
+        steps = streaming_optimizers[optimizer](pstate, ticks, **(optimizer_kwargs or {}))
+        rotation = None
+        summary = RotationStats(pstate).consume(steps).summary(ticks)
+    else:
+        rotation = optimizers[optimizer](pstate, ticks, **(optimizer_kwargs or {}))
+        summary = rotation_summary(pstate, rotation, ticks)
+        
+    if key is not None:
+        cache.put(key, {
+            "summary": summary,
+            "rotation": None if rotation is None else encode_rotation(rotation),
+        })
+        
+    return rotation, summary
+
+def sweep_grid(grid):
+    # Expand {"use_ASR": [True, False], "Decimate": [True, False], ...}
+    # into one dict per combination
+    keys = sorted(grid.keys())
+    
+    for values in itertools.product(*[grid[k] for k in keys]):
+        yield dict(zip(keys, values))
+
+# The definitions are sent to each worker once (pool initializer)
+# and every cell only sends its settings
+sweep_definitions = None
+
+def init_sweep_worker(definitions):
+    global sweep_definitions
+    sweep_definitions = definitions
+
+# One ResultCache per directory for every cell a process runs, so its size
+# is only listed once
+sweep_caches = {}
+
+def sweep_cache(directory):
+    if directory not in sweep_caches:
+        sweep_caches[directory] = ResultCache(directory)
+        
+    return sweep_caches[directory]
+
+def sweep_options(settings, actions):
+    # PState options of a cell, the actions it names are enabled/disabled
+    options = {}
+    
+    for k in settings:
+        if k in SWEEP_OPTIONS:
+            options[k] = settings[k]
+        else:
+            i = Action.find_by_name(k, actions)
+            if i is None:
+                raise ValueError("Unknown action in sweep grid: {0}".format(k))
+            actions[i].enabled = settings[k]
+            
+    return options
+
+def run_sweep_cell(settings, ticks, optimizer="greedy", optimizer_kwargs=None, definitions=None, cache_dir=None):
+    definitions = sweep_definitions if definitions is None else definitions
+    actions = [Action.from_definition(d) for d in definitions]
+    options = sweep_options(settings, actions)
+            
+    pstate = PState(actions, **options)
+    cache = None if cache_dir is None else sweep_cache(cache_dir)
+    
+    rotation, summary = cached_optimize(pstate, ticks, optimizer, optimizer_kwargs, cache, keep_rotation=False)
+        
+    summary["settings"] = settings
+    return summary
+
+# Greedy summaries of every cell from one BatchPState (each cell with its
+# own generator from its seed, numpy rolls aren't the ones a PState with the
+# same seed gets). Cached under their own key since prng results differ from
+# run_sweep_cell's.
+def run_sweep_batch(cells, ticks, definitions, cache_dir=None):
+    cache = None if cache_dir is None else ResultCache(cache_dir)
+    results = [None] * len(cells)
+    keys = [None] * len(cells)
+    missing = []
+    enabled = []
+    options = []
+    
+    for k, settings in enumerate(cells):
+        actions = [Action.from_definition(d) for d in definitions]
+        cell_options = sweep_options(settings, actions)
+        
+        if cache is not None:
+            keys[k] = ResultCache.key(
+                PState(actions, use_value_cache=False, **cell_options), ticks, "greedy", {"batched": True}
+            )
+            entry = None if keys[k] is None else cache.get(keys[k])
+            
+            if entry is not None:
+                results[k] = dict(entry["summary"])
+                continue
+                
+        missing.append(k)
+        enabled.append([a.enabled for a in actions])
+        options.append(cell_options)
+        
+    if len(missing) > 0:
+        batch = BatchPState(
+            [Action.from_definition(d) for d in definitions], size=len(missing),
+            adrenaline=[o.get("adrenaline", 0) for o in options],
+            use_prng=[o.get("use_prng", False) for o in options],
+            use_ringofvigour=[o.get("use_ringofvigour", False) for o in options],
+            use_ASR=[o.get("use_ASR", False) for o in options],
+            enabled=enabled, seed=[o.get("seed") for o in options]
+        )
+        
+        for k, summary in zip(missing, batch_greedy(batch, ticks).summaries(ticks)):
+            results[k] = summary
+            
+            if keys[k] is not None:
+                cache.put(keys[k], {"summary": summary, "rotation": None})
+                
+    for k in range(0, len(cells)):
+        results[k]["settings"] = cells[k]
+        
+    return results
+
+# Runs the optimizer for every combination in the grid across a process pool
+# and returns the summaries ranked by total damage (best first). With a
+# cache_dir (see ResultCache) only the cells that aren't cached are run.
+# batched runs every (greedy) cell together on a BatchPState instead.
+def sweep(actions, grid, ticks, optimizer="greedy", optimizer_kwargs=None, processes=None, cache_dir=None,
+    batched=False):
+    definitions = [a.to_definition() for a in actions]
+    cells = list(sweep_grid(grid))
+    
+    if batched:
+        if optimizer != "greedy":
+            raise ValueError("Only the greedy optimizer can be batched, not {0}".format(optimizer))
+        results = run_sweep_batch(cells, ticks, definitions, cache_dir)
+    elif processes == 1:
+        results = [run_sweep_cell(c, ticks, optimizer, optimizer_kwargs, definitions, cache_dir) for c in cells]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, initializer=init_sweep_worker, initargs=(definitions,)
+        ) as pool:
+            futures = [pool.submit(run_sweep_cell, c, ticks, optimizer, optimizer_kwargs, None, cache_dir) for c in cells]
+            results = [f.result() for f in futures]
+            
+    return sorted(results, key=lambda r: r["damage"], reverse=True)
+
+def format_settings(settings):
+    return ", ".join("{0}={1}".format(k, settings[k]) for k in sorted(settings.keys()))
+
+def print_sweep(results, top=None):
+    print("{0:>4} | {1:>10} | {2:>7} | {3:>6} | {4:>6} | {5:>6} | {6:>8} | {7:25} | {8}".format(
+        "Rank", "Damage", "Dpt", "Gained", "Spent", "Wasted", "Dmg/Adr", "Most used", "Settings"
+    ))
+    
+    for rank, r in enumerate(results[:top]):
+        print("{0:>4} | {1:>10.2f} | {2:>7.2f} | {3:>6} | {4:>6} | {5:>6} | {6:>8.2f} | {7:25} | {8}".format(
+            rank + 1, r["damage"], r["dpt"], r["gained_adrenaline"], r["spent_adrenaline"],
+            r["excess_adrenaline"], r["damage_per_adrenaline"],
+            "{0} ({1}x)".format(*r["most_used"]), format_settings(r["settings"])
+        ))
+        
+def on_off(value):
+    if value.lower() in ("on", "true", "yes", "1"):
+        return True
+    if value.lower() in ("off", "false", "no", "0"):
+        return False
+    raise argparse.ArgumentTypeError("expected on/off, got {0}".format(value))
+
+def sweep_main(args):
+    grid = {
+        "adrenaline": args.adrenaline,
+        "use_ringofvigour": args.ring,
+        "use_ASR": args.asr,
+        "use_prng": args.prng,
+    }
+    
+    if args.seed is not None:
+        grid["seed"] = args.seed
+    
+    for name in args.toggle:
+        grid[name] = [True, False]
+    
+    results = sweep(
+        action_bars[args.bar], grid, to_ticks(sec=args.seconds),
+        optimizer=args.optimizer, processes=args.processes, cache_dir=args.cache,
+        batched=args.batched
+    )
+    
+    print_sweep(results, top=args.top)
+
+# Worker mode (python optimizer.py serve). Requests are JSON objects, one
+# per line, on stdin or a unix socket, answered with one JSON line each:
+#
+#   {"id": 1, "command": "rotation", "bar": "melee_2h", "seconds": 20, "adrenaline": 73}
+#   {"id": 1, "ok": true, "result": {"summary": {...}, "rotation": [...]}}
+#
+# Commands (options default to adrenaline 0, ring on, ASR/prng off):
+#   rotation   summary (and action names) from greedy/beam/exact/steady
+#              ("optimizer"), "rotation": false leaves the names out
+#   evaluate   evaluate_rotations for "rotations" (lists of names)
+#   sweep      sweep over "grid", the cells are spread over the pool
+#   info       worker pid, request count and cached values
+#
+# Actions come from "bar" (action_bars) or, when serving with --abilities,
+# "styles"/"filter" for ActionLoader. Every request is run on the process
+# pool as soon as it arrives, so responses can come back out of order (match
+# them up by id). Each pool process keeps the definitions and a template
+# pstate per action set, requests run on a branch of the template so the
+# value caches stay warm between requests.
+class OptimizerWorker(object):
+    def __init__(self, abilities=None):
+        self.loader = None if abilities is None else ActionLoader(abilities)
+        self.definitions = {}
+        self.templates = {}
+        self.requests = 0
+        
+    def action_set(self, request):
+        # Key and definitions of the actions a request asks for
+        if "bar" in request or self.loader is None:
+            key = request.get("bar", "melee_2h")
+            
+            if key not in action_bars:
+                raise ValueError("Unknown bar: {0}".format(key))
+        else:
+            key = json.dumps([request.get("styles"), request.get("filter")], sort_keys=True)
+            
+        if key not in self.definitions:
+            if key in action_bars:
+                self.definitions[key] = [a.to_definition() for a in action_bars[key]]
+            else:
+                self.definitions[key] = self.loader.get_definitions(request.get("styles"), request.get("filter"))
+                
+        return key, self.definitions[key]
+        
+    def new_pstate(self, request):
+        key, definitions = self.action_set(request)
+        template = self.templates.get(key)
+        
+        if template is None:
+            template = self.templates[key] = PState([Action.from_definition(d) for d in definitions])
+            
+        pstate = template.branch()
+        pstate.adrenaline = request.get("adrenaline", 0)
+        pstate.use_ringofvigour = request.get("ring", True)
+        pstate.use_ASR = request.get("asr", False)
+        pstate.use_prng = request.get("prng", False)
+        pstate.seed(request.get("seed"))
+        
+        for name, enabled in request.get("enabled", {}).items():
+            i = Action.find_by_name(name, pstate.actions)
+            if i is None:
+                raise ValueError("Unknown action: {0}".format(name))
+            pstate.actions[i].enabled = enabled
+            
+        return pstate
+        
+    def ticks(self, request):
+        if "ticks" in request:
+            return int(request["ticks"])
+        return to_ticks(sec=request.get("seconds", 60))
+        
+    def handle(self, request):
+        self.requests += 1
+        command = request.get("command", "rotation")
+        
+        if command == "rotation":
+            return self.rotation(request)
+        if command == "evaluate":
+            return evaluate_rotations(self.new_pstate(request), request["rotations"])
+        if command == "sweep_cell":
+            return self.sweep_cell(request)
+        if command == "info":
+            return self.info()
+            
+        raise ValueError("Unknown command: {0}".format(command))
+        
+    def rotation(self, request):
+        pstate = self.new_pstate(request)
+        ticks = self.ticks(request)
+        optimizer = request.get("optimizer", "greedy")
+        
+        if optimizer == "steady":
+            stats = steady_state_value(pstate, ticks)
+            result = {"summary": stats.summary(ticks), "cycle": None}
+            
+            if stats.cycle is not None:
+                result["cycle"] = {
+                    "start": stats.cycle.start, "ticks": stats.cycle.ticks,
+                    "steps": stats.cycle.steps, "repeats": stats.cycle.repeats
+                }
+            return result
+            
+        if optimizer not in optimizers:
+            raise ValueError("Unknown optimizer: {0}".format(optimizer))
+            
+        rotation = optimizers[optimizer](pstate, ticks, **request.get("optimizer_kwargs", {}))
+        result = {"summary": rotation_summary(pstate, rotation, ticks)}
+        
+        if request.get("rotation", True):
+            result["rotation"] = [getattr(a["action"], "name", None) for a in rotation]
+            
+        return result
+        
+    def sweep_cell(self, request):
+        key, definitions = self.action_set(request)
+        return run_sweep_cell(request["settings"], self.ticks(request), request.get("optimizer", "greedy"),
+            request.get("optimizer_kwargs"), definitions)
+            
+    def info(self):
+        caches = [t.value_cache for t in self.templates.values() if t.value_cache is not None]
+        
+        return {
+            "pid": os.getpid(),
+            "requests": self.requests,
+            "action_sets": sorted(self.templates.keys()),
+            "value_cache_entries": sum(c.size for c in caches),
+        }
+
+serve_worker = None
+
+def init_serve_worker(abilities=None):
+    global serve_worker
+    serve_worker = OptimizerWorker(abilities)
+    
+def serve_request(request):
+    if serve_worker is None:
+        init_serve_worker()
+    return serve_worker.handle(request)
+    
+class OptimizerServer(object):
+    # Reads request lines, runs them on the pool and writes the responses.
+    # processes=0 runs everything on a single thread in this process.
+    def __init__(self, processes=None, abilities=None):
+        if processes == 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, initializer=init_serve_worker, initargs=(abilities,)
+            )
+        else:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes, initializer=init_serve_worker, initargs=(abilities,)
+            )
+            
+    def close(self):
+        self.executor.shutdown()
+        
+    async def run(self, request):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, serve_request, request)
+        
+    async def sweep(self, request):
+        cells = list(sweep_grid(request.get("grid", {})))
+        results = await asyncio.gather(*[
+            self.run(dict(request, command="sweep_cell", settings=c)) for c in cells
+        ])
+        
+        results = sorted(results, key=lambda r: r["damage"], reverse=True)
+        return results if request.get("top") is None else results[:request["top"]]
+        
+    async def respond(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"id": None, "ok": False, "error": "Invalid request: {0}".format(e)}
+            
+        if not isinstance(request, dict):
+            return {"id": None, "ok": False, "error": "Invalid request: expected a JSON object"}
+            
+        try:
+            if request.get("command") == "sweep":
+                result = await self.sweep(request)
+            else:
+                result = await self.run(request)
+        except Exception as e:
+            return {"id": request.get("id"), "ok": False, "error": "{0}: {1}".format(type(e).__name__, e)}
+            
+        return {"id": request.get("id"), "ok": True, "result": result}
+        
+    async def serve_lines(self, readline, write):
+        # Every request line gets its own task, waits for the ones still
+        # running once the input ends
+        tasks = set()
+        
+        async def answer(line):
+            await write(json.dumps(await self.respond(line)) + "\n")
+            
+        while True:
+            line = await readline()
+            if not line:
+                break
+                
+            if len(line.strip()) == 0:
+                continue
+                
+            task = asyncio.ensure_future(answer(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks)
+            
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        
+        async def readline():
+            return await loop.run_in_executor(None, sys.stdin.readline)
+            
+        async def write(text):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            
+        await self.serve_lines(readline, write)
+        
+    async def serve_socket(self, path):
+        async def connection(reader, writer):
+            async def write(text):
+                writer.write(text.encode("utf-8"))
+                await writer.drain()
+                
+            try:
+                await self.serve_lines(reader.readline, write)
+            finally:
+                writer.close()
+                
+        # A socket file left over from an old server would make the bind fail
+        if os.path.exists(path):
+            os.remove(path)
+            
+        server = await asyncio.start_unix_server(connection, path=path)
+        
+        # Stop on SIGTERM too, so the socket file gets cleaned up
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+def serve_main(args):
+    server = OptimizerServer(processes=args.processes, abilities=args.abilities)
+    
+    try:
+        if args.socket is None:
+            asyncio.run(server.serve_stdio())
+        else:
+            asyncio.run(server.serve_socket(args.socket))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        server.close()
+
+def print_rotation(rotation):
+    current_tick = 1
+    
+    for a in rotation:
+        print("{0:3} [{1:3}%] | {4:3.2f}% dpt | {2} ({3}) {5}".format(
+            current_tick, a["adrenaline"], getattr(a["action"], "name", "SKIP"),
+            getattr(a["action"], "ticks", 1), a["value"], a["mods"]
+        ))
+        current_tick += getattr(a["action"], "ticks", 1)
+        
+def exact_main(args):
+    ticks = to_ticks(sec=args.seconds)
+    
+    def new_pstate():
+        return PState(copy.deepcopy(action_bars[args.bar]), adrenaline=args.adrenaline,
+            use_ringofvigour=args.ring)
+            
+    greedy = get_total(greedy_value(new_pstate(), ticks))
+    stats = {}
+    rotation = exact_value(new_pstate(), ticks, table_size=args.table_size, stats=stats)
+    exact = get_total(rotation)
+    
+    print_rotation(rotation)
+    print()
+    print("| Greedy Total: {0:.2f}% ability dmg".format(greedy))
+    print("| Exact Total:  {0:.2f}% ability dmg ({1:+.2f}%)".format(
+        exact, 100.0 * (exact - greedy) / greedy if greedy else 0.0
+    ))
+    print("| Nodes: {0} expanded, {1} pruned".format(stats["nodes"], stats["pruned"]))
+    print("| Table: {0} entries, {1:.1f}% hit rate".format(stats["table_size"], 100.0 * stats["hit_rate"]))
+
+def mcts_main(args):
+    ticks = to_ticks(sec=args.seconds)
+    
+    def new_pstate():
+        return PState(copy.deepcopy(action_bars[args.bar]), adrenaline=args.adrenaline,
+            use_ringofvigour=args.ring, use_prng=args.prng, seed=args.seed)
+            
+    greedy = get_total(greedy_value(new_pstate(), ticks))
+    stats = {}
+    rotation = mcts_value(new_pstate(), ticks, iterations=args.iterations, seconds=args.budget,
+        processes=args.processes, seed=args.seed, exploration=args.exploration, stats=stats)
+    total = get_total(rotation)
+    
+    print_rotation(rotation)
+    print()
+    print("| Greedy Total: {0:.2f}% ability dmg".format(greedy))
+    print("| MCTS Total:   {0:.2f}% ability dmg ({1:+.2f}%)".format(
+        total, 100.0 * (total - greedy) / greedy if greedy else 0.0
+    ))
+    print("| Search: {0} iterations, {1} nodes, {2} searches".format(
+        stats["iterations"], stats["nodes"], stats["searches"]
+    ))
+
+def priority_main(args):
+    ticks = to_ticks(sec=args.seconds)
+    
+    def new_pstate():
+        return PState(copy.deepcopy(action_bars[args.bar]), adrenaline=args.adrenaline,
+            use_ringofvigour=args.ring)
+            
+    greedy = get_total(greedy_value(new_pstate(), ticks))
+    stats = {}
+    rotation = priority_search_value(new_pstate(), ticks, generations=args.generations,
+        population=args.population, processes=args.processes, seed=args.seed, stats=stats)
+    total = get_total(rotation)
+    
+    print("Priority list:")
+    for name, gate in zip(stats["policy"].order, stats["policy"].gates):
+        print("| {0:25} {1}".format(name, "" if gate == 0 else "(adrenaline >= {0})".format(gate)))
+        
+    print()
+    print("| Greedy Total:   {0:.2f}% ability dmg".format(greedy))
+    print("| Priority Total: {0:.2f}% ability dmg ({1:+.2f}%)".format(
+        total, 100.0 * (total - greedy) / greedy if greedy else 0.0
+    ))
+    print("| Search: {0} generations, {1} evaluations, {2} cached, {3} cut short".format(
+        stats["generations"], stats["evaluations"], stats["cache_hits"], stats["pruned"]
+    ))
+
+def steady_main(args):
+    ticks = to_ticks(sec=args.seconds)
+    pstate = PState(copy.deepcopy(action_bars[args.bar]), adrenaline=args.adrenaline,
+        use_ringofvigour=args.ring)
+    
+    stats = steady_state_value(pstate, ticks, event_driven=args.event_driven)
+    summary = stats.summary(ticks)
+    
+    print("| Execution Ticks: {0}".format(ticks))
+    print("| Rotation Total:  {0:.2f}% ability dmg".format(summary["damage"]))
+    print("| Average Action:  {0:.2f}% dpt".format(summary["dpt"]))
+    
+    if stats.cycle is None:
+        print("| No cycle found, simulated every tick")
+    else:
+        print("| Cycle: starts on tick {0}, {1} ticks ({2} decisions), {3} cycles extrapolated".format(
+            stats.cycle.start, stats.cycle.ticks, stats.cycle.steps, stats.cycle.repeats
+        ))
+        
+    print("| Adrenaline: {0} gained, {1} spent, {2} wasted".format(
+        summary["gained_adrenaline"], summary["spent_adrenaline"], summary["excess_adrenaline"]
+    ))
+    print()
+    
+    print("Usage by action ({0} actions):".format(summary["actions_used"]))
+    for name, times_used in summary["usage"]:
+        print("| {0:25} ({1}x)".format(name, times_used))
+
+def sensitivity_main(args):
+    ticks = to_ticks(sec=args.seconds)
+    pstate = PState(copy.deepcopy(action_bars[args.bar]), adrenaline=args.adrenaline,
+        use_ringofvigour=args.ring)
+    
+    analysis = SensitivityAnalysis(pstate, ticks, interval=args.interval)
+    results = analysis.run(step=args.step)
+    
+    print("| Execution Ticks: {0}".format(ticks))
+    print("| Rotation Total:  {0:.2f}% ability dmg".format(analysis.damage))
+    print("| Nudge:           +{0:.0f}% of each parameter".format(args.step * 100))
+    print()
+    
+    print("{0:32} | {1:>9} | {2:>9} | {3:>10} | {4:>10} | {5}".format(
+        "Parameter", "Value", "Nudged", "Dmg change", "Per unit", "Simulated"
+    ))
+    
+    for r in results[:args.top]:
+        print("{0:32} | {1:>9.3f} | {2:>9.3f} | {3:>10.2f} | {4:>10.2f} | {5}/{6}".format(
+            "{0} {1}".format(r["name"], r["field"]), r["value"], r["perturbed"], r["change"],
+            r["marginal"], r["simulated"], r["decisions"]
+        ))
+        
+    simulated = sum(r["simulated"] for r in results)
+    total = sum(r["decisions"] for r in results)
+    print()
+    print("| Simulated {0} of {1} decisions ({2:.0f}%)".format(simulated, total, 100.0 * simulated / total if total else 0))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Optimize Runescape ability rotations")
+    parser.add_argument("--profile-json", metavar="FILE", default=None,
+        help="Write hook/value/decision stats for the run as JSON")
+    parser.add_argument("--profile-stacks", metavar="FILE", default=None,
+        help="Write the run's timings as collapsed stacks (for flamegraph.pl/speedscope)")
+    parser.add_argument("--cache", metavar="DIR", default=None,
+        help="Re-use results of identical runs from this directory (see ResultCache)")
+    commands = parser.add_subparsers(dest="command")
+    
+    sweep_parser = commands.add_parser("sweep", help="Rank every combination of gear/starting settings")
+    sweep_parser.add_argument("--bar", choices=sorted(action_bars.keys()), default="melee_2h")
+    sweep_parser.add_argument("--seconds", type=float, default=60)
+    sweep_parser.add_argument("--optimizer", choices=sorted(optimizers.keys()), default="greedy")
+    sweep_parser.add_argument("--adrenaline", type=int, nargs="+", default=[0])
+    sweep_parser.add_argument("--ring", type=on_off, nargs="+", default=[True, False],
+        help="Ring of vigour on/off")
+    sweep_parser.add_argument("--asr", type=on_off, nargs="+", default=[False])
+    sweep_parser.add_argument("--prng", type=on_off, nargs="+", default=[False])
+    sweep_parser.add_argument("--seed", type=int, nargs="+", default=None)
+    sweep_parser.add_argument("--toggle", action="append", default=[], metavar="ACTION",
+        help="Try the run with this action both enabled and disabled")
+    sweep_parser.add_argument("--processes", type=int, default=None)
+    sweep_parser.add_argument("--top", type=int, default=None)
+    sweep_parser.add_argument("--batched", action="store_true",
+        help="Run every cell at once on the batched (numpy) engine, greedy only")
+    
+    exact_parser = commands.add_parser("exact", help="Optimal rotation for a short window, compared to greedy")
+    exact_parser.add_argument("--bar", choices=sorted(action_bars.keys()), default="melee_2h")
+    exact_parser.add_argument("--seconds", type=float, default=12)
+    exact_parser.add_argument("--adrenaline", type=int, default=100)
+    exact_parser.add_argument("--ring", type=on_off, default=True, help="Ring of vigour on/off")
+    exact_parser.add_argument("--table-size", type=int, default=100000)
+    
+    mcts_parser = commands.add_parser("mcts", help="Monte Carlo tree search within a time/iteration budget")
+    mcts_parser.add_argument("--bar", choices=sorted(action_bars.keys()), default="melee_2h")
+    mcts_parser.add_argument("--seconds", type=float, default=120, help="Length of the fight")
+    mcts_parser.add_argument("--adrenaline", type=int, default=0)
+    mcts_parser.add_argument("--ring", type=on_off, default=True, help="Ring of vigour on/off")
+    mcts_parser.add_argument("--prng", type=on_off, default=False)
+    mcts_parser.add_argument("--seed", type=int, default=None)
+    mcts_parser.add_argument("--budget", type=float, default=None, help="Seconds to search for")
+    mcts_parser.add_argument("--iterations", type=int, default=None)
+    mcts_parser.add_argument("--processes", type=int, default=1)
+    mcts_parser.add_argument("--exploration", type=float, default=0.5)
+    
+    priority_parser = commands.add_parser("priority", help="Search for the best priority list (genetic search)")
+    priority_parser.add_argument("--bar", choices=sorted(action_bars.keys()), default="melee_2h")
+    priority_parser.add_argument("--seconds", type=float, default=120, help="Length of the fight")
+    priority_parser.add_argument("--adrenaline", type=int, default=0)
+    priority_parser.add_argument("--ring", type=on_off, default=True, help="Ring of vigour on/off")
+    priority_parser.add_argument("--generations", type=int, default=20)
+    priority_parser.add_argument("--population", type=int, default=32)
+    priority_parser.add_argument("--processes", type=int, default=1)
+    priority_parser.add_argument("--seed", type=int, default=None)
+    
+    steady_parser = commands.add_parser("steady", help="Greedy totals for long fights, extrapolating the repeating cycle")
+    steady_parser.add_argument("--bar", choices=sorted(action_bars.keys()), default="melee_2h")
+    steady_parser.add_argument("--seconds", type=float, default=3600)
+    steady_parser.add_argument("--adrenaline", type=int, default=0)
+    steady_parser.add_argument("--ring", type=on_off, default=True, help="Ring of vigour on/off")
+    steady_parser.add_argument("--event-driven", action="store_true")
+    
+    sensitivity_parser = commands.add_parser("sensitivity", help="Damage change from nudging each ability parameter")
+    sensitivity_parser.add_argument("--bar", choices=sorted(action_bars.keys()), default="melee_2h")
+    sensitivity_parser.add_argument("--seconds", type=float, default=600)
+    sensitivity_parser.add_argument("--adrenaline", type=int, default=0)
+    sensitivity_parser.add_argument("--ring", type=on_off, default=True, help="Ring of vigour on/off")
+    sensitivity_parser.add_argument("--step", type=float, default=0.05,
+        help="Nudge as a fraction of the parameter (parameters at 0 are set to it)")
+    sensitivity_parser.add_argument("--interval", type=int, default=16, help="Decisions between checkpoints")
+    sensitivity_parser.add_argument("--top", type=int, default=None)
+    
+    serve_parser = commands.add_parser("serve", help="Answer JSON line requests on stdin/stdout or a unix socket")
+    serve_parser.add_argument("--socket", metavar="PATH", default=None,
+        help="Listen on this unix socket instead of stdin/stdout")
+    serve_parser.add_argument("--processes", type=int, default=None,
+        help="Pool size (0 runs requests in the server process)")
+    serve_parser.add_argument("--abilities", metavar="FILE", default=None,
+        help="Abilities file for requests that pick actions by styles/filter")
+    
+    return parser.parse_args(argv)
+        
+TEST_MODE = False
+        
+def test():
+    
+    al = ActionLoader("abilities.json")
+    
     actions = al.get_actions(filter={"equipment":"2H"})
     
     for a in actions:
@@ -641,51 +5808,83 @@ def test():
 ##############################################################
         
     
-def main():
+def main(argv=None):
     if TEST_MODE:
         test()
         return
+        
+    args = parse_args(argv)
+    
+    if args.command == "sweep":
+        sweep_main(args)
+        return
+        
+    if args.command == "exact":
+        exact_main(args)
+        return
+        
+    if args.command == "mcts":
+        mcts_main(args)
+        return
+        
+    if args.command == "priority":
+        priority_main(args)
+        return
+        
+    if args.command == "steady":
+        steady_main(args)
+        return
+        
+    if args.command == "sensitivity":
+        sensitivity_main(args)
+        return
+        
+    if args.command == "serve":
+        serve_main(args)
+        return
     
     pstate = PState(melee_2h_actions, adrenaline=0, use_ringofvigour=True, use_prng=False)
     total_ticks = to_ticks(sec=60)
     
-    rotation = greedy_value(pstate, total_ticks)
-    current_tick = 1
+    # Profiling needs the run to actually happen
+    profiling = args.profile_json is not None or args.profile_stacks is not None
+    cache = None if args.cache is None or profiling else ResultCache(args.cache)
     
-    for a in rotation:
-        print("{0:3} [{1:3}%] | {4:3.2f}% dpt | {2} ({3}) {5}".format(
-            current_tick, a["adrenaline"], getattr(a["action"], "name", "SKIP"),
-            getattr(a["action"], "ticks", 1), a["value"], a["mods"]
-        ))
-        current_tick += getattr(a["action"], "ticks", 1)
+    if profiling:
+        pstate.enable_instrumentation()
+    
+    rotation, summary = cached_optimize(pstate, total_ticks, "greedy", cache=cache)
+    print_rotation(rotation)
+    
+    if args.profile_json is not None:
+        pstate.instruments.to_json(args.profile_json)
         
-    total_value = get_total(rotation)
-    most_used,uses = pstate.get_most_used()
-    most_value,value = pstate.get_most_value()
+    if args.profile_stacks is not None:
+        pstate.instruments.write_collapsed(args.profile_stacks)
         
     print()
     print("Damage Summary:")
     print("| Execution Ticks: {0}".format(total_ticks))
-    print("| Rotation Total:  {0:.2f}% ability dmg".format(total_value))
-    print("| Average Action:  {0:.2f}% dpt".format(total_value / total_ticks))
+    print("| Rotation Total:  {0:.2f}% ability dmg".format(summary["damage"]))
+    print("| Average Action:  {0:.2f}% dpt".format(summary["dpt"]))
     print()
     print("Frequency & Value:")
-    print("| Most used action:  {0} ({1}x)".format(most_used.name, uses))
-    print("| Most value action: {0} (~{1:.2f}% of total)".format(most_value.name, (value / total_value) * 100))
+    print("| Most used action:  {0} ({1}x)".format(*summary["most_used"]))
+    print("| Most value action: {0} (~{1:.2f}% of total)".format(*summary["most_value"]))
 
     print()
     
     print("Adrenaline Info:")
-    print("| Total adrenaline gained:  {0}".format(pstate.gained_adrenaline))
-    print("| Total adrenaline spent:   {0}".format(pstate.spent_adrenaline))
-    print("| Excess adrenaline wasted: {0}".format(pstate.excess_adrenaline))
-    print("| Dmg per spent adrenaline: {0}".format(sum([a.total_used_value for a in pstate.actions if a.adrenaline_change < 0]) / pstate.spent_adrenaline))
+    print("| Total adrenaline gained:  {0}".format(summary["gained_adrenaline"]))
+    print("| Total adrenaline spent:   {0}".format(summary["spent_adrenaline"]))
+    print("| Excess adrenaline wasted: {0}".format(summary["excess_adrenaline"]))
+    print("| Dmg per spent adrenaline: {0}".format(summary["damage_per_adrenaline"]))
     
     print()
     
-    print("Usage by action ({0} actions):".format(len([a for a in rotation if a["action"] is not None])))
-    for a in sorted(pstate.actions, key=lambda a: a.times_used, reverse=True):
-        print("| {0:25} ({1}x)".format(a.name, a.times_used))
+    print("Usage by action ({0} actions):".format(summary["actions_used"]))
+    for name, times_used in summary["usage"]:
+        print("| {0:25} ({1}x)".format(name, times_used))
     
 if __name__ == "__main__":
     main()   
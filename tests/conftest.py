@@ -0,0 +1,5 @@
+import os
+import sys
+
+# optimizer.py is a single module at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,16 @@
+import benchmark
+
+
+# Baseline timings are scaled by the calibration times, a machine that runs
+# the calibration loop twice as slow is expected to make half the decisions
+def test_regressions_relative_to_calibration():
+    baseline = {"case": {"decisions_per_sec": 1000.0, "value_us": 2.0, "peak_kb": 100.0, "calibration": 0.1}}
+    slower = {"case": {"decisions_per_sec": 520.0, "value_us": 3.9, "peak_kb": 100.0, "calibration": 0.2}}
+    assert benchmark.find_regressions(slower, baseline, 0.25) == []
+
+    slower["case"]["decisions_per_sec"] = 300.0
+    assert [r[1] for r in benchmark.find_regressions(slower, baseline, 0.25)] == ["decisions_per_sec"]
+
+    # Saved without a calibration time, compared as is
+    del baseline["case"]["calibration"]
+    assert len(benchmark.find_regressions(slower, baseline, 0.25)) == 2
@@ -0,0 +1,967 @@
+import copy
+import json
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+import benchmark
+import optimizer
+
+
+def new_pstate(bar, **options):
+    return optimizer.PState(copy.deepcopy(optimizer.action_bars[bar]), **options)
+
+
+def rotation_names(rotation):
+    return [(getattr(a["action"], "name", None), a["value"], a["adrenaline"]) for a in rotation]
+
+
+def scanned_available(pstate):
+    ready_set, pstate.ready_set = pstate.ready_set, None
+    try:
+        return pstate.get_available_actions()
+    finally:
+        pstate.ready_set = ready_set
+
+
+# The cache only changes how values are found, not what they are
+def test_value_cache_matches_uncached():
+    bars = [optimizer.action_bars["melee_2h"], optimizer.action_bars["range_2h"], benchmark.synthetic_bar(60)]
+    for actions in bars:
+        for options in ({"adrenaline": 0}, {"adrenaline": 100, "use_ringofvigour": True},
+                        {"adrenaline": 50, "use_prng": True, "use_ASR": True, "seed": 3}):
+            cached = optimizer.PState(copy.deepcopy(actions), use_value_cache=True, **options)
+            uncached = optimizer.PState(copy.deepcopy(actions), use_value_cache=False, **options)
+            expected = rotation_names(optimizer.greedy_value(uncached, 1500))
+            assert rotation_names(optimizer.greedy_value(cached, 1500)) == expected, options
+
+
+# Parameter setters on a live pstate: base values are keyed by definition,
+# the prediction tables are rebuilt by update_definitions
+def test_value_cache_definition_change():
+    pstate = new_pstate("melee_2h", adrenaline=50, use_ringofvigour=True)
+    optimizer.greedy_value(pstate, 30)
+
+    for action in pstate.actions:
+        pstate.value(action)
+
+    action = pstate.actions[optimizer.Action.find_by_name("Smash", pstate.actions)]
+    action.max *= 2
+    uncached = optimizer.PState(pstate.actions, adrenaline=pstate.adrenaline, use_value_cache=False)
+    uncached.active_mods = pstate.active_mods
+    assert pstate.value(action, mod_value_prediction=False) == uncached.value(action, mod_value_prediction=False)
+
+    pstate.update_definitions()
+    for action in pstate.actions:
+        assert pstate.value(action) == uncached.value(action)
+
+
+# Event driven runs play the same rotation as ticking every tick, also with
+# idle stretches and Conditions/python checks on the clock or a cooldown that
+# flip while idle
+def test_event_driven_matches_ticks():
+    def bar(names, checks):
+        actions = copy.deepcopy([a for a in optimizer.melee_2h_actions if a.name in names])
+        for a in actions:
+            if a.name in checks:
+                check = checks[a.name]
+                a.pstate_check = optimizer.Condition(check) if type(check) is str else check
+        return actions
+
+    def fury_ready_soon(pstate):
+        fury = pstate.actions[optimizer.Action.find_by_name("Fury", pstate.actions)]
+        return fury.time_remaining <= 3
+
+    bars = [
+        optimizer.action_bars["melee_2h"],
+        optimizer.action_bars["range_2h"],
+        bar(["Sacrifice", "Smash", "Sever", "Bersker", "Fury"], {}),
+        bar(["Sacrifice", "Smash", "Sever", "Fury"], {"Smash": "elapsed >= 200", "Sever": "cooldown('Fury') <= 3"}),
+        bar(["Sacrifice", "Smash", "Sever", "Fury"], {"Sever": fury_ready_soon}),
+    ]
+    for actions in bars:
+        for options in ({"adrenaline": 0}, {"adrenaline": 100, "use_ringofvigour": True}):
+            ticked = optimizer.greedy_value(optimizer.PState(copy.deepcopy(actions), **options), 3000)
+            events = optimizer.greedy_value(optimizer.PState(copy.deepcopy(actions), **options), 3000, event_driven=True)
+            assert rotation_names(events) == rotation_names(ticked), options
+            assert [r["mods"] for r in events] == [r["mods"] for r in ticked], options
+
+
+# The threshold Conditions on melee_2h read Bersker's cooldown, the event
+# queue wakes up where it crosses their threshold instead of every tick. With
+# only Sever (or Sever and Smash) building adrenaline the bar is mostly idle.
+def test_event_driven_skips_ticks_on_melee(monkeypatch):
+    wakeups = []
+    skip_ticks = optimizer.skip_ticks
+    monkeypatch.setattr(optimizer, "skip_ticks", lambda *args: wakeups.append(skip_ticks(*args)) or wakeups[-1])
+
+    for kept in (["Sever"], ["Sever", "Smash"]):
+        actions = copy.deepcopy(optimizer.action_bars["melee_2h"])
+        for a in actions:
+            if a.adrenaline_change is not None and a.adrenaline_change > 0 and a.name not in kept:
+                a.enabled = False
+        assert all(a.pstate_check.crossings for a in actions if a.adrenaline_change == -15)
+
+        for options in ({"adrenaline": 0}, {"adrenaline": 100, "use_ringofvigour": True}):
+            del wakeups[:]
+            ticked = optimizer.greedy_value(optimizer.PState(copy.deepcopy(actions), **options), 6000)
+            events = optimizer.greedy_value(optimizer.PState(copy.deepcopy(actions), **options), 6000, event_driven=True)
+            idle = sum(1 for r in ticked if r["action"] is None)
+
+            assert rotation_names(events) == rotation_names(ticked), (kept, options)
+            assert sum(wakeups) == idle and len(wakeups) * 5 < idle, (kept, options)
+
+
+# Every change to the list keeps the name index and buddy links in step with
+# a linear scan (buddies added after the action that names them too)
+def test_action_registry_index_after_changes():
+    def scan(actions, name):
+        return next((i for i, a in enumerate(actions) if a.name == name), None)
+
+    def check(registry):
+        for name in [a.name for a in registry] + ["Missing"]:
+            assert optimizer.Action.find_by_name(name, registry) == scan(registry, name), name
+        for a in registry:
+            expected = [scan(registry, n) for n in a.buddy_actions or [] if scan(registry, n) is not None]
+            assert registry.buddies_of(a) == expected, a.name
+
+    registry = optimizer.ActionRegistry(copy.deepcopy(optimizer.melee_2h_actions))
+    still = registry.pop(optimizer.Action.find_by_name("Slaughter(Still)", registry))
+    check(registry)
+    registry.append(optimizer.Action("Extra", max=10, cooldown=5, buddy_actions=["Smash"]))
+    check(registry)
+    registry.insert(0, still)
+    check(registry)
+    registry.remove(registry[optimizer.Action.find_by_name("Smash", registry)])
+    check(registry)
+    registry.sort(key=lambda a: a.name)
+    check(registry)
+    registry.reverse()
+    check(registry)
+    registry[2] = optimizer.Action("Smash", max=20, cooldown=10)
+    check(registry)
+    del registry[0]
+    check(registry)
+    registry.extend(copy.deepcopy(optimizer.melee_2h_actions[:3]))
+    check(registry)
+    registry *= 2
+    check(registry)
+
+    # append updates the index in place, unless it's shared with a branch
+    names = registry.names
+    registry.append(optimizer.Action("Later", max=10, cooldown=5))
+    assert registry.names is names
+    check(registry)
+    branch = registry.branch([copy.copy(a) for a in registry])
+    branch.append(optimizer.Action("Branched", max=10, cooldown=5, buddy_actions=["Later"]))
+    assert optimizer.Action.find_by_name("Branched", registry) is None
+    check(registry)
+    check(branch)
+
+    pstate = optimizer.PState(registry, adrenaline=100)
+    optimizer.greedy_value(pstate, 300)
+    check(pstate.actions)
+
+
+def run_state(pstate):
+    return (
+        pstate.signature(), pstate.elapsed_ticks, pstate.gained_adrenaline, pstate.spent_adrenaline,
+        pstate.excess_adrenaline, [(a.times_used, a.total_used_value) for a in pstate.actions],
+        [(m.name, m.last_used, m.is_active) for m in pstate.active_mods],
+    )
+
+
+# restore rolls every field back (nested snapshots too), the pstate then
+# plays on exactly like a copy that never left the snapshot
+def test_snapshot_restore_round_trip():
+    for bar in ("melee_2h", "range_2h"):
+        pstate = new_pstate(bar, adrenaline=50, use_ringofvigour=True)
+        optimizer.greedy_value(pstate, 60)
+        untouched = pstate.branch()
+        start = run_state(pstate)
+
+        outer = pstate.snapshot()
+        optimizer.greedy_value(pstate, 100)
+        middle = run_state(pstate)
+        inner = pstate.snapshot()
+        optimizer.greedy_value(pstate, 300)
+
+        pstate.restore(inner)
+        assert run_state(pstate) == middle
+        pstate.restore(outer)
+        assert run_state(pstate) == start
+        pstate.release()
+
+        assert rotation_names(optimizer.greedy_value(pstate, 600)) == rotation_names(optimizer.greedy_value(untouched, 600))
+        assert run_state(pstate) == run_state(untouched)
+
+
+# Without a snapshot open, expired mod instances are re-used for new casts
+def test_mod_pool_reuses_expired_mods():
+    pstate = new_pstate("melee_2h", adrenaline=100, use_ringofvigour=True)
+    optimizer.greedy_value(pstate, 600)
+    pooled = [m for mods in pstate.mod_pool.values() for m in mods]
+    assert len(pooled) > 0
+
+    mod = pooled[-1]
+    assert pstate.acquire_mod(mod) is mod and mod.is_active
+
+
+# The gain tables predict the same mod gains as rescanning the actions, at
+# every decision of a run (they are kept up to date as cooldowns change)
+def test_mod_gain_tables_match_rescan():
+    for bar in ("melee_2h", "range_2h"):
+        for adrenaline in (0, 100):
+            pstate = new_pstate(bar, adrenaline=adrenaline, use_ringofvigour=True)
+            mods = [a for a in pstate.actions if a.mod is not None]
+            checked = 0
+
+            while pstate.elapsed_ticks <= 1500:
+                for action in mods:
+                    assert pstate.value_cache.mod_value_increase(action) == \
+                        pytest.approx(pstate.mod_value_increase(action)), (bar, action.name, pstate.elapsed_ticks)
+                    checked += 1
+                pstate.activate(getattr(pstate.get_greedy_best(), "name", None))
+
+            assert checked > 0 and pstate.value_cache.hits > 0
+
+
+# Streaming the steps into RotationStats gives greedy_value's records and
+# main()'s summary without keeping the rotation
+def test_streamed_stats_match_greedy_value():
+    for bar in ("melee_2h", "range_2h"):
+        listed = new_pstate(bar, adrenaline=50, use_ringofvigour=True)
+        streamed = new_pstate(bar, adrenaline=50, use_ringofvigour=True)
+        rotation = optimizer.greedy_value(listed, 1500)
+
+        stats = optimizer.RotationStats(streamed)
+        records = [step.to_record() for step in stats.stream(optimizer.greedy_steps(streamed, 1500))]
+        assert rotation_names(records) == rotation_names(rotation)
+        assert [r["mods"] for r in records] == [r["mods"] for r in rotation]
+
+        assert stats.damage == pytest.approx(optimizer.get_total(rotation))
+        assert stats.ticks == sum(getattr(r["action"], "ticks", 1) for r in rotation)
+        assert stats.summary(1500) == optimizer.rotation_summary(listed, rotation, 1500)
+        assert not hasattr(optimizer.Step(None, 0, 0, ()), "__dict__")
+
+
+# Instrumentation times the hooks of the same loop, every hook is counted
+# once per activation (also one that raises) and the rotation doesn't change
+def test_instrumented_hooks_match_activations(capsys):
+    def failing_hook(pstate, action):
+        raise RuntimeError("hook failed")
+
+    plain = new_pstate("melee_2h", adrenaline=50, use_ringofvigour=True)
+    pstate = new_pstate("melee_2h", adrenaline=50, use_ringofvigour=True)
+    pstate.on_activate.append(failing_hook)
+    instruments = pstate.enable_instrumentation()
+
+    rotation = optimizer.greedy_value(pstate, 600)
+    activations = sum(1 for a in rotation if a["action"] is not None)
+
+    assert rotation_names(rotation) == rotation_names(optimizer.greedy_value(plain, 600))
+    assert set(instruments.hook_calls) == set(f.__name__ for f in pstate.on_activate)
+    assert all(calls == activations for calls in instruments.hook_calls.values())
+    assert instruments.stack == []
+    assert "hook failed" in capsys.readouterr().out
+
+
+# The JSON export has every counter, the collapsed stacks have each section's
+# time without the sections inside it
+def test_instrumentation_exports(tmp_path):
+    pstate = new_pstate("melee_2h", adrenaline=50, use_ringofvigour=True)
+    instruments = pstate.enable_instrumentation()
+    optimizer.greedy_value(pstate, 600)
+
+    exported = json.loads(instruments.to_json())
+    assert set(exported) == set([
+        "hooks", "value_calls", "decisions", "available_sizes", "average_available", "ticks_skipped", "sections",
+    ])
+    assert set(exported["hooks"]) == set(f.__name__ for f in pstate.on_activate)
+    assert all(set(h) == set(["calls", "seconds"]) for h in exported["hooks"].values())
+    assert exported["decisions"] == sum(exported["available_sizes"].values())
+    instruments.to_json(str(tmp_path / "stats.json"))
+    assert json.loads((tmp_path / "stats.json").read_text()) == exported
+
+    instruments = optimizer.Instrumentation()
+    instruments.section_time.update({"a": 3.0, "a;b": 1.0, "a;c": 0.5, "a;b;d": 0.25, "e": 0.125})
+    assert instruments.collapsed_stacks() == ["a 1500000", "a;b 750000", "a;b;d 250000", "a;c 500000", "e 125000"]
+
+
+# The python pstate_checks the built-in Conditions replaced
+def old_threshold(pstate):
+    return pstate.adrenaline >= 50
+
+
+def old_threshold_before(name):
+    def check(pstate):
+        i = optimizer.Action.find_by_name(name, pstate.actions)
+
+        if i is not None and \
+            (pstate.actions[i].is_ready() or
+            (((pstate.adrenaline - 15) + (pstate.actions[i].time_remaining * (8 / 3.0))) < 100)):
+            return False
+
+        return pstate.adrenaline >= 50
+    return check
+
+
+def old_ultimate(pstate):
+    return pstate.adrenaline == 100
+
+
+# Conditions agree with the functions they replaced at every decision and
+# adrenaline, functions still work as pstate_checks (same rotation) and
+# Conditions pickle by their source
+def test_conditions_match_old_checks():
+    old = {
+        optimizer.pstate_threshold: old_threshold,
+        optimizer.pstate_threshold_melee: old_threshold_before("Bersker"),
+        optimizer.pstate_threshold_range: old_threshold_before("Death's Swiftness"),
+        optimizer.pstate_ultimate: old_ultimate,
+    }
+
+    for bar in ("melee_2h", "range_2h"):
+        pstate = new_pstate(bar, use_ringofvigour=True)
+        for _ in optimizer.greedy_steps(pstate, 600):
+            saved = pstate.adrenaline
+            for adrenaline in (saved, 0, 35, 49, 50, 85, 100):
+                pstate.adrenaline = adrenaline
+                for condition, function in old.items():
+                    assert condition(pstate) == function(pstate), (condition, adrenaline, pstate.elapsed_ticks)
+            pstate.adrenaline = saved
+
+        by_source = dict((condition.source, function) for condition, function in old.items())
+        functions = copy.deepcopy(optimizer.action_bars[bar])
+        for a in functions:
+            if a.pstate_check is not None:
+                a.pstate_check = by_source[a.pstate_check.source]
+        expected = optimizer.greedy_value(optimizer.PState(functions, use_ringofvigour=True), 1500)
+        assert rotation_names(optimizer.greedy_value(new_pstate(bar, use_ringofvigour=True), 1500)) == rotation_names(expected)
+
+    assert pickle.loads(pickle.dumps(optimizer.pstate_threshold_melee)).source == optimizer.pstate_threshold_melee.source
+
+
+def test_condition_adrenaline_thresholds():
+    assert optimizer.Condition("adrenaline == 100").thresholds == (100,)
+    assert optimizer.Condition("adrenaline >= 50 and 80 > adrenaline").thresholds == (50, 80)
+    assert optimizer.Condition("adrenaline >= 50 and cooldown('Smash') < 3").thresholds == (50,)
+    assert optimizer.Condition("adrenaline + 15 >= 50").thresholds is None
+
+
+# The incremental ready set agrees with a full rescan before every decision,
+# including adrenaline only checks with several thresholds (and one that
+# isn't a plain comparison)
+def test_ready_set_matches_rescan():
+    custom = copy.deepcopy(optimizer.melee_2h_actions)
+    for a in custom:
+        if a.name == "Smash":
+            a.pstate_check = optimizer.Condition("adrenaline >= 30 and adrenaline < 70")
+        elif a.name == "Sever":
+            a.pstate_check = optimizer.Condition("adrenaline * 2 > 90")
+            a.negative_pstate_check = True
+
+    bars = [optimizer.action_bars["melee_2h"], optimizer.action_bars["range_2h"], custom]
+    for actions in bars:
+        for options in ({"adrenaline": 0}, {"adrenaline": 100, "use_prng": True, "use_ASR": True, "seed": 5}):
+            pstate = optimizer.PState(copy.deepcopy(actions), use_ringofvigour=True, **options)
+            assert pstate.get_available_actions() == scanned_available(pstate)
+
+            for step in optimizer.greedy_steps(pstate, 1500):
+                assert pstate.get_available_actions() == scanned_available(pstate), pstate.elapsed_ticks
+
+
+# Timers/cooldowns changed outside of tick/activate, the ready set is
+# rebuilt by update_definitions
+def test_ready_set_timer_change():
+    pstate = new_pstate("melee_2h", adrenaline=100, use_ringofvigour=True)
+    optimizer.greedy_value(pstate, 30)
+
+    for action in pstate.actions:
+        action.cooldown += 3
+        action.last_used = action.cooldown if action.last_used < 6 else 0
+
+    pstate.update_definitions()
+    scan = optimizer.PState(pstate.actions, adrenaline=pstate.adrenaline, use_value_cache=False)
+    scan.ready_set = None
+    assert pstate.get_available_actions() == scan.get_available_actions()
+
+
+# Definitions round-trip through to_definition/from_definition (and JSON),
+# pstates built on the same list share the definitions but not the run state
+def test_definition_round_trip():
+    for bar in ("melee_2h", "range_2h"):
+        for action in optimizer.action_bars[bar]:
+            definition = action.to_definition()
+            assert optimizer.Action.from_definition(definition).to_definition() == definition
+            assert optimizer.Action.from_definition(json.loads(json.dumps(definition))).to_definition() == definition
+
+        actions = optimizer.action_bars[bar]
+        first = optimizer.PState(actions, adrenaline=50, use_ringofvigour=True)
+        second = optimizer.PState(actions, adrenaline=50, use_ringofvigour=True)
+        rotation = optimizer.greedy_value(first, 300)
+
+        assert all(a.definition is b.definition for a, b in zip(first.actions, actions))
+        assert all(a.times_used == 0 and a.total_used_value == 0 for a in second.actions + list(actions))
+        assert rotation_names(optimizer.greedy_value(second, 300)) == rotation_names(rotation)
+
+    action = optimizer.melee_2h_actions[0]
+    assert not hasattr(action, "__dict__") and not hasattr(action.definition, "__dict__")
+    with pytest.raises(AttributeError):
+        action.definition.max = 1
+
+
+# Beam search starts from the greedy rotation so it's never worse, returns a
+# valid rotation worth what it reports and leaves pstate where replaying it
+# would
+def test_beam_search_at_least_greedy():
+    for bar in ("melee_2h", "range_2h"):
+        pstate = new_pstate(bar, use_ringofvigour=True)
+        greedy = optimizer.get_total(optimizer.greedy_value(pstate.branch(), 300))
+
+        for width in (1, 4):
+            searched = pstate.branch()
+            rotation = optimizer.beam_search_value(searched, 300, width=width)
+            names = [getattr(a["action"], "name", None) for a in rotation]
+            total = optimizer.get_total(rotation)
+            assert total >= greedy
+
+            result = optimizer.evaluate_rotations(pstate, [names])[0]
+            assert result["valid"] and result["damage"] == pytest.approx(total)
+
+            replayed = pstate.branch()
+            optimizer.replay_rotation(replayed, names)
+            assert searched.signature() == replayed.signature()
+
+
+def test_transposition_table_evicts_least_recently_used():
+    table = optimizer.TranspositionTable(max_size=2)
+    table.put("a", 1)
+    table.put("b", 2)
+    assert table.get("a") == 1
+    table.put("c", 3)
+
+    assert table.get("b") is None
+    assert table.get("a") == 1 and table.get("c") == 3
+    assert len(table) == 2
+    assert table.hit_rate == 0.75
+
+
+# Short windows on the built in bars: the exact search is never beaten by
+# beam search, and beam search never by greedy (it starts from greedy)
+def test_exact_beam_greedy_ordering():
+    for bar, ticks in (("melee_2h", 12), ("range_2h", 20)):
+        for adrenaline in (0, 100):
+            options = {"adrenaline": adrenaline, "use_ringofvigour": True}
+            stats = {}
+            exact = optimizer.get_total(optimizer.exact_value(new_pstate(bar, **options), ticks, stats=stats))
+            beam = optimizer.get_total(optimizer.beam_search_value(new_pstate(bar, **options), ticks, width=4))
+            greedy = optimizer.get_total(optimizer.greedy_value(new_pstate(bar, **options), ticks))
+
+            assert exact >= beam >= greedy, (bar, adrenaline)
+            assert stats["nodes"] > 0
+
+
+# Extrapolating the cycle gives the same totals and end state (cooldowns
+# left, not the time since an action came off cooldown) as running every tick
+def test_steady_state_matches_full_run():
+    ticks = 20000
+
+    for bar in ("melee_2h", "range_2h"):
+        pstate = new_pstate(bar, adrenaline=50, use_ringofvigour=True)
+        full = pstate.branch()
+        steady = optimizer.steady_state_value(pstate, ticks)
+        stats = optimizer.RotationStats(full)
+        stats.consume(optimizer.greedy_steps(full, ticks))
+
+        assert steady.cycle is not None
+        assert steady.damage == pytest.approx(stats.damage)
+        summary, expected = steady.summary(ticks), stats.summary(ticks)
+        for key in ("usage", "actions_used", "gained_adrenaline", "spent_adrenaline", "excess_adrenaline"):
+            assert summary[key] == expected[key], (bar, key)
+
+        assert pstate.adrenaline == full.adrenaline
+        assert [max(a.time_remaining, 0) for a in pstate.actions] == [max(a.time_remaining, 0) for a in full.actions]
+
+
+# Scoring the greedy rotation (as records or names) gives greedy's total,
+# so does replaying its names on a fresh pstate
+def test_evaluate_rotations_matches_greedy():
+    for bar in ("melee_2h", "range_2h"):
+        pstate = new_pstate(bar, adrenaline=50, use_ringofvigour=True)
+        greedy = optimizer.greedy_value(pstate.branch(), 300)
+        names = [getattr(a["action"], "name", None) for a in greedy]
+        total = optimizer.get_total(greedy)
+
+        results = optimizer.evaluate_rotations(pstate, [greedy, names, names[:10] + ["Nothing"]])
+        assert results[0]["valid"] and results[1]["valid"]
+        assert results[0]["damage"] == results[1]["damage"] == total
+        assert not results[2]["valid"] and results[2]["invalid_at"] == 10
+
+        assert optimizer.get_total(optimizer.replay_rotation(pstate.branch(), names)) == total
+        assert pstate.elapsed_ticks == 0
+
+
+# With use_prng the searches can each recommend a different first action than
+# the one with the most visits over all of them, pstate seed 2 and searches
+# seeded 32-35 is such a case
+def test_mcts_processes_no_recommendation_for_first():
+    ticks = optimizer.to_ticks(sec=12)
+    pstate = new_pstate("melee_2h", adrenaline=50, use_prng=True, seed=2)
+    rotation = optimizer.mcts_value(pstate, ticks, iterations=12, processes=4, seed=32)
+
+    assert optimizer.get_total(rotation) > 0
+    assert sum(getattr(a["action"], "ticks", 1) for a in rotation) > ticks
+
+
+# An iteration budget is kept, and without use_prng the first playout is the
+# greedy rollout so the rotation (played on pstate like greedy_value) is
+# valid and never worse than greedy
+def test_mcts_iterations_at_least_greedy():
+    ticks = optimizer.to_ticks(sec=36)
+    for bar in ("melee_2h", "range_2h"):
+        pstate = new_pstate(bar, adrenaline=50)
+        greedy = optimizer.greedy_value(pstate.branch(), ticks)
+        stats = {}
+        rotation = optimizer.mcts_value(pstate.branch(), ticks, iterations=25, seed=1, stats=stats)
+
+        assert stats["iterations"] == 25 and stats["searches"] == 1
+        assert all(set(r) == set(greedy[0]) for r in rotation)
+        assert sum(getattr(a["action"], "ticks", 1) for a in rotation) > ticks
+        assert optimizer.get_total(rotation) >= optimizer.get_total(greedy)
+
+        evaluated = optimizer.evaluate_rotations(pstate, [rotation])[0]
+        assert evaluated["valid"] and evaluated["damage"] == optimizer.get_total(rotation)
+
+
+PRIORITY_SEARCH = """
+import copy, optimizer
+pstate = optimizer.PState(copy.deepcopy(optimizer.action_bars["melee_2h"]))
+stats = {}
+rotation = optimizer.priority_search_value(pstate, 300, seed=7, stats=stats)
+print(repr((optimizer.get_total(rotation), stats["policy"].order, stats["policy"].gates)))
+"""
+
+
+# A seeded search is the same in every process, whatever the string hashing
+def test_priority_search_reproducible_across_hash_seeds():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    outputs = []
+
+    for hash_seed in ("1", "2"):
+        env = dict(os.environ, PYTHONHASHSEED=hash_seed)
+        outputs.append(subprocess.check_output([sys.executable, "-c", PRIORITY_SEARCH], cwd=root, env=env))
+
+    assert outputs[0] == outputs[1]
+
+
+# The search plays a valid rotation worth its best fitness. The first
+# generation has nothing to prune against or find in the cache, after that
+# the elites are cache hits and the pruned count is the unfinished runs
+def test_priority_search_counters():
+    pstate = new_pstate("melee_2h", adrenaline=50)
+    search = optimizer.PrioritySearch(pstate, 300, population=16, seed=1)
+    search.evaluate(search.initial_population())
+    assert (search.cache_hits, search.pruned, search.evaluations) == (0, 0, len(search.fitness))
+
+    search = optimizer.PrioritySearch(pstate, 300, population=16, seed=1).run(5)
+    assert search.evaluations == len(search.fitness)
+    assert search.cache_hits >= search.elite * 5
+    assert 0 < search.pruned == sum(1 for damage, finished in search.fitness.values() if not finished)
+    assert all(damage < search.best[0] for damage, finished in search.fitness.values() if not finished)
+
+    stats = {}
+    rotation = optimizer.priority_search_value(pstate.branch(), 300, generations=5, population=16, seed=1,
+        stats=stats)
+    assert (stats["evaluations"], stats["cache_hits"], stats["pruned"]) == \
+        (search.evaluations, search.cache_hits, search.pruned)
+    assert optimizer.get_total(rotation) == stats["damage"] == search.best[0]
+    evaluated = optimizer.evaluate_rotations(pstate, [rotation])[0]
+    assert evaluated["valid"] and evaluated["damage"] == stats["damage"]
+
+
+# ArrayPState takes the same action lists and plays the same rotations
+def test_array_pstate_matches_pstate():
+    pytest.importorskip("numpy")
+    for bar in ("melee_2h", "range_2h"):
+        for adrenaline in (0, 50, 100):
+            options = {"adrenaline": adrenaline, "use_ringofvigour": True}
+            scalar = optimizer.greedy_value(new_pstate(bar, **options), 1500)
+            array = optimizer.greedy_value(optimizer.ArrayPState(optimizer.action_bars[bar], **options), 1500)
+            assert rotation_names(array) == rotation_names(scalar), (bar, adrenaline)
+
+
+# restore rolls the arrays back with the rest of the pstate
+def test_array_pstate_snapshot_restore():
+    pytest.importorskip("numpy")
+    pstate = optimizer.ArrayPState(optimizer.action_bars["melee_2h"], adrenaline=50, use_ringofvigour=True)
+    optimizer.greedy_value(pstate, 30)
+    signature = pstate.signature()
+    last_used = pstate.last_used.copy()
+
+    token = pstate.snapshot()
+    first = optimizer.greedy_value(pstate, 200)
+    pstate.restore(token)
+    pstate.release()
+
+    assert pstate.signature() == signature
+    assert (pstate.last_used == last_used).all()
+    assert rotation_names(optimizer.greedy_value(pstate, 200)) == rotation_names(first)
+
+
+# The parameter arrays are rebuilt by update_definitions
+def test_array_pstate_definition_change():
+    pytest.importorskip("numpy")
+    actions = copy.deepcopy(optimizer.action_bars["melee_2h"])
+    for a in actions:
+        if a.name == "Smash":
+            a.cooldown *= 2
+            a.max *= 3
+    expected = optimizer.greedy_value(optimizer.PState(actions), 600)
+
+    pstate = optimizer.ArrayPState(optimizer.action_bars["melee_2h"])
+    for a in pstate.actions:
+        if a.name == "Smash":
+            a.cooldown *= 2
+            a.max *= 3
+    pstate.update_definitions()
+    assert rotation_names(optimizer.greedy_value(pstate, 600)) == rotation_names(expected)
+
+
+# Monte Carlo batches are reproducible from their seed and leave pstate as
+# it was, a fixed rotation's rolls average out to its no-roll total
+def test_monte_carlo_seeded():
+    pytest.importorskip("numpy")
+    pstate = new_pstate("melee_2h", adrenaline=50, use_ASR=True)
+    first = optimizer.monte_carlo_value(pstate, 100, trials=20, seed=5).summary()
+
+    assert optimizer.monte_carlo_value(pstate, 100, trials=20, seed=5).summary() == first
+    assert optimizer.monte_carlo_value(pstate, 100, trials=20, seed=6).summary() != first
+    assert first["trials"] == 20
+    assert pstate.elapsed_ticks == 0 and pstate.adrenaline == 50
+
+    rotation = optimizer.greedy_value(pstate.branch(), 100)
+    rolled = optimizer.monte_carlo_rotation(pstate, rotation, trials=200, seed=5)
+    assert optimizer.monte_carlo_rotation(pstate, rotation, trials=200, seed=5).summary() == rolled.summary()
+    low, high = rolled.damage.confidence_interval()
+    assert low <= optimizer.get_total(rotation) <= high
+
+    batch = optimizer.monte_carlo_batch(pstate, 100, trials=50, seed=5).summary()
+    assert optimizer.monte_carlo_batch(pstate, 100, trials=50, seed=5).summary() == batch
+
+
+# An ASR proc leaves adrenaline at 50 where the rotation expects 35, those
+# trials can't play "Low" next and are counted as invalid
+def test_monte_carlo_rotation_invalid_trials():
+    pytest.importorskip("numpy")
+    actions = [
+        optimizer.Action("Spend", max=50, cooldown=20, adrenaline_change=-15,
+            pstate_check=optimizer.Condition("adrenaline >= 50")),
+        optimizer.Action("Low", max=10, cooldown=5, pstate_check=optimizer.Condition("adrenaline < 40")),
+    ]
+
+    result = optimizer.monte_carlo_rotation(optimizer.PState(actions, adrenaline=50, use_ASR=True),
+        ["Spend", "Low"], trials=1000, seed=5)
+    assert 50 < result.invalid < 150
+    assert result.trials + result.invalid == 1000 and result.usage["Low"].count == result.trials
+
+    result = optimizer.monte_carlo_rotation(optimizer.PState(actions, adrenaline=50), ["Spend", "Low"],
+        trials=1000, seed=5)
+    assert (result.invalid, result.trials) == (0, 1000)
+
+
+# Without prng every batched cell plays out like the scalar run of its settings
+def test_sweep_batch_matches_cells():
+    pytest.importorskip("numpy")
+    definitions = [a.to_definition() for a in optimizer.melee_2h_actions]
+    grid = {"adrenaline": [0, 50, 73, 100], "use_ringofvigour": [True, False], "Decimate": [True, False]}
+    cells = list(optimizer.sweep_grid(grid))
+    assert len(cells) == 16
+
+    batched = optimizer.run_sweep_batch(cells, 300, definitions)
+    for cell, summary in zip(cells, batched):
+        assert summary == optimizer.run_sweep_cell(cell, 300, definitions=definitions), cell
+
+
+# Each seeded prng cell has its own generator, so its result doesn't depend
+# on the other cells or on which of them were cached
+def test_sweep_batch_prng_cells_independent(tmp_path):
+    pytest.importorskip("numpy")
+    definitions = [a.to_definition() for a in optimizer.melee_2h_actions]
+    ticks = 200
+    cells = [
+        {"adrenaline": adrenaline, "use_prng": True, "use_ASR": True, "seed": seed}
+        for adrenaline in (0, 50) for seed in (1, 2)
+    ]
+    cells.insert(1, {"adrenaline": 100})
+
+    batched = optimizer.run_sweep_batch(cells, ticks, definitions)
+    for cell, summary in zip(cells, batched):
+        assert optimizer.run_sweep_batch([cell], ticks, definitions) == [summary]
+
+    cache_dir = str(tmp_path)
+    assert optimizer.run_sweep_batch(cells[2:], ticks, definitions, cache_dir) == batched[2:]
+    assert optimizer.run_sweep_batch(cells, ticks, definitions, cache_dir) == batched
+
+
+# Sweeping over a process pool gives the same ranked summaries as running the
+# cells here, each one what a direct greedy run with its settings gets
+def test_sweep_matches_direct_runs():
+    grid = {"adrenaline": [0, 100], "use_ringofvigour": [True, False], "Decimate": [True, False]}
+    results = optimizer.sweep(optimizer.melee_2h_actions, grid, 300, processes=2)
+
+    assert len(results) == 8
+    assert [r["damage"] for r in results] == sorted([r["damage"] for r in results], reverse=True)
+    assert results == optimizer.sweep(optimizer.melee_2h_actions, grid, 300, processes=1)
+
+    for r in results:
+        settings = r["settings"]
+        pstate = new_pstate("melee_2h", adrenaline=settings["adrenaline"], use_ringofvigour=settings["use_ringofvigour"])
+        pstate.actions[optimizer.Action.find_by_name("Decimate", pstate.actions)].enabled = settings["Decimate"]
+        assert r["damage"] == optimizer.get_total(optimizer.greedy_value(pstate, 300)), settings
+
+
+# Definitions sent to sweep/worker processes name their checks, only
+# registered ones are looked up (any other name has to parse as a condition)
+def test_definition_check_names(monkeypatch):
+    definition = optimizer.Action("Test", max=10, cooldown=5).to_definition()
+
+    for name in ("main", "sweep", "adjust_adrenaline"):
+        with pytest.raises(ValueError):
+            optimizer.Action.from_definition(dict(definition, pstate_check=name))
+
+    action = optimizer.Action.from_definition(dict(definition, pstate_check="pstate_ultimate"))
+    assert action.pstate_check is optimizer.pstate_ultimate
+
+    def low_adrenaline(pstate):
+        return pstate.adrenaline < 30
+
+    monkeypatch.setitem(optimizer.pstate_checks, "low_adrenaline", low_adrenaline)
+    action = optimizer.Action.from_definition(dict(definition, pstate_check="low_adrenaline"))
+    assert action.pstate_check is low_adrenaline
+    assert action.to_definition()["pstate_check"] == "low_adrenaline"
+
+
+def write_abilities(path, smash_max=1880):
+    database = {
+        "melee": [
+            {"name": "Smash", "min": 250, "max": smash_max, "cooldown": 10.2, "equipment": "2h"},
+            {"name": "Sever", "min": 300, "max": 1880, "cooldown": 15},
+            {"name": "Slice", "min": 300, "max": 1200, "cooldown": 3, "equipment": "dual"},
+        ],
+        "range": [{"name": "Snipe", "min": 1250, "max": 2190, "cooldown": 10.2, "equipment": "2h"}],
+    }
+    path.write_text(json.dumps(database))
+
+
+# Warm loads come from the cache without parsing (also when the file was only
+# touched), queries return fresh actions with the cooldowns converted once
+def test_action_loader_warm_cache(tmp_path, monkeypatch):
+    path = tmp_path / "abilities.json"
+    write_abilities(path)
+    cold = optimizer.ActionLoader(str(path))
+    assert not cold.from_cache
+    expected = [a.to_definition() for a in cold.get_actions(styles=["melee"], filter={"equipment": "2h"})]
+    assert [(d["name"], d["cooldown"]) for d in expected] == [("Smash", 17), ("Sever", 25)]
+
+    def parse(text):
+        raise AssertionError("warm load parsed the file")
+    monkeypatch.setattr(optimizer.ActionLoader, "parse", staticmethod(parse))
+    os.utime(str(path), (1, 1))
+
+    for _ in range(0, 2):
+        warm = optimizer.ActionLoader(str(path))
+        assert warm.from_cache
+
+    first = warm.get_actions(styles=["melee"], filter={"equipment": "2h"})
+    second = warm.get_actions(styles=["melee"], filter={"equipment": "2h"})
+    assert [a.to_definition() for a in first] == [a.to_definition() for a in second] == expected
+    assert all(a is not b for a, b in zip(first, second))
+
+    first[0].last_used = 5
+    assert second[0].last_used != 5
+
+    monkeypatch.undo()
+    write_abilities(path, smash_max=2000)
+    changed = optimizer.ActionLoader(str(path))
+    assert not changed.from_cache
+    assert changed.get_actions(filter={"name": "Smash"})[0].max == 2000
+
+
+# Requests over stdin get their id back with the result (the greedy rotation
+# a direct run gives), bad lines get an error and don't stop the worker
+def test_serve_stdin_requests():
+    lines = [
+        {"id": 1, "adrenaline": 50, "seconds": 30},
+        "not json",
+        [1],
+        {"id": 3, "command": "nope"},
+        {"id": 4, "command": "evaluate", "rotations": [["Dismember", "Cleave"], ["Nothing"]]},
+    ]
+    stdin = "".join((line if isinstance(line, str) else json.dumps(line)) + "\n" for line in lines)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, os.path.join(root, "optimizer.py"), "serve", "--processes", "0"],
+        input=stdin, capture_output=True, text=True, timeout=120, check=True
+    ).stdout
+    responses = [json.loads(line) for line in output.splitlines()]
+    by_id = dict((r["id"], r) for r in responses if r["id"] is not None)
+    errors = [r["error"] for r in responses if r["id"] is None]
+
+    assert len(responses) == len(lines)
+    assert sorted(errors) == ["Invalid request: Expecting value: line 1 column 1 (char 0)",
+                              "Invalid request: expected a JSON object"]
+
+    pstate = new_pstate("melee_2h", adrenaline=50, use_ringofvigour=True)
+    ticks = optimizer.to_ticks(sec=30)
+    rotation = optimizer.greedy_value(pstate, ticks)
+    assert by_id[1]["ok"]
+    assert by_id[1]["result"]["rotation"] == [getattr(a["action"], "name", None) for a in rotation]
+    assert by_id[1]["result"]["summary"]["damage"] == pytest.approx(optimizer.get_total(rotation))
+
+    assert by_id[3] == {"id": 3, "ok": False, "error": "ValueError: Unknown command: nope"}
+    assert by_id[4]["ok"] and by_id[4]["result"][0]["valid"] and not by_id[4]["result"][1]["valid"]
+
+
+# A repeated run is read back from the cache with the same rotation and
+# summary, runs that can't be reproduced aren't given a key
+def test_result_cache_round_trip(tmp_path):
+    cache = optimizer.ResultCache(str(tmp_path))
+    rotation, summary = optimizer.cached_optimize(new_pstate("melee_2h", adrenaline=50), 100, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    cached, cached_summary = optimizer.cached_optimize(new_pstate("melee_2h", adrenaline=50), 100, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cached_summary == summary
+    assert [getattr(a["action"], "name", None) for a in cached] == [getattr(a["action"], "name", None) for a in rotation]
+
+    assert optimizer.ResultCache.key(new_pstate("melee_2h", adrenaline=50), 200) != \
+        optimizer.ResultCache.key(new_pstate("melee_2h", adrenaline=50), 100)
+    assert optimizer.ResultCache.key(new_pstate("melee_2h", use_prng=True), 100) is None
+    assert optimizer.ResultCache.key(new_pstate("melee_2h"), 100, "mcts", {"iterations": 10}) is None
+
+
+# A pstate part way through a run (mods up, clock, counters, rolls used)
+# doesn't share a key with a fresh one
+def test_result_cache_key_covers_run_state():
+    fresh = new_pstate("melee_2h", adrenaline=100)
+    key = optimizer.ResultCache.key(fresh, 100)
+    assert optimizer.ResultCache.key(new_pstate("melee_2h", adrenaline=100), 100) == key
+
+    running = new_pstate("melee_2h", adrenaline=100)
+    optimizer.greedy_value(running, 20)
+    running.adrenaline = 100
+    for a, b in zip(running.actions, fresh.actions):
+        a.last_used, a.times_used = b.last_used, b.times_used
+    assert len(running.active_mods) > 0
+    assert optimizer.ResultCache.key(running, 100) != key
+
+    seeded = new_pstate("melee_2h", use_prng=True, seed=3)
+    key = optimizer.ResultCache.key(seeded, 100)
+    seeded.value(seeded.actions[0])
+    assert optimizer.ResultCache.key(seeded, 100) != key
+
+
+# Closures are only known to the key by name, two different ones (and
+# extra on_activate hooks) mean the run isn't cached at all
+def test_result_cache_key_skips_closures_and_hooks():
+    def check_at(adrenaline):
+        def chk(pstate):
+            return pstate.adrenaline >= adrenaline
+        return chk
+
+    keys = []
+    for adrenaline in (10, 90):
+        pstate = new_pstate("melee_2h", adrenaline=50)
+        pstate.actions[optimizer.Action.find_by_name("Assault", pstate.actions)].pstate_check = check_at(adrenaline)
+        keys.append(optimizer.ResultCache.key(pstate, 100))
+    assert keys == [None, None]
+
+    pstate = new_pstate("melee_2h", adrenaline=50)
+    assert optimizer.ResultCache.key(pstate, 100) is not None
+    pstate.on_activate.append(lambda pstate, action: None)
+    assert optimizer.ResultCache.key(pstate, 100) is None
+
+
+# An entry that was read is a hit even if touching it fails
+def test_result_cache_get_survives_utime_error(tmp_path, monkeypatch):
+    cache = optimizer.ResultCache(str(tmp_path))
+    cache.put("key", {"summary": {}, "rotation": None})
+
+    def utime(path, *args, **kwargs):
+        raise OSError("gone")
+
+    monkeypatch.setattr(optimizer.os, "utime", utime)
+    assert cache.get("key") == {"summary": {}, "rotation": None}
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+# Puts keep a running size and only list the directory to evict once it's
+# over max_bytes, the least recently used entries go first
+def test_result_cache_evicts_by_running_size(tmp_path, monkeypatch):
+    listings = []
+    listdir = optimizer.os.listdir
+    monkeypatch.setattr(optimizer.os, "listdir", lambda path: listings.append(path) or listdir(path))
+
+    cache = optimizer.ResultCache(str(tmp_path), max_bytes=10000)
+    entry = {"summary": {"damage": 1.0}, "rotation": list(range(0, 200))}
+    size = len(optimizer.zlib.compress(optimizer.pickle.dumps(entry, protocol=optimizer.pickle.HIGHEST_PROTOCOL)))
+    fits = 10000 // size
+
+    for k in range(0, fits):
+        cache.put("entry{0}".format(k), entry)
+        optimizer.os.utime(cache.path("entry{0}".format(k)), ns=(k, k))
+    cache.put("entry0", entry)
+    optimizer.os.utime(cache.path("entry0"), ns=(fits, fits))
+
+    assert len(listings) == 1
+    assert cache.bytes == cache.size() == fits * size
+
+    cache.put("new", entry)
+    assert cache.bytes == cache.size() <= 10000
+    assert cache.get("entry1") is None
+    assert cache.get("entry0") is not None and cache.get("new") is not None
+
+
+# Greedy total of a fresh run with name's field set to value (nudged the
+# same way SensitivityAnalysis does, a fresh action is off cooldown)
+def nudged_total(actions, name, field, value, ticks, **options):
+    nudged = []
+
+    for a in actions:
+        if field in optimizer.SENSITIVITY_MOD_FIELDS:
+            if a.mod is not None and a.mod.name == name:
+                a = copy.copy(a)
+                a.mod = optimizer.Modifier.new(a.mod.definition.replace(**{field: value}))
+        elif a.name == name:
+            enabled = a.enabled
+            a = optimizer.Action.new(a.definition.replace(**{field: value}))
+            a.enabled = enabled
+        nudged.append(a)
+
+    return optimizer.get_total(optimizer.greedy_value(optimizer.PState(nudged, **options), ticks))
+
+
+# Cooldowns also break ties between equal values, the x0.5/x1.5/+-1 nudges
+# reverse some of them before the action is ever used (Dismember 10 -> 15
+# makes Cleave win the tie at tick 0 of the 13 tick run)
+def test_sensitivity_perturb_matches_rerun():
+    for bar, ticks, options in (("melee_2h", 300, {"adrenaline": 50, "use_ringofvigour": True}),
+                                ("melee_2h", 13, {"adrenaline": 50}), ("range_2h", 300, {"adrenaline": 50})):
+        actions = optimizer.action_bars[bar]
+        analysis = optimizer.SensitivityAnalysis(optimizer.PState(actions, **options), ticks, interval=8)
+        parameters = [p for p in analysis.parameters() if p[1] in ("max", "cooldown", "multiplier")]
+        assert set(p[1] for p in parameters) == set(["max", "cooldown", "multiplier"])
+
+        for name, field in parameters:
+            old = analysis.value_of(name, field)
+            values = [old * 0.8, old * 1.1]
+            if field == "cooldown":
+                values += [old * 0.5, old * 1.5, old + 1, old - 1]
+            for value in values:
+                result = analysis.perturb(name, field, value)
+                assert result["damage"] == nudged_total(actions, name, field, value, ticks, **options), \
+                    (bar, ticks, name, field, value)